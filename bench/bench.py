@@ -0,0 +1,747 @@
+"""
+SFU CMPT 756
+In-process microbenchmarks for every service route.
+
+Each Flask app (db, s1, s2 and playlist v1/v2) is loaded in its own
+child process and driven through its test client.  The db service runs
+against an in-memory FakeDynamoDB; the other services' calls to the db
+service are answered in-process by a DatastoreAdapter (see `fakes.py`).
+Nothing touches the network or AWS, so the numbers measure the cost of
+the Python request path itself.
+
+For every route the suite reports:
+    ops_per_sec       throughput of back-to-back requests
+    p50_us, p99_us    per-request latency
+    alloc_peak_kib    peak memory allocated while serving one request
+    alloc_retained_b  memory still held after one request (leaks, caches)
+
+Results are written as JSON (default `bench/results/latest.json`) and
+compared with a stored baseline (default `bench/results/baseline.json`,
+created with --save-baseline).  A route that is slower or allocates
+more than the baseline by more than --tolerance fails the run with
+exit status 1.
+
+    $ python bench/bench.py --save-baseline     # on the base commit
+    $ python bench/bench.py                     # after a change
+
+With --id-list-sizes it prints the stored size of playlists of several
+lengths, and their read and write capacity units, with `music_list`
+stored as a list and packed (see `common/idlists.py`).  To compare the
+latency of the two, run the suite once with ID_LIST_ENCODING=packed.
+
+With --cold-start N the suite instead starts each app N times in a
+fresh interpreter and reports the median of
+    loaded_ms         process start until the app module is imported
+    preload_ms        time in `common.startup.preload`
+    first_request_ms  the app's first route case, as its first request
+    total_ms          the three together
+and the slowest imports of one extra run under `-X importtime`.
+A regression in total_ms fails the run like a slower route.  The db
+and DynamoDB are still the fakes, so the first request does not pay
+for connections or credentials.
+"""
+
+# Standard library modules
+import argparse
+import base64
+import csv
+import importlib.util
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+# Installed packages
+import requests
+
+import simplejson as json
+
+# Local modules
+import fakes
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESOURCE_DIR = os.path.join(REPO, 'gatling', 'resources')
+RESULTS_DIR = os.path.join(REPO, 'bench', 'results')
+
+DB_URL = 'http://cmpt756db:30002/'
+
+AUTH = {'Authorization': 'Bearer A'}
+LOADER_TOKEN = 'bench'
+LOADER_AUTH = {'Authorization': 'Basic ' + base64.standard_b64encode(
+    ('svc-loader:' + LOADER_TOKEN).encode()).decode()}
+
+# Version stamped on the music fixtures, for conditional GETs
+FIXTURE_ETAG = 'fixture'
+
+MIN_ITERATIONS = 50
+ALLOC_SAMPLES = 20
+
+# Environment every app is loaded with.  Warming would compete with
+# the timed requests.
+APP_ENV = {
+    'SVC_LOADER_TOKEN': LOADER_TOKEN,
+    'AWS_REGION': 'us-east-1',
+    'WARMUP_SOURCE': 'none',
+}
+
+# Slowest top-level imports reported per app by --cold-start
+COLD_IMPORTS = 5
+
+# Load an app in a fresh interpreter (COLD_LOAD is also profiled) and
+# time its own work
+COLD_LOAD = '''
+import importlib.util, sys, time
+sys.path[:0] = [{bench!r}, {repo!r}]
+spec = importlib.util.spec_from_file_location('cold', {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+'''
+COLD_START = COLD_LOAD + '''
+from common import startup
+loaded = startup.since_start()
+start = time.perf_counter()
+startup.preload(module.app)
+preload = time.perf_counter() - start
+import bench
+print(bench.json.dumps(dict(
+    loaded_ms=loaded * 1e3, preload_ms=preload * 1e3,
+    first_request_ms=bench.cold_request({name!r}, module) * 1e3)))
+'''
+
+# Metrics where bigger is worse, and the one where bigger is better
+COST_METRICS = ['alloc_peak_kib', 'total_ms']
+RATE_METRIC = 'ops_per_sec'
+
+# Tracks in the long playlist fixture, and the lengths --id-list-sizes
+# reports
+LONG_PLAYLIST = 100
+ID_LIST_LENGTHS = [2, 10, 100, 1000]
+
+
+def parse_args():
+    argp = argparse.ArgumentParser(
+        'bench',
+        description='In-process microbenchmarks for the service routes'
+        )
+    argp.add_argument(
+        '--apps',
+        default=','.join(APPS.keys()),
+        help="Comma-separated apps to benchmark (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--routes',
+        default='',
+        help="Only run cases whose name contains this string"
+        )
+    argp.add_argument(
+        '--min-time',
+        type=float,
+        default=1.0,
+        help="Minimum timed seconds per case (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--output',
+        default=os.path.join(RESULTS_DIR, 'latest.json'),
+        help="Results file (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--baseline',
+        default=os.path.join(RESULTS_DIR, 'baseline.json'),
+        help="Baseline to compare against (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help="Store these results as the new baseline"
+        )
+    argp.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help="Allowed fractional regression per metric (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--id-list-sizes',
+        action='store_true',
+        help="Print playlist sizes in each id-list encoding and exit"
+        )
+    argp.add_argument(
+        '--cold-start',
+        type=int,
+        default=0,
+        metavar='N',
+        help="Time N cold starts of each app instead of its routes"
+        )
+    argp.add_argument(
+        '--child',
+        help=argparse.SUPPRESS
+        )
+    return argp.parse_args()
+
+
+# ---------------------------------------------------------------------
+# Fixtures
+# ---------------------------------------------------------------------
+
+def read_csv(name):
+    with open(os.path.join(RESOURCE_DIR, name), 'r') as inp:
+        return list(csv.DictReader(inp))
+
+
+def bench_ids(n, kind='track'):
+    """Return `n` made-up UUIDs, the same on every run."""
+    return [str(uuid.uuid5(uuid.NAMESPACE_URL, 'bench-{}-{}'.format(kind, i)))
+            for i in range(n)]
+
+
+def stored_form(name):
+    """Return a function putting items in the form app `name` stores."""
+    if name != 'db':
+        # The DatastoreAdapter stores items as the services send them
+        return lambda item: item
+    # Needs the repository on sys.path, as set by load_app
+    from common import idlists
+    return idlists.encode_item
+
+
+def load_fixtures(dynamodb, store=lambda item: item):
+    """
+    Fill the fake tables from the Gatling resource files, passing each
+    playlist through `store`.
+    """
+    fx = {}
+    fx['users'] = read_csv('users.csv')
+    fx['music'] = read_csv('music.csv')
+    fx['playlists'] = read_csv('playlist.csv')
+    dynamodb.load('user', [
+        {'user_id': r['UUID'], 'fname': r['fname'], 'lname': r['lname'],
+         'email': r['email']} for r in fx['users']])
+    dynamodb.load('music', [
+        {'music_id': r['UUID'], 'Artist': r['Artist'],
+         'SongTitle': r['SongTitle'], 'etag': FIXTURE_ETAG}
+        for r in fx['music']])
+    dynamodb.load('playlist', [store(
+        {'playlist_id': r['UUID'], 'music_list': r['music_list'].split(','),
+         'owner': fx['users'][i % len(fx['users'])]['UUID']})
+        for i, r in enumerate(fx['playlists'])])
+    fx['long_playlist_id'] = bench_ids(1, 'playlist')[0]
+    dynamodb.load('playlist', [store(
+        {'playlist_id': fx['long_playlist_id'],
+         'music_list': bench_ids(LONG_PLAYLIST),
+         'owner': fx['users'][0]['UUID']})])
+    fx['user_id'] = fx['users'][0]['UUID']
+    fx['music_id'] = fx['music'][0]['UUID']
+    fx['playlist_id'] = fx['playlists'][0]['UUID']
+    in_list = set(fx['playlists'][0]['music_list'].split(','))
+    fx['extra_music_id'] = [r['UUID'] for r in fx['music']
+                            if r['UUID'] not in in_list][0]
+    return fx
+
+
+def put(dynamodb, objtype, item):
+    dynamodb.table_for(objtype).put_item(Item=item)
+
+
+def playlist_tracks(dynamodb, fx):
+    table = dynamodb.table_for('playlist')
+    return table.items[fx['playlist_id']]['music_list']
+
+
+def without_extra(dynamodb, fx, i):
+    tracks = playlist_tracks(dynamodb, fx)
+    if fx['extra_music_id'] in tracks:
+        tracks.remove(fx['extra_music_id'])
+
+
+def with_extra(dynamodb, fx, i):
+    tracks = playlist_tracks(dynamodb, fx)
+    if fx['extra_music_id'] not in tracks:
+        tracks.append(fx['extra_music_id'])
+
+
+# ---------------------------------------------------------------------
+# Cases
+# ---------------------------------------------------------------------
+
+class Case:
+    """
+    One benchmarked request.
+
+    `path`, `json` and `headers` may be callables of (fixtures,
+    iteration).
+    `setup(dynamodb, fixtures, iteration)` runs untimed before each
+    request, to put the store in the state the request expects.
+    """
+
+    def __init__(self, name, method, path, json=None, headers=AUTH,
+                 setup=None, ok=(200,)):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.json = json
+        self.headers = headers
+        self.setup = setup
+        self.ok = ok
+
+    def prepare(self, dynamodb, fx, i):
+        if self.setup is not None:
+            self.setup(dynamodb, fx, i)
+        path = self.path(fx, i) if callable(self.path) else self.path
+        body = self.json(fx, i) if callable(self.json) else self.json
+        headers = (self.headers(fx, i) if callable(self.headers)
+                   else self.headers)
+        return path, body, headers
+
+    def request(self, client, path, body, headers):
+        return client.open(path, method=self.method, json=body,
+                           headers=headers)
+
+
+def user_auth(fx, i):
+    """A verified token of the fixture user, for routes that need one."""
+    # Needs the repository on sys.path, as set by load_app
+    from common import auth
+    return {'Authorization': 'Bearer ' + auth.encode(fx['user_id'])}
+
+
+def db_cases():
+    prefix = '/api/v1/datastore/'
+
+    def music_key(fx, i):
+        return 'objtype=music&objkey=' + fx['music_id']
+
+    def bench_key(fx, i):
+        return 'bench-{}'.format(i)
+
+    return [
+        Case('read music', 'GET',
+             lambda fx, i: prefix + 'read?' + music_key(fx, i)),
+        Case('read playlist', 'GET',
+             lambda fx, i: prefix + 'read?objtype=playlist&objkey=' +
+             fx['playlist_id']),
+        Case('read long playlist', 'GET',
+             lambda fx, i: prefix + 'read?objtype=playlist&objkey=' +
+             fx['long_playlist_id']),
+        Case('read missing music', 'GET',
+             prefix + 'read?objtype=music&objkey=no-such-song'),
+        Case('query user', 'GET',
+             lambda fx, i: prefix + 'query?objtype=user&attr=email&value=' +
+             fx['users'][0]['email']),
+        Case('batch read music', 'POST', prefix + 'batch_read',
+             json=lambda fx, i: {'objtype': 'music', 'objkeys': [
+                 r['UUID'] for r in fx['music'][:20]]}),
+        Case('write music', 'POST', prefix + 'write',
+             json=lambda fx, i: {'objtype': 'music', 'Artist': 'Bench',
+                                 'SongTitle': 'Song {}'.format(i)}),
+        Case('update music', 'PUT',
+             lambda fx, i: prefix + 'update?' + music_key(fx, i),
+             json={'Artist': 'Bench', 'SongTitle': 'Updated'}),
+        Case('update long playlist', 'PUT',
+             lambda fx, i: prefix + 'update?objtype=playlist&objkey=' +
+             fx['long_playlist_id'],
+             json={'music_list': bench_ids(LONG_PLAYLIST)}),
+        Case('delete music', 'DELETE',
+             lambda fx, i: prefix + 'delete?objtype=music&objkey=' +
+             bench_key(fx, i),
+             setup=lambda db, fx, i: put(db, 'music',
+                                         {'music_id': bench_key(fx, i)})),
+        Case('load music', 'POST', prefix + 'load',
+             json=lambda fx, i: {'objtype': 'music', 'uuid': bench_key(fx, i),
+                                 'Artist': 'Bench', 'SongTitle': 'Loaded'},
+             headers=LOADER_AUTH),
+    ]
+
+
+def user_cases():
+    prefix = '/api/v1/user/'
+    return [
+        Case('get_user', 'GET', lambda fx, i: prefix + fx['user_id']),
+        Case('find_user_by_email', 'GET',
+             lambda fx, i: prefix + '?email=' + fx['users'][0]['email']),
+        Case('list_playlists', 'GET',
+             lambda fx, i: prefix + fx['user_id'] + '/playlists',
+             headers=user_auth),
+        Case('get_users', 'GET',
+             lambda fx, i: prefix + '?ids=' + ','.join(
+                 r['UUID'] for r in fx['users'][:20])),
+        Case('create_user', 'POST', prefix,
+             json={'fname': 'Bench', 'lname': 'User',
+                   'email': 'bench@example.com'}),
+        Case('update_user', 'PUT', lambda fx, i: prefix + fx['user_id'],
+             json={'fname': 'Bench', 'lname': 'User',
+                   'email': 'bench@example.com'}),
+        Case('delete_user', 'DELETE',
+             lambda fx, i: prefix + 'bench-{}'.format(i),
+             setup=lambda db, fx, i: put(db, 'user', {
+                 'user_id': 'bench-{}'.format(i)})),
+        Case('login', 'PUT', prefix + 'login',
+             json=lambda fx, i: {'uid': fx['user_id']}),
+    ]
+
+
+def music_cases():
+    prefix = '/api/v1/music/'
+    return [
+        Case('get_song', 'GET', lambda fx, i: prefix + fx['music_id']),
+        Case('get_song_unchanged', 'GET',
+             lambda fx, i: prefix + fx['music_id'],
+             headers=dict(AUTH, **{'If-None-Match': '"{}"'.format(
+                 FIXTURE_ETAG)}),
+             ok=(304,)),
+        Case('get_song_missing', 'GET', prefix + 'no-such-song'),
+        Case('get_songs', 'POST', prefix + 'batch',
+             json=lambda fx, i: {'ids': [r['UUID']
+                                         for r in fx['music'][:20]]}),
+        Case('create_song', 'POST', prefix,
+             json={'Artist': 'Bench', 'SongTitle': 'Song'}),
+        Case('update_song', 'PUT', lambda fx, i: prefix + fx['music_id'],
+             json={'Artist': 'Bench', 'SongTitle': 'Updated'}),
+        Case('delete_song', 'DELETE',
+             lambda fx, i: prefix + 'bench-{}'.format(i),
+             setup=lambda db, fx, i: put(db, 'music', {
+                 'music_id': 'bench-{}'.format(i)})),
+    ]
+
+
+def playlist_cases(get_ok=(200,)):
+    prefix = '/api/v1/playlist/'
+
+    def tracks_path(verb):
+        return lambda fx, i: '{}{}/{}/{}'.format(
+            prefix, fx['playlist_id'], verb, fx['extra_music_id'])
+
+    return [
+        Case('get_playlist', 'GET', lambda fx, i: prefix + fx['playlist_id'],
+             ok=get_ok),
+        Case('create_playlist', 'POST', prefix,
+             json=lambda fx, i: {'music_list': ','.join(
+                 r['UUID'] for r in fx['music'][:3])}),
+        Case('addmusic_playlist', 'PUT', tracks_path('add'),
+             setup=without_extra),
+        Case('removemusic_playlist', 'PUT', tracks_path('remove'),
+             setup=with_extra),
+        Case('delete_playlist', 'DELETE',
+             lambda fx, i: prefix + 'bench-{}'.format(i),
+             setup=lambda db, fx, i: put(db, 'playlist', {
+                 'playlist_id': 'bench-{}'.format(i), 'music_list': []})),
+    ]
+
+
+# playlist v2 deliberately fails half of its reads
+APPS = {
+    'db': ('db/app-tpl.py', db_cases),
+    's1': ('s1/app.py', user_cases),
+    's2': ('s2/v1/app.py', music_cases),
+    'playlist-v1': ('playlist/app.py', playlist_cases),
+    'playlist-v2': ('playlist/v2/app.py',
+                    lambda: playlist_cases(get_ok=(200, 500))),
+}
+
+
+# ---------------------------------------------------------------------
+# Running one app (in a child process)
+# ---------------------------------------------------------------------
+
+def install_datastore(dynamodb):
+    """Answer every `requests` call to the db service from `dynamodb`."""
+    adapter = fakes.DatastoreAdapter(dynamodb)
+    get_adapter = requests.Session.get_adapter
+
+    def bench_get_adapter(self, url):
+        if url.startswith(DB_URL):
+            return adapter
+        return get_adapter(self, url)
+
+    requests.Session.get_adapter = bench_get_adapter
+
+
+def load_app(name, dynamodb):
+    path = os.path.join(REPO, APPS[name][0])
+    for key, value in APP_ENV.items():
+        os.environ.setdefault(key, value)
+    sys.path.insert(0, REPO)
+    if name != 'db':
+        install_datastore(dynamodb)
+    spec = importlib.util.spec_from_file_location(
+        'bench_' + name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if name == 'db':
+        module.dynamodb = dynamodb
+    return module.app
+
+
+def percentile(sorted_vals, pct):
+    rank = int(round(pct / 100.0 * (len(sorted_vals) - 1)))
+    return sorted_vals[rank]
+
+
+def run_case(case, client, dynamodb, fx, min_time):
+    i = 0
+    path, body, headers = case.prepare(dynamodb, fx, i)
+    resp = case.request(client, path, body, headers)
+    if resp.status_code not in case.ok:
+        raise RuntimeError('{}: status {}: {}'.format(
+            case.name, resp.status_code, resp.get_data(as_text=True)[:200]))
+
+    times = []
+    total = 0.0
+    while total < min_time or len(times) < MIN_ITERATIONS:
+        i += 1
+        path, body, headers = case.prepare(dynamodb, fx, i)
+        start = time.perf_counter()
+        case.request(client, path, body, headers)
+        elapsed = time.perf_counter() - start
+        times.append(elapsed)
+        total += elapsed
+
+    peaks = []
+    retained = []
+    for _ in range(ALLOC_SAMPLES):
+        i += 1
+        path, body, headers = case.prepare(dynamodb, fx, i)
+        tracemalloc.start()
+        case.request(client, path, body, headers)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        peaks.append(peak)
+        retained.append(current)
+
+    times.sort()
+    return {
+        'iterations': len(times),
+        'ops_per_sec': len(times) / total,
+        'p50_us': percentile(times, 50) * 1e6,
+        'p99_us': percentile(times, 99) * 1e6,
+        'alloc_peak_kib': sum(peaks) / len(peaks) / 1024.0,
+        'alloc_retained_b': sum(retained) / len(retained),
+    }
+
+
+def run_app(name, routes, min_time):
+    dynamodb = fakes.FakeDynamoDB()
+    app = load_app(name, dynamodb)
+    fx = load_fixtures(dynamodb, stored_form(name))
+    client = app.test_client()
+    results = {}
+    for case in APPS[name][1]():
+        if routes in case.name:
+            results[case.name] = run_case(case, client, dynamodb, fx,
+                                          min_time)
+    return results
+
+
+def run_child(name, routes, min_time):
+    """Benchmark one app in a fresh interpreter; return its results."""
+    with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as tmp:
+        out = tmp.name
+    try:
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--child', out, '--apps', name,
+               '--routes', routes, '--min-time', str(min_time)]
+        subprocess.run(cmd, check=True)
+        with open(out, 'r') as inp:
+            return json.load(inp)
+    finally:
+        os.unlink(out)
+
+
+def cold_request(name, module):
+    """Time the first case of app `name` as `module`'s first request."""
+    dynamodb = fakes.FakeDynamoDB()
+    fx = load_fixtures(dynamodb, stored_form(name))
+    if name == 'db':
+        module.dynamodb = dynamodb
+    else:
+        install_datastore(dynamodb)
+    case = APPS[name][1]()[0]
+    path, body, headers = case.prepare(dynamodb, fx, 0)
+    client = module.app.test_client()
+    start = time.perf_counter()
+    case.request(client, path, body, headers)
+    return time.perf_counter() - start
+
+
+def slowest_imports(profile):
+    """Return the slowest top-level imports in `-X importtime` output."""
+    imports = []
+    for line in profile.splitlines():
+        fields = line.split('|')
+        if not line.startswith('import time:') or len(fields) != 3:
+            continue
+        name = fields[2][1:]
+        if name.startswith(' ') or not fields[1].strip().isdigit():
+            continue
+        imports.append((int(fields[1]) / 1e3, name))
+    imports.sort(reverse=True)
+    return {name: ms for ms, name in imports[:COLD_IMPORTS]}
+
+
+def run_cold(name, samples):
+    """Start app `name` `samples` times; return the median timings."""
+    args = dict(bench=os.path.dirname(os.path.abspath(__file__)),
+                repo=REPO, path=os.path.join(REPO, APPS[name][0]),
+                name=name)
+    env = dict(APP_ENV, **os.environ)
+    runs = []
+    for _ in range(samples):
+        out = subprocess.run([sys.executable, '-c',
+                              COLD_START.format(**args)],
+                             env=env, check=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL).stdout
+        run = json.loads(out.decode().splitlines()[-1])
+        run['total_ms'] = sum(run.values())
+        runs.append(run)
+    profile = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                              COLD_LOAD.format(**args)],
+                             env=env, check=True, stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE).stderr
+    result = {metric: percentile(sorted(run[metric] for run in runs), 50)
+              for metric in runs[0]}
+    result['samples'] = samples
+    result['imports'] = slowest_imports(profile.decode())
+    return {'cold start': result}
+
+
+def print_id_list_sizes():
+    """Print the stored size of playlists in each id-list encoding."""
+    sys.path.insert(0, REPO)
+    from common import idlists
+    print('{:>6} {:>9} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'tracks', 'list B', 'packed B', 'saving', 'list RCU', 'pack RCU',
+        'list WCU', 'pack WCU'))
+    for n in ID_LIST_LENGTHS:
+        item = {'playlist_id': bench_ids(1, 'playlist')[0],
+                'music_list': bench_ids(n),
+                'owner': bench_ids(1, 'user')[0],
+                'etag': '0123456789abcdef'}
+        sizes = [idlists.item_size(idlists.encode_item(dict(item), e))
+                 for e in (idlists.LIST, idlists.PACKED)]
+        # Strongly consistent reads take 4 KB per unit, writes 1 KB
+        print('{:6} {:9} {:9} {:>7} {:9} {:9} {:9} {:9}'.format(
+            n, sizes[0], sizes[1], '{:.0%}'.format(1 - sizes[1] / sizes[0]),
+            -(-sizes[0] // 4096), -(-sizes[1] // 4096),
+            -(-sizes[0] // 1024), -(-sizes[1] // 1024)))
+
+
+# ---------------------------------------------------------------------
+# Reporting
+# ---------------------------------------------------------------------
+
+def compare(results, baseline, tolerance):
+    """Return a list of regression messages against `baseline`."""
+    regressions = []
+    for app, cases in results.items():
+        for case, res in cases.items():
+            base = baseline.get(app, {}).get(case)
+            if base is None:
+                continue
+            if RATE_METRIC in res and \
+                    res[RATE_METRIC] < base[RATE_METRIC] * (1 - tolerance):
+                regressions.append('{} {}: {} {:.0f} < baseline {:.0f}'.format(
+                    app, case, RATE_METRIC, res[RATE_METRIC],
+                    base[RATE_METRIC]))
+            for metric in COST_METRICS:
+                if metric in res and \
+                        res[metric] > base[metric] * (1 + tolerance):
+                    regressions.append(
+                        '{} {}: {} {:.1f} > baseline {:.1f}'.format(
+                            app, case, metric, res[metric], base[metric]))
+    return regressions
+
+
+def print_results(results, baseline):
+    print('{:12} {:22} {:>9} {:>7} {:>9} {:>9} {:>10} {:>10}'.format(
+        'app', 'route', 'ops/s', 'vs base', 'p50 us', 'p99 us',
+        'peak KiB', 'retained B'))
+    for app, cases in results.items():
+        for case, res in cases.items():
+            if RATE_METRIC not in res:
+                continue
+            base = baseline.get(app, {}).get(case)
+            change = ''
+            if base is not None:
+                change = '{:+.0%}'.format(
+                    res[RATE_METRIC] / base[RATE_METRIC] - 1)
+            print('{:12} {:22} {:9.0f} {:>7} {:9.0f} {:9.0f} {:10.1f} '
+                  '{:10.0f}'.format(app, case, res['ops_per_sec'], change,
+                                    res['p50_us'], res['p99_us'],
+                                    res['alloc_peak_kib'],
+                                    res['alloc_retained_b']))
+
+
+def print_cold(results, baseline):
+    print('{:12} {:>9} {:>10} {:>10} {:>9} {:>7}'.format(
+        'app', 'loaded ms', 'preload ms', 'first ms', 'total ms',
+        'vs base'))
+    for app, cases in results.items():
+        res = cases['cold start']
+        base = baseline.get(app, {}).get('cold start')
+        change = ''
+        if base is not None:
+            change = '{:+.0%}'.format(res['total_ms'] / base['total_ms'] - 1)
+        print('{:12} {:9.0f} {:10.1f} {:10.1f} {:9.0f} {:>7}'.format(
+            app, res['loaded_ms'], res['preload_ms'],
+            res['first_request_ms'], res['total_ms'], change))
+    for app, cases in results.items():
+        print('{:12} slowest imports: {}'.format(app, ', '.join(
+            '{} {:.0f}ms'.format(name, ms)
+            for name, ms in cases['cold start']['imports'].items())))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    apps = [a for a in args.apps.split(',') if a]
+    unknown = [a for a in apps if a not in APPS]
+    if unknown:
+        print("Unknown apps: {}".format(', '.join(unknown)))
+        sys.exit(2)
+
+    if args.id_list_sizes:
+        print_id_list_sizes()
+        sys.exit(0)
+
+    if args.child:
+        res = run_app(apps[0], args.routes, args.min_time)
+        with open(args.child, 'w') as out:
+            json.dump(res, out)
+        sys.exit(0)
+
+    if args.cold_start > 0:
+        results = {a: run_cold(a, args.cold_start) for a in apps}
+    else:
+        results = {a: run_child(a, args.routes, args.min_time)
+                   for a in apps}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as inp:
+            baseline = json.load(inp)
+
+    if args.cold_start > 0:
+        print_cold(results, baseline)
+    else:
+        print_results(results, baseline)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as out:
+        json.dump(results, out, indent=2)
+
+    if args.save_baseline:
+        for app, cases in results.items():
+            baseline.setdefault(app, {}).update(cases)
+        with open(args.baseline, 'w') as out:
+            json.dump(baseline, out, indent=2)
+        print("Saved baseline to {}".format(args.baseline))
+        sys.exit(0)
+
+    if not baseline:
+        print("No baseline at {}; run with --save-baseline".format(
+            args.baseline))
+        sys.exit(0)
+    regressions = compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print("REGRESSION " + r)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,258 @@
+"""
+SFU CMPT 756
+In-memory stand-ins for the datastores used by the benchmarks.
+
+FakeDynamoDB replaces the boto3 DynamoDB resource of the db service.
+DatastoreAdapter is a `requests` transport adapter that answers the
+db service's REST API (`/api/v1/datastore/...`) from a FakeDynamoDB,
+so that the user, music and playlist services can be driven without
+a network or a running db service.
+
+Only the subset of each API that the services actually use is
+implemented.  Keep these in step with `db/app-tpl.py`.
+"""
+
+# Standard library modules
+import base64
+import copy
+import io
+import re
+import types
+import urllib.parse
+import uuid
+
+# Installed packages
+import botocore.exceptions
+
+import requests
+
+import simplejson as json
+
+OK_METADATA = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+
+SET_CLAUSE = re.compile(r'\s*(#?\w+)\s*=\s*(:\w+)\s*')
+
+
+class FakeTable:
+    """A DynamoDB table holding items in a dict keyed by hash key."""
+
+    def __init__(self, name, key_name):
+        self.name = name
+        self.key_name = key_name
+        self.items = {}
+
+    def query(self, KeyConditionExpression, Select='ALL_ATTRIBUTES',
+              IndexName=None, **kw):
+        expr = KeyConditionExpression.get_expression()
+        key, value = expr['values']
+        if IndexName is not None:
+            return self.lookup_index(key.name, value, kw.get('Limit'),
+                                     kw.get('ExclusiveStartKey'))
+        if key.name != self.key_name:
+            raise ValueError("fake tables only query their hash key")
+        return self.lookup(value)
+
+    def lookup(self, objkey):
+        """Return the query response for the item with this hash key."""
+        items = []
+        if objkey in self.items:
+            items.append(copy.deepcopy(self.items[objkey]))
+        return dict(Items=items,
+                    Count=len(items),
+                    ScannedCount=len(items),
+                    **OK_METADATA)
+
+    def lookup_index(self, attr, value, limit=None, start=None):
+        """Return the query response of a secondary index on `attr`."""
+        # A scan; the benchmarks time the services, not the index
+        keys = sorted(k for k, item in self.items.items()
+                      if item.get(attr) == value)
+        response = self.page(keys, limit, start)
+        if 'LastEvaluatedKey' in response:
+            response['LastEvaluatedKey'][attr] = value
+        return response
+
+    def scan(self, Limit=None, ExclusiveStartKey=None, **kw):
+        return self.page(sorted(self.items), Limit, ExclusiveStartKey)
+
+    def page(self, keys, limit, start):
+        """Return the response for the items with these keys, in pages."""
+        if start is not None:
+            keys = [k for k in keys if k > start[self.key_name]]
+        more = limit is not None and len(keys) > limit
+        items = [copy.deepcopy(self.items[k]) for k in keys[:limit]]
+        response = dict(Items=items,
+                        Count=len(items),
+                        ScannedCount=len(items),
+                        **OK_METADATA)
+        if more:
+            response['LastEvaluatedKey'] = {self.key_name: keys[limit - 1]}
+        return response
+
+    def put_item(self, Item, **kw):
+        self.items[Item[self.key_name]] = copy.deepcopy(Item)
+        return dict(OK_METADATA)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues,
+                    ConditionExpression=None, ExpressionAttributeNames=None,
+                    **kw):
+        """SET updates, with an optional condition of `a = :v` terms."""
+        names = ExpressionAttributeNames or {}
+        objkey = Key[self.key_name]
+        if not UpdateExpression.startswith('SET '):
+            raise ValueError("fake tables only support SET updates")
+        if ConditionExpression is not None:
+            item = self.items.get(objkey, {})
+            for clause in ConditionExpression.split(' AND '):
+                attr, val = SET_CLAUSE.fullmatch(clause).groups()
+                if item.get(names.get(attr, attr)) != \
+                        ExpressionAttributeValues[val]:
+                    raise botocore.exceptions.ClientError(
+                        {'Error': {'Code': 'ConditionalCheckFailedException',
+                                   'Message': 'The conditional request '
+                                              'failed'}},
+                        'UpdateItem')
+        item = self.items.setdefault(objkey, {self.key_name: objkey})
+        for clause in UpdateExpression[4:].split(','):
+            attr, val = SET_CLAUSE.fullmatch(clause).groups()
+            item[names.get(attr, attr)] = copy.deepcopy(
+                ExpressionAttributeValues[val])
+        return dict(OK_METADATA)
+
+    def delete_item(self, Key, **kw):
+        self.items.pop(Key[self.key_name], None)
+        return dict(OK_METADATA)
+
+
+class FakeClient:
+    """Stand-in for the low-level client, `dynamodb.meta.client`."""
+
+    def __init__(self, dynamodb):
+        self.dynamodb = dynamodb
+
+    def describe_table(self, TableName):
+        table = self.dynamodb.Table(TableName)
+        return dict(Table={'TableName': TableName,
+                           'TableStatus': 'ACTIVE',
+                           'ItemCount': len(table.items)},
+                    **OK_METADATA)
+
+
+class FakeDynamoDB:
+    """Stand-in for `boto3.resource('dynamodb')`."""
+
+    def __init__(self):
+        self.tables = {}
+        self.meta = types.SimpleNamespace(client=FakeClient(self))
+
+    def Table(self, name):
+        if name not in self.tables:
+            # Table names are '<Objtype>-<registry id>', keyed by
+            # '<objtype>_id'
+            objtype = name.split('-')[0].lower()
+            self.tables[name] = FakeTable(name, objtype + '_id')
+        return self.tables[name]
+
+    def table_for(self, objtype):
+        for name, table in self.tables.items():
+            if table.key_name == objtype + '_id':
+                return table
+        return self.Table(objtype.capitalize() + '-ZZ-REG-ID')
+
+    def batch_get_item(self, RequestItems, **kw):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.Table(name)
+            responses[name] = [
+                copy.deepcopy(table.items[key[table.key_name]])
+                for key in request['Keys']
+                if key[table.key_name] in table.items]
+        return dict(Responses=responses, UnprocessedKeys={}, **OK_METADATA)
+
+    def load(self, objtype, items):
+        """Bulk-load items (dicts including '<objtype>_id')."""
+        table = self.table_for(objtype)
+        for item in items:
+            table.put_item(Item=item)
+
+
+class DatastoreAdapter(requests.adapters.BaseAdapter):
+    """Serve the db service's REST API from a FakeDynamoDB."""
+
+    def __init__(self, dynamodb):
+        super().__init__()
+        self.dynamodb = dynamodb
+
+    def send(self, request, **kwargs):
+        url = urllib.parse.urlsplit(request.url)
+        endpoint = url.path.rstrip('/').split('/')[-1]
+        params = dict(urllib.parse.parse_qsl(url.query))
+        body = json.loads(request.body) if request.body else None
+        handler = getattr(self, 'do_' + endpoint, None)
+        if handler is None:
+            return self.response(request, 404, {"error": "no such route"})
+        return self.response(request, 200, handler(params, body))
+
+    def close(self):
+        pass
+
+    def response(self, request, status, payload):
+        resp = requests.Response()
+        resp.status_code = status
+        resp.headers['Content-Type'] = 'application/json'
+        resp.raw = io.BytesIO(json.dumps(payload).encode())
+        resp.url = request.url
+        resp.request = request
+        return resp
+
+    def do_health(self, params, body):
+        return {}
+
+    def do_read(self, params, body):
+        table = self.dynamodb.table_for(params['objtype'])
+        return table.lookup(params['objkey'])
+
+    def do_query(self, params, body):
+        table = self.dynamodb.table_for(params['objtype'])
+        limit = int(params['limit']) if 'limit' in params else None
+        start = None
+        if 'start' in params:
+            start = json.loads(base64.urlsafe_b64decode(params['start']))
+        response = table.lookup_index(params['attr'], params['value'],
+                                      limit, start)
+        if 'LastEvaluatedKey' in response:
+            response['NextToken'] = base64.urlsafe_b64encode(
+                json.dumps(response['LastEvaluatedKey']).encode()).decode()
+        return response
+
+    def do_batch_read(self, params, body):
+        table = self.dynamodb.table_for(body['objtype'])
+        found = {k: copy.deepcopy(table.items[k])
+                 for k in body['objkeys'] if k in table.items}
+        return {"Items": [found.get(k) for k in body['objkeys']],
+                "Count": len(found),
+                "Missing": [k for k in dict.fromkeys(body['objkeys'])
+                            if k not in found]}
+
+    def do_write(self, params, body):
+        objtype = body.pop('objtype')
+        table = self.dynamodb.table_for(objtype)
+        item = {table.key_name: str(uuid.uuid4())}
+        item.update(body)
+        item['etag'] = uuid.uuid4().hex[:16]
+        table.put_item(Item=item)
+        return {table.key_name: item[table.key_name]}
+
+    def do_update(self, params, body):
+        table = self.dynamodb.table_for(params['objtype'])
+        body['etag'] = uuid.uuid4().hex[:16]
+        expression = 'SET ' + ', '.join(
+            '{} = :val{}'.format(k, i) for i, k in enumerate(body))
+        values = {':val{}'.format(i): v for i, v in enumerate(body.values())}
+        return table.update_item(Key={table.key_name: params['objkey']},
+                                 UpdateExpression=expression,
+                                 ExpressionAttributeValues=values)
+
+    def do_delete(self, params, body):
+        table = self.dynamodb.table_for(params['objtype'])
+        return table.delete_item(Key={table.key_name: params['objkey']})
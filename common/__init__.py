@@ -0,0 +1,9 @@
+"""
+SFU CMPT 756
+Code shared by the db, user, music and playlist services.
+
+Every service image copies this package next to its `app.py`
+(the images are built from the top of the repo; see `k8s-tpl.mak`).
+To run a service outside a container, put the top of the repo
+on the path, e.g. `PYTHONPATH=. python s1/app.py 30000`.
+"""
@@ -0,0 +1,204 @@
+"""
+SFU CMPT 756
+Bearer-token verification.
+
+The user service's `login` issues HS256 JWTs with `encode`.  `init_app`
+verifies the token of every request that presents one, without calling
+any other service:
+
+* a request with an invalid, expired or revoked token is answered 401.
+  Any credential shaped like a JWT (three dot-separated segments) is
+  verified, whatever scheme it is sent with, so that a revoked token
+  cannot be replayed as e.g. `Token <jwt>`;
+* a request with a valid token has its user id in `g.user_id`;
+* requests without an Authorization header are left to the views,
+  which decide whether the route needs one.
+
+Verifying an HS256 signature costs tens of microseconds, so results are
+kept in an LRU cache keyed by a 16-byte hash of the token; a cached
+token costs one hash and one dict lookup.  Tokens passed to `revoke`
+(by `logoff`) are remembered, by hash, until they expire, and the hash
+is published on the change feed (see `common/changes.py`) as a change
+to objtype 'token', so that every process the feed reaches refuses the
+token too.
+
+Revocation is therefore per process unless the feed is enabled.  The
+deployment templates run several workers per pod (WEB_WORKERS) with
+the default local feed, so a logoff is enforced only by the s1 worker
+that served it; the other workers, the other s1 pods, s2 and playlist
+keep accepting the token until it expires.  To enforce it everywhere,
+apply cluster/change-feed.yaml and set CHANGE_FEED=http, with its
+peers and secret, on every service.
+
+Modes (AUTH_MODE):
+    permissive  (default) tokens that are not JWTs, such as the
+                `Bearer A` sent by mcli and loadgen, are accepted
+                unverified; JWTs must be valid
+    strict      every token must be a valid JWT
+
+Environment variables:
+    AUTH_MODE        permissive or strict (default permissive)
+    JWT_SECRET       HS256 signing key (default 'secret')
+    JWT_TTL          seconds a new token is valid (default 3600)
+    AUTH_CACHE_SIZE  verification results cached (default 10000)
+"""
+
+# Standard library modules
+import collections
+import hashlib
+import os
+import threading
+import time
+
+# Installed packages
+from flask import g
+from flask import request
+from flask import Response
+
+import jwt
+
+from prometheus_client import Counter
+
+import simplejson as json
+
+# Local modules
+from common import changes
+from common import timing
+
+SECRET = os.getenv('JWT_SECRET', 'secret')
+TTL = int(os.getenv('JWT_TTL', '3600'))
+CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '10000'))
+STRICT = os.getenv('AUTH_MODE', 'permissive') == 'strict'
+
+# Paths ending in these are probes or scrapes and are never checked
+SKIP_SUFFIXES = ('/health', '/readiness', '/metrics')
+
+# The change-feed objtype of revocations
+REVOKED_TYPE = 'token'
+
+RESULTS = Counter('auth_results_total',
+                  'Token checks, by result',
+                  ['result'])
+
+cache = collections.OrderedDict()
+revoked = {}
+lock = threading.Lock()
+
+
+def token_key(token):
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def encode(user_id):
+    """Return a new token for `user_id`."""
+    now = time.time()
+    token = jwt.encode({'user_id': user_id, 'time': now,
+                        'exp': int(now) + TTL},
+                       SECRET,
+                       algorithm='HS256')
+    # PyJWT 1.x returns bytes, 2.x returns str
+    return token.decode() if isinstance(token, bytes) else token
+
+
+def decode(token):
+    """Return (claims, None) for a valid token, or (None, reason)."""
+    try:
+        return jwt.decode(token, SECRET, algorithms=['HS256']), None
+    except jwt.ExpiredSignatureError:
+        return None, 'expired'
+    except jwt.InvalidTokenError:
+        return None, 'invalid'
+
+
+def check(token):
+    """Return (claims, None) for a usable token, or (None, reason)."""
+    key = token_key(token)
+    now = time.time()
+    with lock:
+        entry = cache.get(key)
+        if entry is not None:
+            cache.move_to_end(key)
+        if key in revoked:
+            return None, 'revoked'
+    if entry is None:
+        entry = decode(token)
+        with lock:
+            cache[key] = entry
+            if len(cache) > CACHE_SIZE:
+                cache.popitem(last=False)
+        result = 'verified'
+    else:
+        result = 'cached'
+    claims, reason = entry
+    if claims is not None and claims.get('exp', now) < now:
+        return None, 'expired'
+    if claims is not None:
+        RESULTS.labels(result).inc()
+    return entry
+
+
+def remember(key, expires):
+    now = time.time()
+    with lock:
+        revoked[key] = expires
+        # Forget tokens that have expired anyway
+        if len(revoked) % 1000 == 0:
+            for k in [k for k, exp in revoked.items() if exp < now]:
+                del revoked[k]
+
+
+def revoked_elsewhere(change):
+    """Change-feed subscriber: remember a token revoked by any process."""
+    try:
+        remember(bytes.fromhex(change.objkey), float(change.version))
+    except (TypeError, ValueError):
+        pass
+
+
+changes.subscribe(REVOKED_TYPE, revoked_elsewhere)
+
+
+def revoke(token):
+    """Refuse `token` from now until it expires, in every process the
+    change feed reaches; ignore invalid tokens."""
+    claims, reason = check(token)
+    if claims is None:
+        return
+    key = token_key(token)
+    expires = claims.get('exp', time.time() + TTL)
+    remember(key, expires)
+    changes.publish(REVOKED_TYPE, key.hex(), expires)
+
+
+def unauthorized(reason):
+    RESULTS.labels(reason).inc()
+    return Response(json.dumps({"error": "{} token".format(reason)}),
+                    status=401,
+                    mimetype='application/json')
+
+
+def init_app(app):
+    """Verify the bearer token of every request to `app` that has one."""
+    @app.before_request
+    def authenticate():
+        header = request.headers.get('Authorization')
+        if header is None or request.path.endswith(SKIP_SUFFIXES):
+            return None
+        scheme, _, token = header.partition(' ')
+        token = token.strip()
+        if token.count('.') != 2 and scheme.count('.') == 2:
+            # A bare JWT with no scheme
+            token = scheme
+        if token.count('.') != 2:
+            if STRICT:
+                return unauthorized('invalid')
+            RESULTS.labels('opaque').inc()
+            return None
+        if STRICT and scheme != 'Bearer':
+            return unauthorized('invalid')
+        with timing.phase('auth'):
+            claims, reason = check(token)
+        if claims is None:
+            return unauthorized(reason)
+        g.user_id = claims.get('user_id')
+        return None
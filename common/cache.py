@@ -0,0 +1,311 @@
+"""
+SFU CMPT 756
+Read cache and conditional GETs for the services.
+
+The db service stamps every item it writes with an `etag` attribute, a
+new random token on each `/write`, `/update` and `/load`.  A service
+keeps the db responses of its single-item reads in a TTLCache, an LRU
+whose entries expire CACHE_TTL seconds after they were fetched:
+
+    songs = cache.TTLCache('music')
+    ...
+    body = cache.read(songs, music_id, lambda: dbclient.get(...))
+    return cache.respond(body)
+
+`respond` sends the item's etag as the ETag header and answers 304,
+without a body, when the request's If-None-Match has that etag.  A
+client polling an unchanged item with a fresh cache entry therefore
+costs neither a db call nor a JSON encode.
+
+Each process has its own cache.  A write through one process
+invalidates that process's entry, and the change feed (see
+`common/changes.py`), if enabled, invalidates the others'.  Otherwise
+they serve the old version until their entry expires: CACHE_TTL
+seconds, then up to CACHE_STALE_TTL more while it is refreshed, or
+CACHE_STALE_IF_ERROR more while the db service is failing (see below).
+A fetch that was under way when its key was invalidated is not cached,
+so it cannot put back the version from before a write.
+
+Reads of ids that do not exist are remembered too, in each cache's
+`missing` cache, so that repeated lookups of a bad or deleted id do
+not reach the db service.  Its entries live only NEGATIVE_CACHE_TTL
+seconds, and it holds at most NEGATIVE_CACHE_SIZE ids, so a client
+scanning random ids evicts only other missing ids.  The db service
+keeps the same kind of cache in front of DynamoDB.
+
+An entry is not dropped the moment it goes stale.  For up to
+CACHE_STALE_TTL seconds past its freshness, `read` returns it at once
+and refreshes it from the db service in a background thread, so a
+popular item never makes a reader wait for the db.  For up to
+CACHE_STALE_IF_ERROR seconds, `read` returns it when the db call
+fails (an exception or a 5xx), rather than passing the failure on.
+Each stale response is counted in cache_stale_served_total.
+
+Environment variables:
+    CACHE_TTL            seconds an entry is fresh; 0 disables caching
+                         (default 5)
+    CACHE_SIZE           entries per cache (default 10000)
+    CACHE_STALE_TTL      seconds past CACHE_TTL an entry is served while
+                         it is refreshed (default 30)
+    CACHE_STALE_IF_ERROR seconds past CACHE_TTL an entry is served when
+                         the db is failing (default 300)
+    NEGATIVE_CACHE_TTL   seconds a not-found result is remembered; 0
+                         disables (default 1)
+    NEGATIVE_CACHE_SIZE  not-found ids remembered per cache
+                         (default 10000)
+"""
+
+# Standard library modules
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+import time
+
+# Installed packages
+from flask import request
+from flask import Response
+
+from prometheus_client import Counter
+
+import simplejson as json
+
+
+def env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        logging.error("invalid {}, using {}".format(name, default))
+        return default
+
+
+CACHE_TTL = env_float('CACHE_TTL', 5.0)
+CACHE_SIZE = int(env_float('CACHE_SIZE', 10000))
+NEGATIVE_TTL = env_float('NEGATIVE_CACHE_TTL', 1.0)
+NEGATIVE_SIZE = int(env_float('NEGATIVE_CACHE_SIZE', 10000))
+STALE_TTL = env_float('CACHE_STALE_TTL', 30.0)
+STALE_IF_ERROR = env_float('CACHE_STALE_IF_ERROR', 300.0)
+
+# Background refreshes run in a small pool per process
+REFRESH_THREADS = 4
+
+LOOKUPS = Counter('cache_lookups_total',
+                  'Service cache lookups, by cache and result',
+                  ['cache', 'result'])
+CONDITIONAL = Counter('conditional_responses_total',
+                      'Responses to reads carrying an ETag, by result',
+                      ['result'])
+STALE_SERVED = Counter('cache_stale_served_total',
+                       'Stale entries served, by cache and reason',
+                       ['cache', 'reason'])
+
+executor = None
+executor_pid = None
+refreshing = set()
+refresh_lock = threading.Lock()
+
+
+class TTLCache:
+    """
+    A thread-safe LRU cache whose entries are fresh for `ttl` seconds.
+
+    Stale entries are kept for `keep` more seconds, for `get_stale`.
+    Unless `missing` is False, `self.missing` is a second, short-lived
+    TTLCache for keys known not to exist.
+
+    A value fetched while its key is invalidated may predate the write
+    that invalidated it.  Take a `token()` before fetching and pass it
+    to `put`, which then drops the value if the key was invalidated
+    since.  The last `size` invalidations are remembered by key; a
+    token older than the ones forgotten is treated as invalidated.
+    """
+
+    def __init__(self, name, size=CACHE_SIZE, ttl=CACHE_TTL,
+                 keep=max(STALE_TTL, STALE_IF_ERROR), missing=True):
+        self.name = name
+        self.size = size
+        self.ttl = ttl
+        self.keep = keep
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # Invalidation count, the count at each key's last invalidation,
+        # and the latest count forgotten
+        self.clock = 0
+        self.invalidated = collections.OrderedDict()
+        self.floor = 0
+        self.missing = None
+        if missing:
+            self.missing = TTLCache(name + '-missing', NEGATIVE_SIZE,
+                                    NEGATIVE_TTL, keep=0, missing=False)
+
+    def get(self, key):
+        """Return the fresh value for `key`, or None."""
+        if self.ttl <= 0:
+            return None
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                result = 'miss'
+            elif entry[1] + self.keep < now:
+                del self.entries[key]
+                result = 'expired'
+            elif entry[1] < now:
+                result = 'stale'
+            else:
+                self.entries.move_to_end(key)
+                result = 'hit'
+        LOOKUPS.labels(self.name, result).inc()
+        return entry[0] if result == 'hit' else None
+
+    def get_stale(self, key):
+        """Return (value, seconds stale) for a kept entry, or (None, None)."""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None, None
+        stale = time.monotonic() - entry[1]
+        if stale > self.keep:
+            return None, None
+        return entry[0], stale
+
+    def token(self):
+        """Return the token for a value about to be fetched."""
+        with self.lock:
+            return self.clock
+
+    def put(self, key, value, token=None):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            if token is not None and \
+                    self.invalidated.get(key, self.floor) > token:
+                return
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.clock += 1
+            self.invalidated[key] = self.clock
+            self.invalidated.move_to_end(key)
+            if len(self.invalidated) > self.size:
+                _, forgotten = self.invalidated.popitem(last=False)
+                self.floor = max(self.floor, forgotten)
+        if self.missing is not None:
+            self.missing.invalidate(key)
+
+
+def get_executor():
+    """Return this process's thread pool for background refreshes."""
+    global executor, executor_pid
+    with refresh_lock:
+        # Threads do not survive a fork, so each worker makes its own
+        if executor_pid != os.getpid():
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=REFRESH_THREADS, thread_name_prefix='refresh')
+            executor_pid = os.getpid()
+            refreshing.clear()
+        return executor
+
+
+def fetch_into(items, key, fetch):
+    """Call `fetch()` and cache what it found; return (status, body)."""
+    token = items.token()
+    missing_token = items.missing.token() if items.missing else None
+    response = fetch()
+    body = response.json()
+    if response.status_code == 200 and body.get('Count'):
+        items.put(key, body, token)
+    elif response.status_code == 200:
+        # Drop any stale copy of an item that has since been deleted
+        with items.lock:
+            items.entries.pop(key, None)
+        if items.missing is not None:
+            items.missing.put(key, body, missing_token)
+    return response.status_code, body
+
+
+def refresh(items, key, fetch):
+    try:
+        fetch_into(items, key, fetch)
+    except Exception as e:
+        logging.warning("refreshing {} {}: {}".format(items.name, key, e))
+    finally:
+        with refresh_lock:
+            refreshing.discard((items.name, key))
+
+
+def revalidate(items, key, fetch):
+    """Refresh `key` in the background, unless that is already underway."""
+    pool = get_executor()
+    with refresh_lock:
+        if (items.name, key) in refreshing:
+            return
+        refreshing.add((items.name, key))
+    pool.submit(refresh, items, key, fetch)
+
+
+def read(items, key, fetch):
+    """
+    Return the db read response body for `key`, from `items` if fresh.
+
+    On a miss `fetch()` makes the db call.  If it succeeded, its body is
+    cached in `items`, or in `items.missing` if the item was not found.
+    A stale entry is returned instead while it is refreshed, or if the
+    call fails, within the CACHE_STALE_TTL and CACHE_STALE_IF_ERROR
+    windows.
+    """
+    body = items.get(key)
+    if body is None and items.missing is not None:
+        body = items.missing.get(key)
+    if body is not None:
+        return body
+    stale, age = items.get_stale(key)
+    if stale is not None and age <= STALE_TTL:
+        revalidate(items, key, fetch)
+        STALE_SERVED.labels(items.name, 'revalidate').inc()
+        return stale
+    try:
+        status, body = fetch_into(items, key, fetch)
+    except Exception:
+        if stale is None or age > STALE_IF_ERROR:
+            raise
+        status = None
+    if status is None or status >= 500:
+        if stale is not None and age <= STALE_IF_ERROR:
+            STALE_SERVED.labels(items.name, 'error').inc()
+            return stale
+    return body
+
+
+def prime(items, key, item):
+    """Cache `item`, e.g. from a batched read, as if `key` had been read."""
+    items.put(key, {"Items": [item], "Count": 1, "ScannedCount": 1})
+
+
+def etag_of(body):
+    """Return the etag of the single item in a db read body, or None."""
+    found = body.get('Items') or []
+    return found[0].get('etag') if len(found) == 1 else None
+
+
+def respond(body):
+    """Return `body` with its ETag, or 304 if the client has it."""
+    etag = etag_of(body)
+    if etag is None:
+        return body
+    if request.if_none_match.contains_weak(etag):
+        CONDITIONAL.labels('not_modified').inc()
+        response = Response(status=304)
+    else:
+        CONDITIONAL.labels('sent').inc()
+        response = Response(json.dumps(body),
+                            status=200,
+                            mimetype='application/json')
+    response.set_etag(etag)
+    return response
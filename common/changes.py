@@ -0,0 +1,334 @@
+"""
+SFU CMPT 756
+Change feed for cache invalidation.
+
+The db service calls `publish` after every `/write`, `/load`, `/update`
+and `/delete`, with the item's type, key and new etag (None for a
+delete); `common/auth.py` publishes revoked tokens as objtype 'token'.
+Code that caches items subscribes to their type:
+
+    changes.subscribe('music',
+                      lambda change: songs.invalidate(change.objkey))
+
+and is called with each Change that reaches its process, so an entry
+is dropped as soon as the item changes instead of when its TTL runs
+out.
+
+Changes travel between processes by a transport (CHANGE_FEED):
+
+    local  (default) changes are delivered to subscribers in the
+           publishing process only.  This is the stand-in for the
+           development server and the benchmarks.
+    http   each batch of changes is POSTed to `/changes` at every
+           address of every CHANGE_FEED_PEERS host, in parallel.  Give
+           the peers as headless Services (cluster/change-feed.yaml),
+           whose DNS names resolve to all their pods; the addresses
+           are looked up again every RESOLVE_SECONDS.  A POST reaches
+           one gunicorn worker per pod, which relays the batch to the
+           pod's other workers through Unix datagram sockets in
+           CHANGE_FEED_DIR (set by `common/serve.py`).  A POST must
+           carry the shared CHANGE_FEED_SECRET, and is refused if the
+           receiving pod has none.
+    module:Class
+           any class with a `send(change)` method that must not block.
+           It is constructed once per process and should call
+           `deliver(change)` for the changes it receives, including
+           its own.
+
+The http transport is best effort: a batch that cannot be sent is
+dropped and counted, and the caches fall back on their TTLs.
+
+Environment variables:
+    CHANGE_FEED         local, http, or module:Class (default local)
+    CHANGE_FEED_PEERS   comma-separated host:port list, for http
+    CHANGE_FEED_SECRET  shared secret of the http transport
+    CHANGE_FEED_DIR     directory of this server's worker sockets
+"""
+
+# Standard library modules
+import collections
+import concurrent.futures
+import hmac
+import importlib
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+# Installed packages
+from flask import request
+from flask import Response
+
+from prometheus_client import Counter
+
+import simplejson as json
+
+Change = collections.namedtuple('Change', ['objtype', 'objkey', 'version'])
+
+# Changes per POST, and changes waiting to be sent before new ones are
+# dropped
+BATCH_SIZE = 100
+QUEUE_SIZE = 10000
+SEND_TIMEOUT = 0.5
+SEND_THREADS = 16
+RESOLVE_SECONDS = 5
+
+SECRET_HEADER = 'X-Change-Feed-Secret'
+
+PUBLISHED = Counter('changes_published_total',
+                    'Changes published, by object type',
+                    ['objtype'])
+RECEIVED = Counter('changes_received_total',
+                   'Changes delivered to this process, by object type',
+                   ['objtype'])
+DROPPED = Counter('changes_dropped_total',
+                  'Changes that could not be sent to a peer or worker')
+
+subscribers = collections.defaultdict(list)
+transport = None
+transport_pid = None
+transport_lock = threading.Lock()
+
+
+def subscribe(objtype, callback):
+    """Call `callback(change)` for changes to `objtype` (None: all)."""
+    subscribers[objtype].append(callback)
+
+
+def deliver(change):
+    """Pass a change that reached this process to its subscribers."""
+    RECEIVED.labels(change.objtype).inc()
+    for callback in subscribers[change.objtype] + subscribers[None]:
+        try:
+            callback(change)
+        except Exception:
+            logging.exception("change subscriber failed")
+
+
+class LocalTransport:
+    """Deliver changes within the publishing process."""
+
+    def send(self, change):
+        deliver(change)
+
+
+def deliver_batch(body):
+    """Deliver a JSON list of changes, as POSTed to `/changes`, and
+    return how many there were."""
+    changes = [Change(change['objtype'], change['objkey'],
+                      change.get('version'))
+               for change in json.loads(body)]
+    for change in changes:
+        deliver(change)
+    return len(changes)
+
+
+class Siblings:
+    """Relay batches to the other worker processes of this server.
+
+    Each process binds a datagram socket named after its pid in
+    `directory`, and a thread delivers the batches sent to it.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, str(os.getpid()))
+        # Left by an earlier process with the same pid
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.inbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.inbox.bind(self.path)
+        self.outbox = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.outbox.setblocking(False)
+        threading.Thread(target=self.run, name='change-feed-siblings',
+                         daemon=True).start()
+
+    def run(self):
+        while True:
+            body = self.inbox.recv(65536)
+            try:
+                deliver_batch(body)
+            except (ValueError, TypeError, KeyError):
+                logging.exception("bad change batch from a sibling")
+
+    def relay(self, body, count):
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            logging.warning("change feed siblings: {}".format(e))
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if path == self.path:
+                continue
+            try:
+                self.outbox.sendto(body, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # A worker that has exited
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            except OSError as e:
+                logging.warning("change feed to worker {}: {}".format(
+                    name, e))
+                DROPPED.inc(count)
+
+
+class HttpTransport:
+    """POST changes, in batches, to every address of every peer."""
+
+    def __init__(self, peers, secret, directory=None):
+        # Imported here, as only this transport needs it and the db
+        # service does not otherwise load it at startup
+        import requests
+        self.peers = peers
+        self.secret = secret
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=SEND_THREADS,
+                                                pool_maxsize=SEND_THREADS)
+        self.session.mount('http://', adapter)
+        self.senders = concurrent.futures.ThreadPoolExecutor(
+            max_workers=SEND_THREADS, thread_name_prefix='change-feed')
+        self.resolved = []
+        self.resolved_at = None
+        self.siblings = Siblings(directory) if directory else None
+        threading.Thread(target=self.run, name='change-feed',
+                         daemon=True).start()
+
+    def send(self, change):
+        # Deliver here at once; the peers may include this pod anyway
+        deliver(change)
+        try:
+            self.queue.put_nowait(change)
+        except queue.Full:
+            DROPPED.inc()
+
+    def addresses(self):
+        """Return the peers' addresses, looked up at most every
+        RESOLVE_SECONDS."""
+        now = time.monotonic()
+        if self.resolved_at is None or \
+                now - self.resolved_at >= RESOLVE_SECONDS:
+            self.resolved = sorted(set(self.resolve()))
+            self.resolved_at = now
+        return self.resolved
+
+    def resolve(self):
+        for peer in self.peers:
+            host, _, port = peer.rpartition(':')
+            try:
+                infos = socket.getaddrinfo(host, int(port),
+                                           proto=socket.IPPROTO_TCP)
+            except (OSError, ValueError) as e:
+                logging.warning("change feed peer {}: {}".format(peer, e))
+                continue
+            for family, _, _, _, sockaddr in infos:
+                ip = sockaddr[0]
+                if family == socket.AF_INET6:
+                    ip = '[' + ip + ']'
+                yield '{}:{}'.format(ip, port)
+
+    def post(self, address, body, count):
+        import requests
+        try:
+            response = self.session.post(
+                'http://' + address + '/changes',
+                data=body,
+                headers={'Content-Type': 'application/json',
+                         SECRET_HEADER: self.secret},
+                timeout=SEND_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logging.warning("change feed to {}: {}".format(address, e))
+            DROPPED.inc(count)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            body = json.dumps([c._asdict() for c in batch])
+            sends = [self.senders.submit(self.post, address, body,
+                                         len(batch))
+                     for address in self.addresses()]
+            concurrent.futures.wait(sends)
+
+    def relay(self, body, count):
+        """Pass a batch received from a peer to this pod's other
+        workers."""
+        if self.siblings is not None:
+            self.siblings.relay(body, count)
+
+
+def make_transport():
+    name = os.getenv('CHANGE_FEED', 'local')
+    if name == 'local':
+        return LocalTransport()
+    if name == 'http':
+        peers = [p.strip() for p in os.getenv('CHANGE_FEED_PEERS',
+                                              '').split(',') if p.strip()]
+        return HttpTransport(peers, os.getenv('CHANGE_FEED_SECRET', ''),
+                             os.getenv('CHANGE_FEED_DIR'))
+    module, _, cls = name.partition(':')
+    return getattr(importlib.import_module(module), cls)()
+
+
+def get_transport():
+    """Return this process's transport, making it on first use."""
+    global transport, transport_pid
+    with transport_lock:
+        # Threads do not survive a fork, so each worker makes its own
+        if transport_pid != os.getpid():
+            transport = make_transport()
+            transport_pid = os.getpid()
+        return transport
+
+
+def publish(objtype, objkey, version=None):
+    """Announce that an item was written (or deleted, if no version)."""
+    PUBLISHED.labels(objtype).inc()
+    get_transport().send(Change(objtype, objkey, version))
+
+
+def authorized(secret):
+    expected = os.getenv('CHANGE_FEED_SECRET', '')
+    return expected != '' and hmac.compare_digest(secret.encode(),
+                                                  expected.encode())
+
+
+def init_app(app):
+    """Accept changes POSTed to `app` by the http transport."""
+    def receive():
+        if not authorized(request.headers.get(SECRET_HEADER, '')):
+            return Response(json.dumps({"error": "forbidden"}),
+                            status=403,
+                            mimetype='application/json')
+        body = request.get_data()
+        try:
+            count = deliver_batch(body)
+        except (ValueError, TypeError, KeyError):
+            return Response(json.dumps({"error": "bad change batch"}),
+                            status=400,
+                            mimetype='application/json')
+        transport = get_transport()
+        if isinstance(transport, HttpTransport):
+            transport.relay(body, count)
+        return Response("", status=204)
+
+    def start_transport():
+        if transport_pid != os.getpid():
+            get_transport()
+
+    app.add_url_rule('/changes', 'changes', receive, methods=['POST'])
+    # Other transports may receive changes, and the http transport
+    # relays them between workers, so start it without waiting for
+    # this process to publish one (see also common/serve.py)
+    if os.getenv('CHANGE_FEED', 'local') != 'local':
+        app.before_request(start_transport)
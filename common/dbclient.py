@@ -0,0 +1,469 @@
+"""
+SFU CMPT 756
+Client for the services' calls to the db service.
+
+`get`, `post`, `put` and `delete` take the same arguments as the
+functions of the same names in `requests` and return a
+`requests.Response`.  All calls share one keep-alive session per
+process, so a request does not pay for a new TCP connection to the
+db service, and the time of every call is charged to the `db` phase
+of the current request (see `common/timing.py`).  Every call carries
+the trace headers of the current request and is recorded as a client
+span (see `common/tracing.py`).  If the request has a deadline (see
+`common/deadline.py`), every call carries the time remaining, its
+timeouts are cut to fit, and no call or retry starts after it.
+
+A slow or failing db service must not tie up the service's worker
+threads, so every call
+
+* has a timeout, set per db endpoint (`read`, `write`, ...);
+* is retried, if it is idempotent and failed with a connection error,
+  a timeout or a 502/503/504, after a jittered exponential backoff.
+  Retries are limited by a budget: each call earns DB_RETRY_RATIO of a
+  retry, so retries cannot multiply the load on a struggling db;
+* passes through a circuit breaker.  When the share of failed calls in
+  the last DB_BREAKER_WINDOW seconds reaches DB_BREAKER_THRESHOLD, the
+  breaker opens and calls fail at once for DB_BREAKER_COOLDOWN seconds.
+  A single trial call then decides whether it closes again.
+
+Reads (GETs) can also be hedged (DB_HEDGE=1): if a read has not
+returned after the DB_HEDGE_PERCENTILE latency of recent reads from
+the same endpoint, a second copy is sent and whichever answers first
+is used.  Hedges are budgeted like retries, at DB_HEDGE_RATIO of
+reads, so they trim the tail without doubling the load.
+
+A call that cannot be made raises DbUnavailable, which `init_app`
+turns into a 503 response.  A call that got a response returns it,
+even if it is a 5xx after the last retry.
+
+Environment variables:
+    DB_POOL_SIZE           connections kept open to the db service
+                           (default 32)
+    DB_CONNECT_TIMEOUT     seconds to connect (default 0.5)
+    DB_TIMEOUT             seconds to wait for a response (default 2.0)
+    DB_TIMEOUT_<ENDPOINT>  override for one endpoint, e.g. DB_TIMEOUT_READ
+    DB_RETRIES             most retries of one call (default 2)
+    DB_RETRY_BACKOFF       base backoff in seconds (default 0.025)
+    DB_RETRY_RATIO         retries earned per call (default 0.2)
+    DB_BREAKER_THRESHOLD   failure share that opens the breaker
+                           (default 0.5)
+    DB_BREAKER_MIN_CALLS   calls in the window before it can open
+                           (default 20)
+    DB_BREAKER_WINDOW      seconds of history considered (default 10)
+    DB_BREAKER_COOLDOWN    seconds the breaker stays open (default 5)
+    DB_HEDGE               1 to hedge reads (default 0)
+    DB_HEDGE_PERCENTILE    latency percentile to wait before hedging
+                           (default 95)
+    DB_HEDGE_RATIO         hedges earned per read (default 0.05)
+    DB_HEDGE_MIN_DELAY     shortest wait before hedging, in seconds
+                           (default 0.002)
+"""
+
+# Standard library modules
+import collections
+import concurrent.futures
+import logging
+import os
+import random
+import threading
+import time
+
+# Installed packages
+from flask import Response
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+
+import requests
+
+import simplejson as json
+
+# Local modules
+from common import deadline
+from common import timing
+from common import tracing
+
+
+def env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        logging.error("invalid {}, using {}".format(name, default))
+        return default
+
+
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '32'))
+
+CONNECT_TIMEOUT = env_float('DB_CONNECT_TIMEOUT', 0.5)
+TIMEOUT = env_float('DB_TIMEOUT', 2.0)
+
+RETRIES = int(env_float('DB_RETRIES', 2))
+RETRY_BACKOFF = env_float('DB_RETRY_BACKOFF', 0.025)
+RETRY_RATIO = env_float('DB_RETRY_RATIO', 0.2)
+
+HEDGE = os.getenv('DB_HEDGE', '0') == '1'
+HEDGE_PERCENTILE = env_float('DB_HEDGE_PERCENTILE', 95.0)
+HEDGE_RATIO = env_float('DB_HEDGE_RATIO', 0.05)
+HEDGE_MIN_DELAY = env_float('DB_HEDGE_MIN_DELAY', 0.002)
+
+# Latencies kept per endpoint, and reads seen before hedging starts
+HEDGE_SAMPLES = 1000
+HEDGE_MIN_SAMPLES = 50
+
+# Methods the db service implements idempotently; POST /write creates
+# a new item on every call
+IDEMPOTENT = ('GET', 'PUT', 'DELETE')
+RETRY_STATUSES = (502, 503, 504)
+
+# Values of the breaker state gauge
+CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+CALLS = Counter('db_client_calls_total',
+                'Calls to the db service, by endpoint and outcome',
+                ['endpoint', 'outcome'])
+RETRIES_TOTAL = Counter('db_client_retries_total',
+                        'Retried calls to the db service',
+                        ['endpoint'])
+BUDGET_EXHAUSTED = Counter('db_client_retry_budget_exhausted_total',
+                           'Retries refused by the retry budget')
+BREAKER_STATE = Gauge('db_client_breaker_state',
+                      'Circuit breaker state: 0 closed, 1 half-open, 2 open',
+                      multiprocess_mode='max')
+BREAKER_TRIPS = Counter('db_client_breaker_trips_total',
+                        'Times the circuit breaker opened')
+BREAKER_REJECTED = Counter('db_client_breaker_rejected_total',
+                           'Calls failed fast by the open circuit breaker')
+HEDGES = Counter('db_client_hedges_total',
+                 'Hedged copies of reads sent to the db service',
+                 ['endpoint'])
+HEDGE_WINS = Counter('db_client_hedge_wins_total',
+                     'Hedged reads answered first by the hedge',
+                     ['endpoint'])
+HEDGE_BUDGET_EXHAUSTED = Counter('db_client_hedge_budget_exhausted_total',
+                                 'Hedges refused by the hedge budget')
+HEDGE_DELAY = Gauge('db_client_hedge_delay_seconds',
+                    'Current wait before a read is hedged',
+                    ['endpoint'],
+                    multiprocess_mode='max')
+
+session = requests.Session()
+session.mount('http://', requests.adapters.HTTPAdapter(
+    pool_connections=1, pool_maxsize=POOL_SIZE))
+
+
+class DbUnavailable(Exception):
+    """The db service could not be reached or the breaker is open."""
+
+
+class RetryBudget:
+    """Allow extra calls (retries, hedges) up to a fixed ratio of calls."""
+
+    def __init__(self, ratio, cap=10.0):
+        self.ratio = ratio
+        self.cap = cap
+        self.tokens = cap
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+
+class CircuitBreaker:
+    """
+    Open when too many recent calls failed.
+
+    Outcomes are counted in one-second buckets over the last `window`
+    seconds.  While open, `allow` refuses calls; after `cooldown`
+    seconds it lets one trial call through (half-open), whose outcome
+    closes or reopens the breaker.
+    """
+
+    def __init__(self, threshold, min_calls, window, cooldown):
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self.buckets = collections.deque()
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if (self.state == OPEN and
+                    time.monotonic() - self.opened_at >= self.cooldown):
+                self.set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self.trial:
+                self.trial = True
+                return True
+            return False
+
+    def record(self, ok):
+        with self.lock:
+            now = time.monotonic()
+            if self.state != CLOSED:
+                if self.trial:
+                    self.trial = False
+                    if ok:
+                        self.buckets.clear()
+                        self.set_state(CLOSED)
+                    else:
+                        self.trip(now)
+                return
+            second = int(now)
+            if not self.buckets or self.buckets[-1][0] != second:
+                self.buckets.append([second, 0, 0])
+            while self.buckets[0][0] <= second - self.window:
+                self.buckets.popleft()
+            self.buckets[-1][1] += 1
+            if not ok:
+                self.buckets[-1][2] += 1
+                calls = sum(b[1] for b in self.buckets)
+                failures = sum(b[2] for b in self.buckets)
+                if (calls >= self.min_calls and
+                        failures >= self.threshold * calls):
+                    self.trip(now)
+
+    def release(self):
+        """End a trial call whose outcome says nothing about the db, so
+        that the next call is tried instead."""
+        with self.lock:
+            self.trial = False
+
+    def trip(self, now):
+        self.opened_at = now
+        self.set_state(OPEN)
+        BREAKER_TRIPS.inc()
+        logging.warning("db circuit breaker open")
+
+    def set_state(self, state):
+        self.state = state
+        BREAKER_STATE.set(state)
+
+
+class LatencyTracker:
+    """Recent latencies of one endpoint and the hedging delay they give."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.samples = collections.deque(maxlen=HEDGE_SAMPLES)
+        self.count = 0
+        self.current = None
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+            # Sorting 1000 samples on every read would cost more than
+            # it saves, so the delay is refreshed every 50 reads
+            if (len(self.samples) >= HEDGE_MIN_SAMPLES and
+                    self.count % 50 == 0):
+                ordered = sorted(self.samples)
+                index = int(len(ordered) * HEDGE_PERCENTILE / 100.0)
+                self.current = max(HEDGE_MIN_DELAY,
+                                   ordered[min(index, len(ordered) - 1)])
+                HEDGE_DELAY.labels(self.endpoint).set(self.current)
+
+    def delay(self):
+        """Seconds to wait before hedging, or None to not hedge yet."""
+        return self.current
+
+
+budget = RetryBudget(RETRY_RATIO)
+hedge_budget = RetryBudget(HEDGE_RATIO)
+trackers = {}
+executor = None
+executor_pid = None
+executor_lock = threading.Lock()
+breaker = CircuitBreaker(env_float('DB_BREAKER_THRESHOLD', 0.5),
+                         int(env_float('DB_BREAKER_MIN_CALLS', 20)),
+                         int(env_float('DB_BREAKER_WINDOW', 10)),
+                         env_float('DB_BREAKER_COOLDOWN', 5.0))
+
+
+def endpoint_of(url):
+    """Return the db endpoint of a URL, e.g. 'read'."""
+    return url.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+
+
+def timeout_for(endpoint):
+    """Return the (connect, read) timeout for calls to `endpoint`."""
+    name = 'DB_TIMEOUT_' + endpoint.upper()
+    return (CONNECT_TIMEOUT, env_float(name, TIMEOUT))
+
+
+def get_executor():
+    """Return this process's thread pool for hedged reads."""
+    global executor, executor_pid
+    with executor_lock:
+        # Threads do not survive a fork, so each worker makes its own
+        if executor_pid != os.getpid():
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=2 * POOL_SIZE, thread_name_prefix='hedge')
+            executor_pid = os.getpid()
+        return executor
+
+
+def timed_request(tracker, method, url, kwargs):
+    start = time.perf_counter()
+    response = session.request(method, url, **kwargs)
+    tracker.observe(time.perf_counter() - start)
+    return response
+
+
+def hedged_request(endpoint, method, url, **kwargs):
+    """Send a read, and a second copy if the first is slow."""
+    tracker = trackers.get(endpoint)
+    if tracker is None:
+        tracker = trackers.setdefault(endpoint, LatencyTracker(endpoint))
+    hedge_budget.deposit()
+    pool = get_executor()
+    first = pool.submit(timed_request, tracker, method, url, kwargs)
+    try:
+        return first.result(timeout=tracker.delay())
+    except concurrent.futures.TimeoutError:
+        pass
+    if not hedge_budget.withdraw():
+        HEDGE_BUDGET_EXHAUSTED.inc()
+        return first.result()
+    HEDGES.labels(endpoint).inc()
+    second = pool.submit(timed_request, tracker, method, url, kwargs)
+    # The loser runs to completion in the pool and is discarded
+    for future in concurrent.futures.as_completed([first, second]):
+        if future.exception() is None:
+            if future is second:
+                HEDGE_WINS.labels(endpoint).inc()
+            return future.result()
+    return first.result()
+
+
+def cap_timeout(timeout, left):
+    """Cut a requests timeout down to the `left` seconds remaining."""
+    if left is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(min(t, left) for t in timeout)
+    return min(timeout, left)
+
+
+def send(method, url, endpoint, attempt, **kwargs):
+    with tracing.span('db ' + method, kind='client', url=url,
+                      attempt=attempt) as span_id:
+        headers = tracing.outbound_headers(span_id)
+        headers.update(deadline.outbound_headers())
+        headers.update(kwargs.pop('headers', None) or {})
+        with timing.phase('db'):
+            if HEDGE and method == 'GET':
+                response = hedged_request(endpoint, method, url,
+                                          headers=headers, **kwargs)
+            else:
+                response = session.request(method, url, headers=headers,
+                                           **kwargs)
+    timing.add_downstream('db', response.headers.get('Server-Timing'))
+    return response
+
+
+def request(method, url, **kwargs):
+    endpoint = endpoint_of(url)
+    timeout = kwargs.pop('timeout', None) or timeout_for(endpoint)
+    budget.deposit()
+    attempt = 0
+    while True:
+        deadline.check('db')
+        kwargs['timeout'] = cap_timeout(timeout, deadline.remaining())
+        if not breaker.allow():
+            BREAKER_REJECTED.inc()
+            CALLS.labels(endpoint, 'rejected').inc()
+            raise DbUnavailable("circuit breaker open")
+        response = None
+        outcome = None
+        try:
+            response = send(method, url, endpoint, attempt, **kwargs)
+            outcome = 'error' if response.status_code >= 500 else 'ok'
+        except requests.Timeout:
+            outcome = 'timeout'
+        except requests.ConnectionError:
+            outcome = 'connection_error'
+        finally:
+            # Any other exception says nothing about the db, but must
+            # not leave a half-open breaker waiting for its trial
+            if outcome is None:
+                breaker.release()
+        left = deadline.remaining()
+        if outcome == 'timeout' and left is not None and left <= 0:
+            # Not the db's fault if it was our deadline that ran out
+            breaker.release()
+            deadline.check('db')
+        breaker.record(outcome == 'ok')
+        CALLS.labels(endpoint, outcome).inc()
+        if response is not None and \
+                response.status_code not in RETRY_STATUSES:
+            return response
+
+        attempt += 1
+        if method not in IDEMPOTENT or attempt > RETRIES:
+            break
+        if not budget.withdraw():
+            BUDGET_EXHAUSTED.inc()
+            break
+        # Full jitter, so that retries from many threads spread out
+        pause = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+        left = deadline.remaining()
+        if left is not None and pause >= left:
+            break
+        RETRIES_TOTAL.labels(endpoint).inc()
+        time.sleep(pause)
+
+    if response is not None:
+        return response
+    raise DbUnavailable("{} {}: {}".format(method, endpoint, outcome))
+
+
+def ping(url, timeout=1.0):
+    """
+    Return True if `url` answers 200.  For readiness probes: the call
+    skips retries, hedging and the circuit breaker, but opens a pooled
+    connection for the requests that follow.
+    """
+    response = session.get(url, timeout=(CONNECT_TIMEOUT, timeout))
+    return response.status_code == 200
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request('PUT', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+def init_app(app):
+    """Answer 503 when a request's call to the db service fails."""
+    @app.errorhandler(DbUnavailable)
+    def db_unavailable(e):
+        logging.warning("db unavailable: {}".format(e))
+        response = Response(json.dumps({"error": "database unavailable"}),
+                            status=503,
+                            mimetype='application/json')
+        response.headers['Retry-After'] = str(int(breaker.cooldown))
+        return response
@@ -0,0 +1,121 @@
+"""
+SFU CMPT 756
+Request deadlines.
+
+A caller that will stop waiting after some time says so in the
+`x-request-timeout-ms` header (or Envoy does, in
+`x-envoy-expected-rq-timeout-ms`, when an Istio route has a timeout).
+`init_app` turns the header into a deadline for the request, and
+
+* answers 504 at once if the request arrived with no time left;
+* `common/dbclient.py` sends the remaining time on every call to the
+  db service, caps its timeouts by it, and raises DeadlineExceeded
+  instead of starting a call or retry after the deadline;
+* in the db service, `instrument_boto3` raises DeadlineExceeded
+  instead of starting a DynamoDB call after the deadline.
+
+so no service keeps working on a request its caller has given up on.
+The budget is relative, so the hosts' clocks need not agree.
+
+Environment variables:
+    DEADLINE_DEFAULT_MS  deadline for requests that arrive without one
+                         (default 0, none)
+"""
+
+# Standard library modules
+import logging
+import os
+import time
+
+# Installed packages
+from flask import g
+from flask import has_request_context
+from flask import request
+from flask import Response
+
+from prometheus_client import Counter
+
+import simplejson as json
+
+HEADER = 'x-request-timeout-ms'
+ENVOY_HEADER = 'x-envoy-expected-rq-timeout-ms'
+
+# Paths ending in these are probes or scrapes and have no deadline
+SKIP_SUFFIXES = ('/health', '/readiness', '/metrics')
+
+EXCEEDED = Counter('deadline_exceeded_total',
+                   'Work skipped because the request deadline had passed',
+                   ['stage'])
+
+
+class DeadlineExceeded(Exception):
+    """The current request's deadline has passed."""
+
+
+def remaining():
+    """Return the seconds left for the current request, or None."""
+    if not has_request_context():
+        return None
+    deadline = g.get('deadline')
+    if deadline is None:
+        return None
+    return deadline - time.perf_counter()
+
+
+def check(stage):
+    """Raise DeadlineExceeded if the current request's deadline has passed."""
+    left = remaining()
+    if left is not None and left <= 0:
+        EXCEEDED.labels(stage).inc()
+        raise DeadlineExceeded(stage)
+
+
+def outbound_headers():
+    """Return the deadline header to send on a call for this request."""
+    left = remaining()
+    if left is None:
+        return {}
+    return {HEADER: str(max(int(left * 1000), 0))}
+
+
+def parse_ms(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def init_app(app):
+    """Give each request of `app` the deadline its caller sent."""
+    default_ms = parse_ms(os.getenv('DEADLINE_DEFAULT_MS', '0')) or 0
+
+    @app.before_request
+    def deadline_start():
+        if request.path.endswith(SKIP_SUFFIXES):
+            return None
+        budgets = [ms for ms in (parse_ms(request.headers.get(HEADER)),
+                                 parse_ms(request.headers.get(ENVOY_HEADER)))
+                   if ms is not None]
+        if not budgets and default_ms > 0:
+            budgets = [default_ms]
+        if not budgets:
+            return None
+        g.deadline = time.perf_counter() + min(budgets) / 1000.0
+        check('arrival')
+        return None
+
+    @app.errorhandler(DeadlineExceeded)
+    def deadline_exceeded(e):
+        logging.info("deadline exceeded before {}".format(e))
+        return Response(json.dumps({"error": "deadline exceeded"}),
+                        status=504,
+                        mimetype='application/json')
+
+
+def instrument_boto3(resource):
+    """Refuse to start calls through a boto3 resource after the deadline."""
+    def before_call(**kwargs):
+        check('dynamodb')
+
+    resource.meta.client.meta.events.register(
+        'before-parameter-build.dynamodb', before_call)
@@ -0,0 +1,205 @@
+"""
+SFU CMPT 756
+Hot-key detection for the db service.
+
+Every key the db service reads or writes is offered to a Space-Saving
+sketch for its (objtype, op), op being 'read' or 'write'.  A sketch of
+k counters finds, in a stream of any length, every key whose share of
+the stream exceeds 1/k, and overestimates a key's count by at most the
+`error` it reports.  It runs in O(k) memory whatever the number of
+distinct keys, so a client scanning random ids cannot grow it.
+
+To forget old traffic, each (objtype, op) has a ring of BUCKETS
+sketches, each covering HOTKEYS_WINDOW / BUCKETS seconds; `top` merges
+the ring, so it reports roughly the last HOTKEYS_WINDOW seconds.
+
+The top keys of this process are served by the db service at
+`/api/v1/datastore/debug/hotkeys` (see `report`), and exported as
+
+    db_hotkey_requests{objtype,op,rank}  window count of the key at rank
+    db_hotkey_share{objtype,op}          top key's share of the window
+
+refreshed whenever a bucket rolls over, by a thread in each process so
+that they also fall back to zero once traffic stops.  Key ids are not
+metric labels, to keep the number of series fixed; look them up in the
+endpoint.  Only the known object types are tracked, so a client sending
+made-up types cannot add trackers or series.
+
+Environment variables:
+    HOTKEYS           0 to disable (default 1)
+    HOTKEYS_K         counters per sketch (default 64)
+    HOTKEYS_WINDOW    seconds of traffic reported (default 60)
+    HOTKEYS_OBJTYPES  comma-separated object types tracked
+                      (default user,music,playlist)
+"""
+
+# Standard library modules
+import logging
+import os
+import threading
+import time
+
+# Installed packages
+from prometheus_client import Gauge
+
+ENABLED = os.getenv('HOTKEYS', '1') != '0'
+K = int(os.getenv('HOTKEYS_K', '64'))
+WINDOW = float(os.getenv('HOTKEYS_WINDOW', '60'))
+BUCKETS = 6
+OBJTYPES = frozenset(t.strip() for t in os.getenv(
+    'HOTKEYS_OBJTYPES', 'user,music,playlist').split(',') if t.strip())
+
+# Ranks exported to Prometheus
+EXPORTED = 5
+
+REQUESTS = Gauge('db_hotkey_requests',
+                 'Requests in the window for the key at each rank',
+                 ['objtype', 'op', 'rank'],
+                 multiprocess_mode='max')
+SHARE = Gauge('db_hotkey_share',
+              "Top key's share of the requests in the window",
+              ['objtype', 'op'],
+              multiprocess_mode='max')
+
+
+class SpaceSaving:
+    """Approximate counts of the most frequent keys, in `k` counters."""
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        self.total = 0
+
+    def offer(self, key):
+        self.total += 1
+        if key in self.counts:
+            self.counts[key] += 1
+        elif len(self.counts) < self.k:
+            self.counts[key] = 1
+            self.errors[key] = 0
+        else:
+            # The new key takes over the smallest counter, and may have
+            # occurred up to that many times already
+            victim = min(self.counts, key=self.counts.get)
+            floor = self.counts.pop(victim)
+            del self.errors[victim]
+            self.counts[key] = floor + 1
+            self.errors[key] = floor
+
+
+class Tracker:
+    """A sliding window of SpaceSaving sketches for one (objtype, op)."""
+
+    def __init__(self, objtype, op, k=K, window=WINDOW):
+        self.objtype = objtype
+        self.op = op
+        self.k = k
+        self.span = window / BUCKETS
+        self.ring = [SpaceSaving(k)]
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def rotate(self, now):
+        """Start a new bucket for each span that has ended, so that
+        spans without traffic are empty buckets."""
+        elapsed = int((now - self.started) // self.span)
+        if elapsed <= 0:
+            return False
+        for _ in range(min(elapsed, BUCKETS)):
+            self.ring.append(SpaceSaving(self.k))
+        del self.ring[:-BUCKETS]
+        self.started += elapsed * self.span
+        return True
+
+    def offer(self, key):
+        with self.lock:
+            rotated = self.rotate(time.monotonic())
+            self.ring[-1].offer(key)
+        if rotated:
+            self.export()
+
+    def refresh(self):
+        """Rotate out traffic that has left the window, and export."""
+        with self.lock:
+            rotated = self.rotate(time.monotonic())
+        if rotated:
+            self.export()
+
+    def top(self, n):
+        """Return [(key, count, error)] for the `n` hottest keys, and the
+        number of requests in the window."""
+        counts = {}
+        errors = {}
+        with self.lock:
+            self.rotate(time.monotonic())
+            total = sum(sketch.total for sketch in self.ring)
+            for sketch in self.ring:
+                for key, count in sketch.counts.items():
+                    counts[key] = counts.get(key, 0) + count
+                    errors[key] = errors.get(key, 0) + sketch.errors[key]
+        hottest = sorted(counts, key=counts.get, reverse=True)[:n]
+        return [(key, counts[key], errors[key]) for key in hottest], total
+
+    def export(self):
+        hottest, total = self.top(EXPORTED)
+        for rank in range(EXPORTED):
+            count = hottest[rank][1] if rank < len(hottest) else 0
+            REQUESTS.labels(self.objtype, self.op, str(rank + 1)).set(count)
+        share = hottest[0][1] / total if hottest and total else 0
+        SHARE.labels(self.objtype, self.op).set(share)
+
+
+trackers = {}
+trackers_lock = threading.Lock()
+refresher_pid = None
+
+
+def refresh_all():
+    while True:
+        time.sleep(WINDOW / BUCKETS)
+        for tracker in list(trackers.values()):
+            try:
+                tracker.refresh()
+            except Exception:
+                logging.exception("hot-key refresh failed")
+
+
+def start_refresher():
+    global refresher_pid
+    with trackers_lock:
+        # Threads do not survive a fork, so each worker makes its own
+        if refresher_pid == os.getpid():
+            return
+        refresher_pid = os.getpid()
+    threading.Thread(target=refresh_all, name='hotkeys',
+                     daemon=True).start()
+
+
+def record(objtype, op, key):
+    """Count one `op` ('read' or 'write') of `key` of type `objtype`."""
+    if not ENABLED or objtype not in OBJTYPES:
+        return
+    if refresher_pid != os.getpid():
+        start_refresher()
+    tracker = trackers.get((objtype, op))
+    if tracker is None:
+        with trackers_lock:
+            tracker = trackers.setdefault((objtype, op),
+                                          Tracker(objtype, op))
+    tracker.offer(key)
+
+
+def report(n=10, objtype=None):
+    """Return the `n` hottest keys of each (objtype, op) as a dict."""
+    result = {}
+    for (otype, op), tracker in sorted(trackers.items()):
+        if objtype is not None and otype != objtype:
+            continue
+        hottest, total = tracker.top(n)
+        result.setdefault(otype, {})[op] = {
+            "requests": total,
+            "keys": [{"key": key, "count": count, "error": error}
+                     for key, count, error in hottest]}
+    return {"window_seconds": WINDOW, "pid": os.getpid(),
+            "objtypes": result}
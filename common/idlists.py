@@ -0,0 +1,129 @@
+"""
+SFU CMPT 756
+Compact storage of id lists for the db service.
+
+A playlist's `music_list` is a list of UUID strings, which DynamoDB
+stores at 37 bytes per id (the string and a byte of list overhead).
+With ID_LIST_ENCODING=packed the db service instead stores each such
+list as one Binary attribute of 16 bytes per id, in order, so items are
+less than half the size and need proportionally fewer read and write
+capacity units.
+
+The translation is done entirely in the db service: `encode_item` just
+before an item is written, `decode_item` on every item read.  Its API
+still takes and returns lists of strings, and reads accept both forms,
+so a table may hold a mix of packed and list items.  A list holding
+anything other than lower-case canonical UUIDs is stored as a list.
+Existing items are converted by the db service's `/migrate` endpoint
+(see `tools/migrate-id-lists.py`), which also converts them back.
+
+Environment variables:
+    ID_LIST_ENCODING  list or packed, the form written (default list)
+    ID_LIST_ATTRS     comma-separated attributes holding id lists
+                      (default music_list)
+"""
+
+# Standard library modules
+import numbers
+import os
+import re
+
+LIST = 'list'
+PACKED = 'packed'
+
+ENCODING = os.getenv('ID_LIST_ENCODING', LIST)
+ATTRS = [a.strip() for a in os.getenv('ID_LIST_ATTRS',
+                                      'music_list').split(',') if a.strip()]
+
+UUID = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+                  r'[0-9a-f]{12}')
+UUID_BYTES = 16
+
+
+def pack(ids):
+    """Return the ids as 16 bytes each, or None if they cannot be."""
+    if not ids or not all(isinstance(i, str) and UUID.fullmatch(i)
+                          for i in ids):
+        return None
+    return bytes.fromhex(''.join(ids).replace('-', ''))
+
+
+def unpack(data):
+    """Inverse of `pack`."""
+    h = bytes(data).hex()
+    form = '{}-{}-{}-{}-{}'.format
+    return [form(h[i:i + 8], h[i + 8:i + 12], h[i + 12:i + 16],
+                 h[i + 16:i + 20], h[i + 20:i + 32])
+            for i in range(0, len(h), 2 * UUID_BYTES)]
+
+
+def packed_value(value):
+    """Return the bytes of a stored Binary attribute, or None."""
+    # boto3 returns Binary attributes wrapped in a Binary object
+    value = getattr(value, 'value', value)
+    if isinstance(value, (bytes, bytearray)):
+        return value
+    return None
+
+
+def encode_item(item, encoding=None):
+    """Convert the id lists of `item`, in place, to the form written."""
+    encoding = encoding or ENCODING
+    for attr in ATTRS:
+        value = item.get(attr)
+        if encoding == PACKED and isinstance(value, list):
+            packed = pack(value)
+            if packed is not None:
+                item[attr] = packed
+        elif encoding == LIST and packed_value(value) is not None:
+            item[attr] = unpack(packed_value(value))
+    return item
+
+
+def decode_item(item):
+    """Convert the id lists of a stored `item`, in place, to lists."""
+    if item is None:
+        return None
+    for attr in ATTRS:
+        data = packed_value(item.get(attr))
+        if data is not None:
+            item[attr] = unpack(data)
+    return item
+
+
+def decode_items(items):
+    for item in items:
+        decode_item(item)
+    return items
+
+
+def needs_migration(item, encoding=None):
+    """Return True if `encode_item` would change a stored `item`."""
+    return encode_item(dict(item), encoding) != item
+
+
+def item_size(item):
+    """
+    Return the size DynamoDB charges for `item`, in bytes: each
+    attribute's name plus its value, where a string or binary value
+    counts its length, a number about one byte per two digits, and a
+    list or map 3 bytes plus 1 per element beyond its elements.
+    """
+    return sum(len(name.encode()) + value_size(value)
+               for name, value in item.items())
+
+
+def value_size(value):
+    data = packed_value(value)
+    if data is not None:
+        return len(data)
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, numbers.Number):
+        return len(str(value).lstrip('-').replace('.', '')) // 2 + 1
+    if isinstance(value, dict):
+        return 3 + sum(len(k.encode()) + value_size(v) + 1
+                       for k, v in value.items())
+    return 3 + sum(value_size(v) + 1 for v in value)
@@ -0,0 +1,278 @@
+"""
+SFU CMPT 756
+Adaptive concurrency limiting.
+
+`init_app` caps the number of requests a service process works on at
+once.  A request that arrives when the cap is reached is answered at
+once with 503 and `Retry-After`, instead of queueing behind the others
+until everyone's latency grows.  Probes and scrapes (`/health`,
+`/readiness`, `/metrics`) and change-feed batches (`/changes`) are
+never rejected.
+
+Under Gunicorn (see `common/serve.py`) a process runs at most
+WEB_THREADS requests at once, and the rest wait in the worker's queue
+for a free thread, out of the app's sight.  The worker therefore
+reports each queued connection (`enqueued` and `dequeued`), and the
+limit counts queued requests as well as running ones: once it is
+reached, each request taken off the queue is answered with 503 at
+once, which drains the queue at the speed of the rejection rather than
+of the requests.  A request's latency includes its wait in the queue.
+
+The cap adapts to observed latency, by one of two algorithms:
+
+gradient (default)
+    Compares the recent average latency with a long-term average.
+    While they agree the limit grows by about its square root per
+    window; as recent latency rises above LIMIT_TOLERANCE times the
+    long-term average, the limit shrinks in proportion, down to half
+    per window.  Windows in which fewer than half of the allowed
+    requests were in flight leave the limit alone, so an idle service
+    does not grow an arbitrarily large limit.
+
+aimd
+    Adds one to the limit for every request that completes within
+    LIMIT_LATENCY_MS, and multiplies it by 0.9 for every request that
+    takes longer or fails with 503/504.
+
+Each process has its own limit (see `common/serve.py`), and the
+exported gauge is the sum over processes.
+
+Environment variables:
+    LIMITER            0 to disable (default 1)
+    LIMIT_ALGORITHM    gradient or aimd (default gradient)
+    LIMIT_INITIAL      starting limit (default 20)
+    LIMIT_MIN          smallest limit (default 4)
+    LIMIT_MAX          largest limit (default 200)
+    LIMIT_TOLERANCE    gradient: latency growth tolerated (default 1.5)
+    LIMIT_LATENCY_MS   aimd: latency counted as overload (default 500)
+"""
+
+# Standard library modules
+import logging
+import math
+import os
+import threading
+import time
+
+# Installed packages
+from flask import g
+from flask import request
+from flask import Response
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+
+import simplejson as json
+
+# Paths ending in these are probes, scrapes or the change feed (see
+# common/changes.py) and are never limited
+SKIP_SUFFIXES = ('/health', '/readiness', '/metrics', '/changes')
+
+# Gradient: a window closes after this long with at least this many
+# samples; the long-term average spans about LONG_WINDOWS windows
+WINDOW_SECONDS = 0.25
+WINDOW_MIN_SAMPLES = 5
+LONG_WINDOWS = 100
+SMOOTHING = 0.2
+
+# Statuses that mean the request failed for lack of capacity
+OVERLOAD_STATUSES = (503, 504)
+
+LIMIT = Gauge('concurrency_limit',
+              'Requests a service will work on at once',
+              multiprocess_mode='livesum')
+REJECTED = Counter('concurrency_rejected_total',
+                   'Requests rejected by the concurrency limiter')
+
+
+def env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        logging.error("invalid {}, using {}".format(name, default))
+        return default
+
+
+class GradientLimit:
+    """Limit that shrinks as latency rises above its long-term average."""
+
+    def __init__(self, initial, min_limit, max_limit, tolerance):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.long_rtt = None
+        self.window_start = time.monotonic()
+        self.window_rtt = 0.0
+        self.window_count = 0
+        self.window_inflight = 0
+
+    def sample(self, rtt, inflight, overloaded):
+        self.window_rtt += rtt
+        self.window_count += 1
+        self.window_inflight = max(self.window_inflight, inflight)
+        now = time.monotonic()
+        if (now - self.window_start < WINDOW_SECONDS or
+                self.window_count < WINDOW_MIN_SAMPLES):
+            return
+        short_rtt = self.window_rtt / self.window_count
+        inflight = self.window_inflight
+        self.window_start = now
+        self.window_rtt = 0.0
+        self.window_count = 0
+        self.window_inflight = 0
+
+        if self.long_rtt is None:
+            self.long_rtt = short_rtt
+        else:
+            self.long_rtt += (short_rtt - self.long_rtt) / LONG_WINDOWS
+            # After an overload the long-term average is inflated;
+            # let it catch up with the recovered latency quickly
+            if self.long_rtt > 2 * short_rtt:
+                self.long_rtt *= 0.95
+        if inflight < self.limit / 2:
+            return
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_rtt /
+                                short_rtt))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        self.limit = (self.limit * (1 - SMOOTHING) + target * SMOOTHING)
+        self.limit = max(self.min_limit, min(self.max_limit, self.limit))
+
+
+class AimdLimit:
+    """Additive-increase, multiplicative-decrease limit."""
+
+    def __init__(self, initial, min_limit, max_limit, latency):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency = latency
+
+    def sample(self, rtt, inflight, overloaded):
+        if overloaded or rtt > self.latency:
+            self.limit = max(self.min_limit, self.limit * 0.9)
+        elif inflight * 2 >= self.limit:
+            self.limit = min(self.max_limit, self.limit + 1)
+
+
+class Limiter:
+    """Count the requests in flight against an adaptive limit."""
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.inflight = 0
+        # Connections queued for a thread (see common/worker.py)
+        self.waiting = 0
+        # Totals for common/probes.py, which watches for sustained
+        # rejection
+        self.admitted = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+        LIMIT.set(int(algorithm.limit))
+
+    def enqueue(self):
+        with self.lock:
+            self.waiting += 1
+
+    def dequeue(self):
+        with self.lock:
+            self.waiting = max(0, self.waiting - 1)
+
+    def acquire(self):
+        """Return the number in flight or queued including this request,
+        or 0."""
+        with self.lock:
+            if self.inflight + self.waiting >= int(self.algorithm.limit):
+                self.rejected += 1
+                return 0
+            self.admitted += 1
+            self.inflight += 1
+            return self.inflight + self.waiting
+
+    def release(self, rtt, inflight, overloaded):
+        with self.lock:
+            self.inflight -= 1
+            self.algorithm.sample(rtt, inflight, overloaded)
+            LIMIT.set(int(self.algorithm.limit))
+
+
+def make_limiter():
+    initial = env_float('LIMIT_INITIAL', 20)
+    min_limit = env_float('LIMIT_MIN', 4)
+    max_limit = env_float('LIMIT_MAX', 200)
+    if os.getenv('LIMIT_ALGORITHM', 'gradient') == 'aimd':
+        algorithm = AimdLimit(initial, min_limit, max_limit,
+                              env_float('LIMIT_LATENCY_MS', 500) / 1000.0)
+    else:
+        algorithm = GradientLimit(initial, min_limit, max_limit,
+                                  env_float('LIMIT_TOLERANCE', 1.5))
+    return Limiter(algorithm)
+
+
+# The Limiter of this process's app, if any
+current = None
+
+# The current request's wait for a thread, set by `dequeued`
+local = threading.local()
+
+
+def enqueued():
+    """Note that a connection is queued for a thread."""
+    if current is not None:
+        current.enqueue()
+
+
+def dequeued(wait):
+    """Note that this thread took a connection that waited `wait`
+    seconds in the queue."""
+    if current is not None:
+        current.dequeue()
+    local.queue_wait = wait
+
+
+def init_app(app):
+    """
+    Limit the requests `app` works on at once.
+
+    Returns the Limiter, or None if limiting is off.  Call this before
+    the other `init_app` functions, so that a rejected request costs
+    as little as possible.
+    """
+    global current
+    if os.getenv('LIMITER', '1') == '0':
+        return None
+    limiter = make_limiter()
+    current = limiter
+
+    @app.before_request
+    def limit_start():
+        wait = getattr(local, 'queue_wait', None) or 0.0
+        local.queue_wait = None
+        if request.path.endswith(SKIP_SUFFIXES):
+            return None
+        inflight = limiter.acquire()
+        if inflight == 0:
+            REJECTED.inc()
+            response = Response(json.dumps({"error": "overloaded"}),
+                                status=503,
+                                mimetype='application/json')
+            response.headers['Retry-After'] = '1'
+            return response
+        g.limit_start = (time.perf_counter() - wait, inflight)
+        return None
+
+    @app.after_request
+    def limit_status(response):
+        g.limit_status = response.status_code
+        return response
+
+    @app.teardown_request
+    def limit_end(exc):
+        start = g.pop('limit_start', None)
+        if start is None:
+            return
+        status = g.get('limit_status', 500)
+        limiter.release(time.perf_counter() - start[0], start[1],
+                        status in OVERLOAD_STATUSES)
+
+    return limiter
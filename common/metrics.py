@@ -0,0 +1,31 @@
+"""
+SFU CMPT 756
+Prometheus metrics for a service.
+
+Under the development server (`python app.py <port>`) a service is a
+single process and the ordinary PrometheusMetrics exporter is used.
+Under `common/serve.py` with several worker processes, each worker
+writes its samples to PROMETHEUS_MULTIPROC_DIR and `/metrics` reports
+the sum over all workers, whichever worker answers the scrape.
+"""
+
+# Standard library modules
+import os
+
+# Installed packages
+from prometheus_flask_exporter import PrometheusMetrics
+
+
+def multiprocess_dir():
+    """Return the multiprocess directory, or '' in single-process mode."""
+    return (os.getenv('PROMETHEUS_MULTIPROC_DIR', '') or
+            os.getenv('prometheus_multiproc_dir', ''))
+
+
+def init_metrics(app):
+    """Return the Prometheus exporter for `app`."""
+    if multiprocess_dir() != '':
+        from prometheus_flask_exporter.multiprocess import \
+            GunicornInternalPrometheusMetrics
+        return GunicornInternalPrometheusMetrics(app)
+    return PrometheusMetrics(app)
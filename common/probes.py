@@ -0,0 +1,204 @@
+"""
+SFU CMPT 756
+Readiness that reflects whether a process can serve.
+
+A service's `/readiness` view returns `probes.readiness()`, which
+answers 200 when the process can take traffic and otherwise 503 with
+the reasons, e.g.
+
+    {"status": "not ready", "warming": true,
+     "downstream": {"ok": false, "error": "...", "age": 1.2},
+     "overloaded": false}
+
+A process is not ready while
+
+warming     it is still loading its caches (see `common/warmup.py`);
+downstream  the cheap probe of its backend, registered with
+            `init_app` (the db service's `/health` for the services,
+            DynamoDB for the db service), fails.  A thread in each
+            process runs it every READY_PROBE_TTL seconds, and a
+            readiness probe answers from its last result, so it never
+            waits on the backend and frequent probes do not load it;
+overloaded  the concurrency limiter (see `common/limiter.py`), which
+            counts the requests queued for a thread, rejected
+            at least READY_OVERLOAD_SHARE of its requests in every
+            probe interval for READY_OVERLOAD_SECONDS.  Once the load
+            balancer has routed around the pod, the limiter stops
+            rejecting and the next probe reports ready again.
+
+The backend is shared by every pod, so by default (READY_DOWNSTREAM=
+startup) a failing probe only holds back a process that has never
+reached it; afterwards the failure is reported in the body but the
+status stays 200.  Marking every pod not ready at once would leave the
+Service with no endpoints at all, while a ready pod still answers at
+once with 503 through the db client's circuit breaker.
+
+Each gunicorn worker answers for itself, so a probe sees the state of
+whichever worker takes it.  `/health` (liveness) is unaffected: a pod
+that is merely overloaded or cut off must not be restarted.
+
+Environment variables:
+    READY_DOWNSTREAM        startup, always or never (default startup)
+    READY_PROBE_TTL         seconds between downstream probes
+                            (default 5)
+    READY_OVERLOAD_SHARE    share of requests rejected that counts as
+                            overload (default 0.1)
+    READY_OVERLOAD_SECONDS  seconds of overload before not ready
+                            (default 10)
+"""
+
+# Standard library modules
+import logging
+import os
+import threading
+import time
+
+# Installed packages
+from flask import Response
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+
+import simplejson as json
+
+# Local modules
+from common import limiter
+from common import warmup
+
+
+def env_float(name, default):
+    try:
+        return float(os.getenv(name, default))
+    except ValueError:
+        logging.error("invalid {}, using {}".format(name, default))
+        return default
+
+
+DOWNSTREAM = os.getenv('READY_DOWNSTREAM', 'startup')
+PROBE_TTL = env_float('READY_PROBE_TTL', 5)
+OVERLOAD_SHARE = env_float('READY_OVERLOAD_SHARE', 0.1)
+OVERLOAD_SECONDS = env_float('READY_OVERLOAD_SECONDS', 10)
+
+UP = Gauge('downstream_up',
+           'Whether the last probe of the backend succeeded',
+           multiprocess_mode='livemin')
+NOT_READY = Counter('readiness_not_ready_total',
+                    'Readiness probes answered 503, by reason',
+                    ['reason'])
+
+
+class DownstreamProbe:
+    """The last result of calling `check()`, which returns True or
+    raises, every `ttl` seconds in a background thread."""
+
+    def __init__(self, check, ttl=PROBE_TTL):
+        self.check = check
+        self.ttl = ttl
+        self.ok = False
+        self.error = "not probed"
+        self.checked = None
+        self.reached = False
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        try:
+            self.ok = bool(self.check())
+            self.error = None if self.ok else "check failed"
+        except Exception as e:
+            self.ok = False
+            self.error = str(e)
+        self.checked = time.monotonic()
+        self.reached = self.reached or self.ok
+        UP.set(1 if self.ok else 0)
+        if not self.ok:
+            logging.warning("downstream probe: {}".format(self.error))
+
+    def run(self):
+        while True:
+            self.refresh()
+            time.sleep(self.ttl)
+
+    def start(self):
+        with self.lock:
+            # Threads do not survive a fork, so each worker makes its own
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+        threading.Thread(target=self.run, name='downstream-probe',
+                         daemon=True).start()
+
+    def state(self):
+        if self.pid != os.getpid():
+            self.start()
+        age = None
+        if self.checked is not None:
+            age = round(time.monotonic() - self.checked, 3)
+        return {"ok": self.ok, "error": self.error, "age": age}
+
+    def blocking(self):
+        """Return True if the last result should hold back readiness."""
+        if self.ok or DOWNSTREAM == 'never':
+            return False
+        return DOWNSTREAM == 'always' or not self.reached
+
+
+class Overload:
+    """Whether the limiter has been rejecting requests for a while."""
+
+    def __init__(self):
+        self.last = (0, 0)
+        self.since = None
+
+    def overloaded(self, concurrency):
+        if concurrency is None:
+            return False
+        counts = (concurrency.admitted, concurrency.rejected)
+        admitted = counts[0] - self.last[0]
+        rejected = counts[1] - self.last[1]
+        self.last = counts
+        now = time.monotonic()
+        total = admitted + rejected
+        if total and rejected >= OVERLOAD_SHARE * total:
+            if self.since is None:
+                self.since = now
+        else:
+            self.since = None
+        return self.since is not None and now - self.since >= OVERLOAD_SECONDS
+
+
+probe = None
+overload = Overload()
+overload_lock = threading.Lock()
+
+
+def init_app(check):
+    """Count `check()`, which returns True or raises, as the probe of
+    this process's backend."""
+    global probe
+    probe = DownstreamProbe(check)
+
+
+def start():
+    """Start probing the backend in this process, if it has a probe."""
+    if probe is not None:
+        probe.start()
+
+
+def readiness():
+    """Return the response to a readiness probe."""
+    body = {"warming": not warmup.ready()}
+    if probe is not None:
+        body["downstream"] = probe.state()
+    with overload_lock:
+        body["overloaded"] = overload.overloaded(limiter.current)
+
+    reasons = [reason for reason in ("warming", "overloaded") if body[reason]]
+    if probe is not None and probe.blocking():
+        reasons.append("downstream")
+    for reason in reasons:
+        NOT_READY.labels(reason).inc()
+    body["status"] = "not ready" if reasons else "ready"
+    return Response(json.dumps(body),
+                    status=503 if reasons else 200,
+                    mimetype="application/json")
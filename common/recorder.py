@@ -0,0 +1,166 @@
+"""
+SFU CMPT 756
+Sampled request recording.
+
+When `RECORD_FILE` is set, a sample of the requests a service handles
+is appended to that file as JSON Lines, one object per request:
+
+    {"ts": 1650000000.123, "service": "music", "method": "GET",
+     "route": "/api/v1/music/<music_id>",
+     "path": "/api/v1/music/6ecfafd0-...", "query": "",
+     "ids": {"music_id": "6ecfafd0-..."}, "status": 200,
+     "duration_ms": 12.7}
+
+Request handling never waits on the file: records are handed to a
+background writer thread through a bounded queue and dropped (and
+counted in `recorder_dropped_total`) if the writer falls behind.
+`loadgen/replay.py` re-issues a recording against another environment.
+
+Environment variables:
+    RECORD_FILE         path of the JSONL file; recording is off if unset
+    RECORD_SAMPLE_RATE  fraction of requests to record (default 1.0)
+    RECORD_BODIES       if set to 1, also record JSON request bodies
+"""
+
+# Standard library modules
+import atexit
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+# Installed packages
+from flask import g
+from flask import request
+
+from prometheus_client import Counter
+
+import simplejson as json
+
+# Paths ending in these are probes or scrapes, not traffic
+SKIP_SUFFIXES = ('/health', '/readiness', '/metrics')
+
+QUEUE_SIZE = 10000
+
+# Most records written by one append, and the longest a record waits
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 1.0
+
+DROPPED = Counter('recorder_dropped_total',
+                  'Request records dropped because the writer fell behind')
+
+
+class Recorder:
+    """
+    Append records to a JSONL file from a background thread.
+
+    The writer thread is started by the first record a process puts,
+    so that each worker forked from a preloaded master (see
+    `common/serve.py`) gets its own.  Every batch is a single append
+    to the file, so workers sharing a file do not interleave lines.
+    """
+
+    def __init__(self, path, sample_rate=1.0, bodies=False):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.bodies = bodies
+        self.dropped = 0
+        self.pid = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def sample(self):
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+            self.thread = threading.Thread(target=self._write_loop,
+                                           name='recorder',
+                                           daemon=True)
+            self.thread.start()
+            self.pid = os.getpid()
+
+    def put(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            DROPPED.inc()
+
+    def close(self):
+        """Flush outstanding records; called at interpreter exit."""
+        if self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+    def _write_loop(self):
+        with open(self.path, 'ab', buffering=0) as out:
+            done = False
+            while not done:
+                batch = []
+                try:
+                    record = self.queue.get(timeout=FLUSH_INTERVAL)
+                    while record is not None:
+                        batch.append(json.dumps(record) + '\n')
+                        if len(batch) >= BATCH_SIZE:
+                            break
+                        record = self.queue.get_nowait()
+                    done = record is None
+                except queue.Empty:
+                    pass
+                if batch:
+                    out.write(''.join(batch).encode())
+
+
+def init_app(app, service):
+    """
+    Record a sample of `app`'s requests if `RECORD_FILE` is set.
+
+    Returns the Recorder, or None if recording is off.
+    """
+    path = os.getenv('RECORD_FILE', '')
+    if path == '':
+        return None
+    try:
+        rate = float(os.getenv('RECORD_SAMPLE_RATE', '1.0'))
+    except ValueError:
+        logging.error("invalid RECORD_SAMPLE_RATE, recording all requests")
+        rate = 1.0
+    rec = Recorder(path, rate, os.getenv('RECORD_BODIES', '') == '1')
+
+    @app.before_request
+    def record_start():
+        if request.path.endswith(SKIP_SUFFIXES) or not rec.sample():
+            return
+        g.record_start = (time.time(), time.perf_counter())
+
+    @app.after_request
+    def record_end(response):
+        start = g.pop('record_start', None)
+        if start is None:
+            return response
+        record = {
+            'ts': start[0],
+            'service': service,
+            'method': request.method,
+            'route': request.url_rule.rule if request.url_rule else None,
+            'path': request.path,
+            'query': request.query_string.decode('latin-1'),
+            'ids': request.view_args or {},
+            'status': response.status_code,
+            'duration_ms': (time.perf_counter() - start[1]) * 1000.0,
+        }
+        if rec.bodies and request.is_json:
+            record['body'] = request.get_json(silent=True)
+        rec.put(record)
+        return response
+
+    return rec
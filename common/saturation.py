@@ -0,0 +1,83 @@
+"""
+SFU CMPT 756
+Saturation metrics for autoscaling.
+
+The services spend most of their time waiting on the db service, so
+CPU rises late, if at all, when a pod runs out of capacity.
+`init_app` exports what does rise:
+
+    service_inflight_requests    requests being handled now (gauge)
+    service_worker_threads       threads available to handle them (gauge)
+    service_busy_seconds_total   thread-seconds spent handling requests
+    service_queue_wait_seconds   time a request waited for a free thread
+                                 (histogram)
+
+Worker-pool utilization is busy seconds per second per thread,
+
+    rate(service_busy_seconds_total[1m]) / service_worker_threads
+
+which, unlike a sampled gauge, counts every request however short.
+Queue wait is measured by the Gunicorn worker in `common/worker.py`
+from the moment a request's connection becomes readable until a
+thread picks it up, and recorded there, before the app sees the
+request, so that it includes the requests the concurrency limiter
+(see `common/limiter.py`) rejects, which under overload are the ones
+that waited longest.  It is not recorded under the development
+server.
+The gauges are summed over a pod's worker processes.
+`cluster/prometheus-adapter-values.yaml` turns these series into
+per-pod metrics for the HPAs in `cluster/saturation-hpa.yaml`.
+"""
+
+# Standard library modules
+import os
+import time
+
+# Installed packages
+from flask import g
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
+# Local modules
+from common import metrics
+from common import timing
+
+INFLIGHT = Gauge('service_inflight_requests',
+                 'Requests being handled',
+                 multiprocess_mode='livesum')
+THREADS = Gauge('service_worker_threads',
+                'Threads available to handle requests',
+                multiprocess_mode='livesum')
+BUSY = Counter('service_busy_seconds',
+               'Thread-seconds spent handling requests')
+QUEUE_WAIT = Histogram('service_queue_wait_seconds',
+                       'Time requests waited for a worker thread',
+                       buckets=timing.BUCKETS)
+
+def dequeued(wait):
+    """Note that a thread picked up a request that waited `wait`
+    seconds."""
+    QUEUE_WAIT.observe(wait)
+
+
+def init_app(app):
+    """Export the saturation metrics of `app`."""
+    # Under Gunicorn with several workers, each worker reports its own
+    # threads when it starts; see common/worker.py
+    if metrics.multiprocess_dir() == '':
+        THREADS.set(int(os.getenv('WEB_THREADS', '8')))
+
+    @app.before_request
+    def saturation_start():
+        INFLIGHT.inc()
+        g.saturation_start = time.perf_counter()
+
+    @app.teardown_request
+    def saturation_end(exc):
+        start = g.pop('saturation_start', None)
+        if start is None:
+            return
+        INFLIGHT.dec()
+        BUSY.inc(time.perf_counter() - start)
@@ -0,0 +1,146 @@
+"""
+SFU CMPT 756
+Production launcher for the services.
+
+    python -m common.serve app:app <port>
+
+runs a service's Flask app under Gunicorn instead of Flask's
+development server.  Each worker process runs a pool of threads
+(the `gthread` worker, extended in `common/worker.py` to report its
+saturation), so a pod can use all of its CPU limit before the HPA has
+to add replicas.
+
+Environment variables:
+    WEB_WORKERS           worker processes (default 2)
+    WEB_THREADS           threads per worker (default 8)
+    WEB_PRELOAD           1 to import the app, and build its clients
+                          (see `common/startup.py`), once in the master
+                          before forking the workers (default 1)
+    WEB_TIMEOUT           seconds before a silent worker is restarted
+                          (default 30)
+    WEB_GRACEFUL_TIMEOUT  seconds in-flight requests are given to finish
+                          after SIGTERM (default 25, inside the default
+                          Kubernetes terminationGracePeriodSeconds of 30)
+    WEB_KEEPALIVE         seconds to hold idle keep-alive connections
+                          (default 5)
+
+With more than one worker, Prometheus metrics are kept in
+PROMETHEUS_MULTIPROC_DIR (default /tmp/prometheus-multiproc), which is
+emptied at startup, so `/metrics` reports all workers together, and
+the workers share a new CHANGE_FEED_DIR, through which the change feed
+(see `common/changes.py`) reaches every worker.
+
+SIGTERM is a graceful shutdown: the master stops accepting connections,
+lets the workers finish their in-flight requests for up to
+WEB_GRACEFUL_TIMEOUT seconds, then exits.
+"""
+
+# Standard library modules
+import logging
+import os
+import shutil
+import sys
+import tempfile
+
+DEFAULT_MULTIPROC_DIR = '/tmp/prometheus-multiproc'
+
+
+def env_int(name, default):
+    try:
+        return int(os.getenv(name, default))
+    except ValueError:
+        logging.error("invalid {}, using {}".format(name, default))
+        return default
+
+
+def prepare_multiproc_dir(path):
+    """
+    Point prometheus_client at an empty multiprocess directory.
+
+    This must run before prometheus_client is first imported, because
+    it chooses single- or multi-process storage at import time.
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = path
+    # Older releases of prometheus_client only read the lowercase name
+    os.environ['prometheus_multiproc_dir'] = path
+
+
+def child_exit(server, worker):
+    """Gunicorn hook: drop the live gauges of a worker that has exited."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+    try:
+        os.unlink(os.path.join(os.environ['CHANGE_FEED_DIR'],
+                               str(worker.pid)))
+    except (KeyError, OSError):
+        pass
+
+
+def post_worker_init(worker):
+    """Gunicorn hook: start warming the worker's caches, listening for
+    changes to them and probing the backend, right away."""
+    from common import changes
+    from common import probes
+    from common import startup
+    from common import warmup
+    startup.worker_ready()
+    warmup.start()
+    changes.get_transport()
+    probes.start()
+
+
+def options(port):
+    workers = env_int('WEB_WORKERS', 2)
+    opts = {
+        'bind': '0.0.0.0:{}'.format(port),
+        'worker_class': 'common.worker.ThreadWorker',
+        'workers': workers,
+        'threads': env_int('WEB_THREADS', 8),
+        'preload_app': os.getenv('WEB_PRELOAD', '1') == '1',
+        'timeout': env_int('WEB_TIMEOUT', 30),
+        'graceful_timeout': env_int('WEB_GRACEFUL_TIMEOUT', 25),
+        'keepalive': env_int('WEB_KEEPALIVE', 5),
+        'accesslog': None,
+        'errorlog': '-',
+        'post_worker_init': post_worker_init,
+    }
+    if workers > 1:
+        opts['child_exit'] = child_exit
+    return opts
+
+
+def main(argv):
+    if len(argv) < 3:
+        logging.error("Usage: python -m common.serve <module>:<app> <port>")
+        sys.exit(-1)
+    app_uri, port = argv[1], int(argv[2])
+    opts = options(port)
+    if opts['workers'] > 1:
+        prepare_multiproc_dir(os.getenv('PROMETHEUS_MULTIPROC_DIR',
+                                        DEFAULT_MULTIPROC_DIR))
+        os.environ['CHANGE_FEED_DIR'] = tempfile.mkdtemp(
+            prefix='change-feed-')
+
+    from gunicorn.app.base import BaseApplication
+    from gunicorn.util import import_app
+
+    class Server(BaseApplication):
+        def load_config(self):
+            for key, value in opts.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # With preload_app, this runs once in the master
+            from common import startup
+            app = import_app(app_uri)
+            startup.loaded()
+            startup.preload(app)
+            return app
+
+    Server().run()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
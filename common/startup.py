@@ -0,0 +1,123 @@
+"""
+SFU CMPT 756
+Cold-start timing and preloading.
+
+A new pod takes no traffic until its app is imported and its first
+request is answered, so this time delays every HPA scale-out.  The
+timings are measured from the start of the process (read from /proc,
+so they include the interpreter's own startup), logged, and exported:
+
+    startup_loaded_seconds         until the app module was imported
+    startup_preload_seconds        spent in `preload`
+    startup_worker_ready_seconds   until a Gunicorn worker was ready to
+                                   accept requests (the slowest worker)
+    startup_first_request_seconds  until a worker began its first
+                                   request (the slowest worker)
+
+`common/serve.py` calls `loaded` and then `preload` as soon as it has
+imported the app, which with WEB_PRELOAD=1 is once, in the Gunicorn
+master, before the workers fork.  `preload` compiles the app's URL map
+and runs the functions registered with `on_preload`, which build
+clients the workers would otherwise each build on their first request.
+They must not open connections: a socket opened before the fork would
+be shared by every worker.  Under the development server only the
+first request is timed.
+
+For a breakdown by module, run a service with PYTHONPROFILEIMPORTTIME=1
+(Python's `-X importtime`), or see `bench/bench.py --cold-start`.
+"""
+
+# Standard library modules
+import logging
+import os
+import threading
+import time
+
+# Installed packages
+from prometheus_client import Gauge
+
+LOADED = Gauge('startup_loaded_seconds',
+               'Seconds from process start until the app was imported',
+               multiprocess_mode='max')
+PRELOAD = Gauge('startup_preload_seconds',
+                'Seconds spent building clients before serving',
+                multiprocess_mode='max')
+WORKER_READY = Gauge('startup_worker_ready_seconds',
+                     'Seconds from process start until a worker was ready',
+                     multiprocess_mode='max')
+FIRST_REQUEST = Gauge('startup_first_request_seconds',
+                      'Seconds from process start until the first request',
+                      multiprocess_mode='max')
+
+
+def process_start():
+    """Return the wall-clock time at which this process started."""
+    try:
+        with open('/proc/self/stat', 'r') as inp:
+            # Field 22, counting from the state after the command name
+            ticks = int(inp.read().rpartition(')')[2].split()[19])
+        with open('/proc/uptime', 'r') as inp:
+            uptime = float(inp.read().split()[0])
+        age = uptime - ticks / os.sysconf('SC_CLK_TCK')
+        return time.time() - max(0.0, age)
+    except (OSError, ValueError, IndexError):
+        return time.time()
+
+
+# Inherited by the workers, so they count from the master's start
+STARTED = process_start()
+
+hooks = []
+first_pid = None
+first_lock = threading.Lock()
+
+
+def since_start():
+    return time.time() - STARTED
+
+
+def on_preload(hook):
+    """Call `hook()` in `preload`, before the workers fork."""
+    hooks.append(hook)
+
+
+def loaded():
+    """Note that the app module has been imported."""
+    seconds = since_start()
+    LOADED.set(seconds)
+    logging.info("app loaded {:.3f}s after process start".format(seconds))
+
+
+def preload(app):
+    """Do the work of a first request that the workers can share."""
+    start = time.perf_counter()
+    app.url_map.update()
+    for hook in hooks:
+        try:
+            hook()
+        except Exception:
+            # The first request will build it instead
+            logging.exception("preload hook failed")
+    PRELOAD.set(time.perf_counter() - start)
+
+
+def worker_ready():
+    """Note that a worker process is ready to accept requests."""
+    WORKER_READY.set(since_start())
+
+
+def init_app(app):
+    """Time each process's first request to `app`."""
+    @app.before_request
+    def startup_first_request():
+        global first_pid
+        if first_pid == os.getpid():
+            return
+        with first_lock:
+            if first_pid == os.getpid():
+                return
+            first_pid = os.getpid()
+        seconds = since_start()
+        FIRST_REQUEST.set(seconds)
+        logging.info("first request {:.3f}s after process start".format(
+            seconds))
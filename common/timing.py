@@ -0,0 +1,123 @@
+"""
+SFU CMPT 756
+Per-request timing breakdown.
+
+Code on the request path wraps each phase of its work in
+
+    with phase('db'):
+        ...
+
+and `init_app` reports the accumulated time of every phase in two ways:
+
+* a `Server-Timing` response header, e.g.
+      Server-Timing: db;dur=12.4;desc="3 calls", serialize;dur=0.3,
+                     db-dynamodb;dur=9.8, total;dur=13.6
+  Entries prefixed `db-` are the phases reported by the db service in
+  its own Server-Timing header, so a playlist response shows how much
+  of its db time was spent in DynamoDB.
+
+* a `request_phase_seconds` Prometheus histogram labelled by phase,
+  observed once per request with the phase's total time.
+
+Phases in use:
+    auth       verifying the request's bearer token
+    db         HTTP calls from a service to the db service
+    dynamodb   DynamoDB calls made by the db service
+    serialize  turning the view's return value into a response body
+
+Timing costs two clock reads per phase plus one histogram update,
+so it is always on.  Set SERVER_TIMING=0 to omit the header (the
+histograms are still recorded).
+"""
+
+# Standard library modules
+import contextlib
+import os
+import time
+
+# Installed packages
+from flask import g
+from flask import has_request_context
+
+from prometheus_client import Histogram
+
+# Most phases are well under a millisecond, so the buckets start low
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+PHASE_SECONDS = Histogram('request_phase_seconds',
+                          'Time spent in each phase of a request',
+                          ['phase'],
+                          buckets=BUCKETS)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Charge the time spent in the `with` block to phase `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if has_request_context():
+            phases = g.setdefault('phases', {})
+            total, count = phases.get(name, (0.0, 0))
+            phases[name] = (total + elapsed, count + 1)
+        else:
+            PHASE_SECONDS.labels(name).observe(elapsed)
+
+
+def add_downstream(prefix, header):
+    """Add the entries of a downstream Server-Timing header."""
+    if not header or not has_request_context():
+        return
+    entries = g.setdefault('downstream_timing', [])
+    for entry in header.split(','):
+        entry = entry.strip()
+        if entry and not entry.startswith('total;'):
+            entries.append(prefix + '-' + entry)
+
+
+def server_timing():
+    """Return the Server-Timing header value for the current request."""
+    entries = []
+    for name, (total, count) in g.get('phases', {}).items():
+        entry = '{};dur={:.2f}'.format(name, total * 1000.0)
+        if count > 1:
+            entry += ';desc="{} calls"'.format(count)
+        entries.append(entry)
+    entries.extend(g.get('downstream_timing', []))
+    start = g.get('timing_start')
+    if start is not None:
+        entries.append('total;dur={:.2f}'.format(
+            (time.perf_counter() - start) * 1000.0))
+    return ', '.join(entries)
+
+
+def init_app(app):
+    """Time the phases of every request handled by `app`."""
+    send_header = os.getenv('SERVER_TIMING', '1') == '1'
+
+    @app.before_request
+    def timing_start():
+        g.timing_start = time.perf_counter()
+
+    # Serialization happens after the view returns, in make_response
+    make_response = app.make_response
+
+    def timed_make_response(rv):
+        with phase('serialize'):
+            return make_response(rv)
+
+    app.make_response = timed_make_response
+
+    @app.teardown_request
+    def timing_observe(exc):
+        for name, (total, count) in g.get('phases', {}).items():
+            PHASE_SECONDS.labels(name).observe(total)
+
+    if send_header:
+        @app.after_request
+        def timing_header(response):
+            response.headers['Server-Timing'] = server_timing()
+            return response
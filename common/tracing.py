@@ -0,0 +1,242 @@
+"""
+SFU CMPT 756
+Trace-context propagation and local span export.
+
+Istio can only join a request's hops into one trace if every service
+copies the trace headers of the request it is serving onto the calls it
+makes.  `init_app` saves the incoming B3/W3C headers and
+`outbound_headers()` returns them for `common/dbclient.py` to send on
+every call to the db service.  A request arriving without trace
+headers (e.g. outside the mesh) starts a new trace.
+
+When TRACE_FILE is set, spans are also written to that file as JSON
+Lines by a background writer (see `common/recorder.py`):
+
+    {"trace_id": "...", "span_id": "...", "parent_id": "...",
+     "service": "playlist", "name": "GET /api/v1/playlist/<playlist_id>",
+     "kind": "server", "start": 1650000000.123, "duration_ms": 14.2,
+     "attrs": {"status": 200}}
+
+A service records a `server` span per request and a `client` span per
+db call; the db service also records a span per boto3 operation.  Span
+files from all services can be joined by trace id without an external
+collector; `tools/critical-path.py` reports where fan-out time goes.
+
+The Istio headers are forwarded unchanged, so that Envoy's spans still
+form one tree.  Our client span id travels separately in
+`x-client-span-id`, and the db service uses it as the parent of its
+server span, so the spans in the files form one tree too.
+
+Environment variables:
+    TRACE_FILE         JSONL file for spans; no spans are written if unset
+    TRACE_SAMPLE_RATE  fraction of new traces to record (default 1.0);
+                       incoming traces follow their x-b3-sampled flag
+"""
+
+# Standard library modules
+import contextlib
+import os
+import random
+import re
+import time
+
+# Installed packages
+from flask import g
+from flask import has_request_context
+from flask import request
+
+# Local modules
+from common import recorder
+
+# Headers Istio asks applications to propagate
+PROPAGATED_HEADERS = [
+    'x-request-id',
+    'x-b3-traceid',
+    'x-b3-spanid',
+    'x-b3-parentspanid',
+    'x-b3-sampled',
+    'x-b3-flags',
+    'b3',
+    'x-ot-span-context',
+    'traceparent',
+    'tracestate',
+]
+
+# Headers carrying the incoming trace context, which a new trace replaces
+CONTEXT_HEADERS = [
+    'x-b3-parentspanid',
+    'b3',
+    'traceparent',
+    'tracestate',
+]
+
+CLIENT_SPAN_HEADER = 'x-client-span-id'
+
+# W3C traceparent: version-trace_id-parent_id-flags, in lower-case hex
+TRACEPARENT = re.compile(r'([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-'
+                         r'([0-9a-f]{2})')
+
+exporter = None
+sample_rate = 1.0
+
+
+def new_id(bits=64):
+    return '{:0{}x}'.format(random.getrandbits(bits), bits // 4)
+
+
+def incoming_context(headers):
+    """Return (trace_id, span_id, sampled) from the incoming headers."""
+    trace_id = headers.get('x-b3-traceid')
+    span_id = headers.get('x-b3-spanid')
+    sampled = headers.get('x-b3-sampled')
+    if trace_id is None and 'traceparent' in headers:
+        # A malformed traceparent is ignored, starting a new trace
+        match = TRACEPARENT.fullmatch(headers['traceparent'].strip())
+        if match and match.group(1) != 'ff' and \
+                match.group(2) != '0' * 32 and match.group(3) != '0' * 16:
+            trace_id, span_id = match.group(2), match.group(3)
+            sampled = '1' if int(match.group(4), 16) & 1 else '0'
+    if sampled is not None:
+        sampled = sampled == '1'
+    return trace_id, span_id, sampled
+
+
+def current_span_id():
+    if not has_request_context():
+        return None
+    stack = g.get('span_stack')
+    return stack[-1] if stack else None
+
+
+def recording():
+    return (exporter is not None and has_request_context() and
+            g.get('trace_sampled', False))
+
+
+def export(name, kind, span_id, parent_id, start, duration, attrs):
+    exporter.put({
+        'trace_id': g.trace_id,
+        'span_id': span_id,
+        'parent_id': parent_id,
+        'service': g.trace_service,
+        'name': name,
+        'kind': kind,
+        'start': start,
+        'duration_ms': duration * 1000.0,
+        'attrs': attrs,
+    })
+
+
+@contextlib.contextmanager
+def span(name, kind='internal', **attrs):
+    """
+    Record the `with` block as a span; yields the span id (or None).
+
+    `attrs` may be updated inside the block, e.g. with a status.
+    """
+    if not recording():
+        yield None
+        return
+    span_id = new_id()
+    parent_id = current_span_id()
+    g.span_stack.append(span_id)
+    start, t0 = time.time(), time.perf_counter()
+    try:
+        yield span_id
+    finally:
+        g.span_stack.pop()
+        export(name, kind, span_id, parent_id, start,
+               time.perf_counter() - t0, attrs)
+
+
+def outbound_headers(client_span_id=None):
+    """Return the trace headers to send on a call made for this request."""
+    if not has_request_context():
+        return {}
+    headers = dict(g.get('trace_headers', {}))
+    if client_span_id is not None:
+        headers[CLIENT_SPAN_HEADER] = client_span_id
+    return headers
+
+
+def init_app(app, service):
+    """Propagate trace context through `app`; export spans if configured."""
+    global exporter, sample_rate
+    path = os.getenv('TRACE_FILE', '')
+    if path != '' and exporter is None:
+        exporter = recorder.Recorder(path)
+    sample_rate = float(os.getenv('TRACE_SAMPLE_RATE', '1.0'))
+
+    @app.before_request
+    def trace_start():
+        headers = request.headers
+        trace_id, span_id, sampled = incoming_context(headers)
+        forwarded = {}
+        for h in PROPAGATED_HEADERS:
+            if h in headers:
+                forwarded[h] = headers[h]
+        server_span = new_id()
+        if trace_id is None:
+            # Start a new trace and pass it on, in place of any context
+            # that was not understood, such as a malformed traceparent
+            trace_id, span_id = new_id(128), None
+            for h in CONTEXT_HEADERS:
+                forwarded.pop(h, None)
+            sampled = random.random() < sample_rate
+            forwarded['x-b3-traceid'] = trace_id
+            forwarded['x-b3-spanid'] = server_span
+            forwarded['x-b3-sampled'] = '1' if sampled else '0'
+        elif sampled is None:
+            sampled = True
+        g.trace_id = trace_id
+        g.trace_headers = forwarded
+        g.trace_service = service
+        g.trace_sampled = sampled
+        g.trace_server_span = server_span
+        # The caller's client span if it sent one, else the incoming span
+        g.trace_parent = headers.get(CLIENT_SPAN_HEADER, span_id)
+        g.trace_start = (time.time(), time.perf_counter())
+        g.span_stack = [g.trace_server_span]
+
+    if exporter is None:
+        return
+
+    @app.after_request
+    def trace_end(response):
+        start = g.get('trace_start')
+        if start is None or not g.get('trace_sampled', False):
+            return response
+        rule = request.url_rule.rule if request.url_rule else request.path
+        export('{} {}'.format(request.method, rule), 'server',
+               g.trace_server_span, g.trace_parent, start[0],
+               time.perf_counter() - start[1],
+               {'status': response.status_code})
+        return response
+
+
+def instrument_boto3(resource):
+    """Record a span for every call made through a boto3 resource."""
+    events = resource.meta.client.meta.events
+
+    def before_call(params, model, context, **kwargs):
+        if recording():
+            context['trace_span'] = (new_id(), current_span_id(),
+                                     params.get('TableName'),
+                                     time.time(), time.perf_counter())
+
+    def after_call(model, context, **kwargs):
+        started = context.pop('trace_span', None)
+        if started is None or not recording():
+            return
+        span_id, parent_id, table, start, t0 = started
+        attrs = {'table': table}
+        if 'http_response' in kwargs:
+            attrs['status'] = kwargs['http_response'].status_code
+        export('dynamodb.' + model.name, 'client', span_id, parent_id,
+               start, time.perf_counter() - t0, attrs)
+
+    # before-call is skipped when a handler supplies the response
+    # (e.g. botocore's Stubber), so the span starts a step earlier
+    events.register('before-parameter-build.dynamodb', before_call)
+    events.register('after-call.dynamodb', after_call)
+    events.register('after-call-error.dynamodb', after_call)
@@ -0,0 +1,168 @@
+"""
+SFU CMPT 756
+Cache and connection pre-warming at startup.
+
+A new pod's caches are empty and its db connection pool is closed, so
+the first wave of traffic after a scale-out would all go to the db
+service and DynamoDB at once.  A service registers a loader:
+
+    warmup.init_app(app, 'music', warm_songs, 'file:resources/music.csv')
+
+and each worker process, as soon as it starts, reads a list of hot ids
+and passes them to the loader in batches of WARMUP_BATCH, from
+WARMUP_THREADS threads (which also opens that many pooled
+connections).  `ready()` is False until it has finished, or until
+WARMUP_TIMEOUT seconds have passed; the readiness probe answers 503
+meanwhile, so the pod gets no traffic while it is cold.
+
+Sources (WARMUP_SOURCE, comma-separated, read in order until there are
+WARMUP_LIMIT ids):
+    file:<path>    one id per line, or a CSV with the ids in its UUID
+                   column; the images carry the Gatling resources as
+                   resources/*.csv
+    hotkeys:<url>  the keys most read recently by a db service process,
+                   e.g. http://cmpt756db:30002/api/v1/datastore/debug/hotkeys
+    none           no warming
+
+Warming is best effort: a source or batch that fails is logged and
+skipped.
+
+Environment variables:
+    WARMUP_SOURCE   see above (default set by each service)
+    WARMUP_LIMIT    most ids loaded (default 1000)
+    WARMUP_BATCH    ids per load call (default 100)
+    WARMUP_THREADS  concurrent load calls (default 4)
+    WARMUP_TIMEOUT  seconds before reporting ready anyway (default 30)
+"""
+
+# Standard library modules
+import concurrent.futures
+import csv
+import logging
+import os
+import threading
+import time
+
+# Installed packages
+from prometheus_client import Counter
+from prometheus_client import Gauge
+
+LIMIT = int(os.getenv('WARMUP_LIMIT', '1000'))
+BATCH = int(os.getenv('WARMUP_BATCH', '100'))
+THREADS = int(os.getenv('WARMUP_THREADS', '4'))
+TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', '30'))
+
+SECONDS = Gauge('warmup_seconds',
+                'Time the last warm-up of a worker took',
+                multiprocess_mode='max')
+IDS = Counter('warmup_ids_total',
+              'Ids passed to the warm-up loader')
+
+registered = None
+started_pid = None
+done = threading.Event()
+lock = threading.Lock()
+
+
+def read_file(path):
+    with open(path, 'r') as inp:
+        lines = inp.read().splitlines()
+    if lines and ',' in lines[0]:
+        rows = list(csv.reader(lines))
+        column = rows[0].index('UUID') if 'UUID' in rows[0] else 0
+        return [row[column] for row in rows[1:] if len(row) > column]
+    return [line.strip() for line in lines if line.strip()]
+
+
+def read_hotkeys(url, objtype, n):
+    # Not imported at startup, as the db service does not otherwise
+    # need it
+    import requests
+    response = requests.get(url, params={"objtype": objtype, "n": n},
+                            timeout=2.0)
+    response.raise_for_status()
+    report = response.json()['objtypes'].get(objtype, {})
+    return [k['key'] for k in report.get('read', {}).get('keys', [])]
+
+
+def read_ids(source, objtype, limit):
+    """Return up to `limit` distinct ids from the `source` list."""
+    ids = []
+    for spec in source.split(','):
+        kind, _, arg = spec.strip().partition(':')
+        try:
+            if kind == 'file':
+                ids.extend(read_file(arg))
+            elif kind == 'hotkeys':
+                ids.extend(read_hotkeys(arg, objtype, limit))
+            elif kind not in ('', 'none'):
+                logging.warning("unknown warm-up source {}".format(spec))
+        except Exception as e:
+            logging.warning("warm-up source {}: {}".format(spec, e))
+        ids = list(dict.fromkeys(ids))
+        if len(ids) >= limit:
+            break
+    return ids[:limit]
+
+
+def run(objtype, load, source, finished):
+    start = time.monotonic()
+    pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=THREADS, thread_name_prefix='warmup')
+    try:
+        ids = read_ids(source, objtype, LIMIT)
+        IDS.inc(len(ids))
+        futures = [pool.submit(load, ids[i:i + BATCH])
+                   for i in range(0, len(ids), BATCH)]
+        _, late = concurrent.futures.wait(futures, timeout=TIMEOUT)
+        for future in futures:
+            if future.done() and future.exception() is not None:
+                logging.warning("warm-up batch: {}".format(
+                    future.exception()))
+        if late:
+            logging.warning("warm-up timed out with {} batches left".format(
+                len(late)))
+        logging.info("warmed {} {} ids in {:.2f}s".format(
+            len(ids), objtype, time.monotonic() - start))
+    except Exception:
+        logging.exception("warm-up failed")
+    finally:
+        pool.shutdown(wait=False)
+        SECONDS.set(time.monotonic() - start)
+        finished.set()
+
+
+def start():
+    """Start warming this process, if a loader is registered and this
+    process has not started already."""
+    global started_pid, done
+    if registered is None or started_pid == os.getpid():
+        return
+    with lock:
+        # Threads do not survive a fork, so each worker warms itself
+        if started_pid == os.getpid():
+            return
+        started_pid = os.getpid()
+        done = threading.Event()
+    threading.Thread(target=run, args=registered + (done,),
+                     name='warmup', daemon=True).start()
+
+
+def ready():
+    """Return True once this process has finished warming."""
+    return registered is None or done.is_set()
+
+
+def init_app(app, objtype, load, source):
+    """
+    Warm each process of `app` by calling `load(ids)` with hot ids of
+    `objtype`, taken from WARMUP_SOURCE or else `source`.
+    """
+    global registered
+    registered = (objtype, load, os.getenv('WARMUP_SOURCE', source))
+
+    # common/serve.py starts warming as each worker boots; this covers
+    # the development server
+    @app.before_request
+    def start_warmup():
+        start()
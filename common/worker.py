@@ -0,0 +1,51 @@
+"""
+SFU CMPT 756
+Gunicorn worker for the services.
+
+Gunicorn's `gthread` worker, extended to report its thread pool to
+`common/saturation.py`: each worker process publishes its thread count
+when it starts, and every request's wait for a free thread is timed
+from the moment its connection was queued, including requests the
+limiter rejects.  Queued connections are also reported to
+`common/limiter.py`, which counts them against its limit.
+`common/serve.py` selects this worker.
+"""
+
+# Standard library modules
+import time
+
+# Installed packages
+from gunicorn.workers import gthread
+
+# Local modules
+from common import limiter
+from common import saturation
+
+
+class ThreadWorker(gthread.ThreadWorker):
+    def init_process(self):
+        saturation.THREADS.set(self.cfg.threads)
+        super().init_process()
+
+    def enqueue_req(self, conn):
+        conn.queued_at = time.perf_counter()
+        limiter.enqueued()
+        super().enqueue_req(conn)
+
+    def handle(self, conn):
+        queued_at = getattr(conn, 'queued_at', None)
+        if queued_at is not None:
+            conn.queued_at = None
+            conn.queue_wait = time.perf_counter() - queued_at
+            limiter.dequeued(conn.queue_wait)
+        return super().handle(conn)
+
+    def handle_request(self, req, conn):
+        # Only here is there a request: a connection is also queued
+        # when a keep-alive client closes it.  Recorded before the app
+        # runs, so requests the limiter rejects are counted too.
+        wait = getattr(conn, 'queue_wait', None)
+        if wait is not None:
+            conn.queue_wait = None
+            saturation.dequeued(wait)
+        return super().handle_request(req, conn)
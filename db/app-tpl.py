@@ -8,6 +8,7 @@ import base64
 import logging
 import os
 import sys
+import time
 import urllib.parse
 import uuid
 
@@ -16,21 +17,45 @@ import uuid
 import boto3
 from boto3.dynamodb.conditions import Key
 
+import botocore.exceptions
+
 from flask import Blueprint
 from flask import Flask
 from flask import request
 from flask import Response
 
-from prometheus_flask_exporter import PrometheusMetrics
-
 import simplejson as json
 
+# Local modules
+from common import cache
+from common import changes
+from common import deadline
+from common import hotkeys
+from common import idlists
+from common import limiter
+from common import probes
+from common import recorder
+from common import saturation
+from common import startup
+from common import timing
+from common import tracing
+from common import warmup
+from common.metrics import init_metrics
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+metrics = init_metrics(app)
 metrics.info('app_info', 'Database process')
+limiter.init_app(app)
+startup.init_app(app)
+saturation.init_app(app)
+recorder.init_app(app, 'db')
+timing.init_app(app)
+deadline.init_app(app)
+changes.init_app(app)
+tracing.init_app(app, 'db')
 
 bp = Blueprint('app', __name__)
 
@@ -64,6 +89,63 @@ else:
         aws_access_key_id=access_key,
         aws_secret_access_key=secret_access_key)
 
+tracing.instrument_boto3(dynamodb)
+deadline.instrument_boto3(dynamodb)
+
+
+def preload_tables():
+    """
+    Build boto3's Table class before the workers fork; otherwise each
+    worker builds it, from the service model, on its first request.
+    """
+    for objtype in ('user', 'music', 'playlist'):
+        dynamodb.Table(objtype.capitalize()+"-ZZ-REG-ID")
+
+
+startup.on_preload(preload_tables)
+
+# BatchGetItem takes at most 100 keys per call, and may return some
+# of them unprocessed when throttled; those are retried with backoff
+BATCH_SIZE = 100
+BATCH_RETRIES = 3
+BATCH_BACKOFF = 0.025
+
+# Items scanned per `/migrate` call, unless the caller gives a limit
+MIGRATE_PAGE = 100
+
+# (objtype, objkey) of recent reads that found nothing.  Per process, so
+# a write through another db process is seen after NEGATIVE_CACHE_TTL.
+missing = cache.TTLCache('db-missing', cache.NEGATIVE_SIZE,
+                         cache.NEGATIVE_TTL, keep=0, missing=False)
+changes.subscribe(
+    None, lambda change: missing.invalidate((change.objtype, change.objkey)))
+
+
+def warm_dynamodb(ids):
+    """
+    Read these songs, so that boto3 has its credentials and pooled
+    DynamoDB connections before the first request needs them.
+    """
+    table_name = "Music-ZZ-REG-ID"
+    with timing.phase('dynamodb'):
+        dynamodb.batch_get_item(RequestItems={
+            table_name: {'Keys': [{'music_id': k} for k in ids]}})
+
+
+warmup.init_app(app, 'music', warm_dynamodb, 'file:resources/music.csv')
+
+
+def check_dynamodb():
+    """
+    Describe the Music table: free of read capacity, but it needs
+    working credentials and a connection to DynamoDB.
+    """
+    dynamodb.meta.client.describe_table(TableName="Music-ZZ-REG-ID")
+    return True
+
+
+probes.init_app(check_dynamodb)
+
 
 # Change the implementation of this: you should probably have a separate
 # driver class for interfacing with a db like dynamodb in a different file.
@@ -77,6 +159,8 @@ def update():
     table_name = objtype.capitalize()+"-ZZ-REG-ID"
     table_id = objtype + "_id"
     table = dynamodb.Table(table_name)
+    content['etag'] = new_etag()
+    idlists.encode_item(content)
     expression = 'SET '
     x = 1
     attrvals = {}
@@ -85,9 +169,14 @@ def update():
         attrvals[':val' + str(x)] = content[k]
         x += 1
     expression = expression[:-2]
-    response = table.update_item(Key={table_id: objkey},
-                                 UpdateExpression=expression,
-                                 ExpressionAttributeValues=attrvals)
+    with timing.phase('dynamodb'):
+        response = table.update_item(Key={table_id: objkey},
+                                     UpdateExpression=expression,
+                                     ExpressionAttributeValues=attrvals)
+    # update_item creates the item if it did not exist
+    missing.invalidate((objtype, objkey))
+    changes.publish(objtype, objkey, content['etag'])
+    hotkeys.record(objtype, 'write', objkey)
     return response
 
 
@@ -97,14 +186,121 @@ def read():
     # check header here
     objtype = urllib.parse.unquote_plus(request.args.get('objtype'))
     objkey = urllib.parse.unquote_plus(request.args.get('objkey'))
+    hotkeys.record(objtype, 'read', objkey)
+    response = missing.get((objtype, objkey))
+    if response is not None:
+        return response
     table_name = objtype.capitalize()+"-ZZ-REG-ID"
     table_id = objtype + "_id"
     table = dynamodb.Table(table_name)
-    response = table.query(Select='ALL_ATTRIBUTES',
-                           KeyConditionExpression=Key(table_id).eq(objkey))
+    with timing.phase('dynamodb'):
+        response = table.query(
+            Select='ALL_ATTRIBUTES',
+            KeyConditionExpression=Key(table_id).eq(objkey))
+    if response['Count'] == 0:
+        missing.put((objtype, objkey), response)
+    idlists.decode_items(response['Items'])
+    return response
+
+
+@bp.route('/query', methods=['GET'])
+def query():
+    """
+    Return the items whose attribute `attr` equals `value`.
+
+    The table must have a global secondary index on `attr`, named
+    `<attr>-index` unless `index` is given, so the lookup is a single
+    indexed query rather than a scan.
+
+    With `limit`, at most that many items are returned, and the
+    response has a `NextToken` if there may be more; pass it back as
+    `start` to get the next page.
+    """
+    headers = request.headers  # noqa: F841
+    # check header here
+    # request.args is already decoded; decoding `value` again would
+    # turn the '+' of an address such as a+b@example.com into a space
+    try:
+        objtype = request.args['objtype']
+        attr = request.args['attr']
+        value = request.args['value']
+    except KeyError:
+        return Response(json.dumps({"error": "error reading arguments"}),
+                        status=400,
+                        mimetype='application/json')
+    index = request.args.get('index', attr + '-index')
+    table_name = objtype.capitalize()+"-ZZ-REG-ID"
+    table = dynamodb.Table(table_name)
+    kwargs = {}
+    try:
+        if 'limit' in request.args:
+            kwargs['Limit'] = int(request.args['limit'])
+        if 'start' in request.args:
+            kwargs['ExclusiveStartKey'] = decode_cursor(request.args['start'])
+    except ValueError:
+        return Response(json.dumps({"error": "bad limit or start"}),
+                        status=400,
+                        mimetype='application/json')
+    with timing.phase('dynamodb'):
+        response = table.query(
+            IndexName=index,
+            KeyConditionExpression=Key(attr).eq(value),
+            **kwargs)
+    if 'LastEvaluatedKey' in response:
+        response['NextToken'] = encode_cursor(response['LastEvaluatedKey'])
+    idlists.decode_items(response['Items'])
     return response
 
 
+@bp.route('/batch_read', methods=['POST'])
+def batch_read():
+    """
+    Read many items of one type by key.
+
+    The body is {"objtype": ..., "objkeys": [...]}.  `Items` has one
+    entry per key, in the order given, with null for keys that do not
+    exist; `Missing` lists those keys.  A POST so that long key lists
+    do not overflow the request line, although it changes nothing.
+    """
+    headers = request.headers  # noqa: F841
+    # check header here
+    try:
+        content = request.get_json()
+        objtype = content['objtype']
+        objkeys = [str(k) for k in content['objkeys']]
+    except Exception:
+        return Response(json.dumps({"error": "error reading arguments"}),
+                        status=400,
+                        mimetype='application/json')
+    table_name = objtype.capitalize()+"-ZZ-REG-ID"
+    table_id = objtype + "_id"
+    for objkey in objkeys:
+        hotkeys.record(objtype, 'read', objkey)
+    # BatchGetItem refuses duplicate keys
+    keys = list(dict.fromkeys(objkeys))
+    found = {}
+    for i in range(0, len(keys), BATCH_SIZE):
+        request_items = {table_name: {
+            'Keys': [{table_id: k} for k in keys[i:i + BATCH_SIZE]]}}
+        for attempt in range(BATCH_RETRIES + 1):
+            with timing.phase('dynamodb'):
+                response = dynamodb.batch_get_item(
+                    RequestItems=request_items)
+            for item in response['Responses'].get(table_name, []):
+                found[item[table_id]] = idlists.decode_item(item)
+            request_items = response.get('UnprocessedKeys')
+            if not request_items:
+                break
+            time.sleep(BATCH_BACKOFF * 2 ** attempt)
+        else:
+            return Response(json.dumps({"error": "throttled"}),
+                            status=503,
+                            mimetype='application/json')
+    return {"Items": [found.get(k) for k in objkeys],
+            "Count": len(found),
+            "Missing": [k for k in keys if k not in found]}
+
+
 @bp.route('/write', methods=['POST'])
 def write():
     headers = request.headers  # noqa: F841
@@ -117,8 +313,14 @@ def write():
     del content['objtype']
     for k in content.keys():
         payload[k] = content[k]
+    payload['etag'] = new_etag()
+    idlists.encode_item(payload)
     table = dynamodb.Table(table_name)
-    response = table.put_item(Item=payload)
+    with timing.phase('dynamodb'):
+        response = table.put_item(Item=payload)
+    missing.invalidate((objtype, payload[table_id]))
+    changes.publish(objtype, payload[table_id], payload['etag'])
+    hotkeys.record(objtype, 'write', payload[table_id])
     returnval = ''
     if response['ResponseMetadata']['HTTPStatusCode'] != 200:
         returnval = {"message": "fail"}
@@ -126,11 +328,32 @@ def write():
         ({table_id: payload[table_id]}, returnval)['returnval' in globals()])
 
 
+def new_etag():
+    '''Return a new version token for an item that is being written'''
+    return uuid.uuid4().hex[:16]
+
+
 def decode_auth_token(token):
     '''Given an auth token in Base64 encoding, return the original string'''
     return base64.standard_b64decode(token).decode()
 
 
+def encode_cursor(key):
+    '''Return a query's LastEvaluatedKey as an opaque, URL-safe string'''
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor):
+    '''Inverse of `encode_cursor`; raise ValueError if malformed'''
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError(cursor)
+    if not isinstance(key, dict):
+        raise ValueError(cursor)
+    return key
+
+
 def load_auth(headers):
     '''Return True if caller authorized to do a `/load` '''
     global loader_token
@@ -180,14 +403,99 @@ def load():
     del content['uuid']
     for k in content.keys():
         payload[k] = content[k]
+    payload['etag'] = new_etag()
+    idlists.encode_item(payload)
     table = dynamodb.Table(table_name)
-    response = table.put_item(Item=payload)
+    with timing.phase('dynamodb'):
+        response = table.put_item(Item=payload)
+    missing.invalidate((objtype, payload[table_id]))
+    changes.publish(objtype, payload[table_id], payload['etag'])
+    hotkeys.record(objtype, 'write', payload[table_id])
     status = response['ResponseMetadata']['HTTPStatusCode']
     if status != 200:
         return json.dumps({"http_status_code": status})
     return json.dumps({table_id: payload[table_id]})
 
 
+@bp.route('/migrate', methods=['POST'])
+def migrate():
+    '''
+    Rewrite one page of stored items with their id lists in the given
+    encoding (see common/idlists.py)
+
+    The body is {"objtype": ..., "encoding": ..., "limit": ...,
+    "start": ...}; `encoding` defaults to ID_LIST_ENCODING and `limit`
+    to MIGRATE_PAGE items scanned.  Pass the `NextToken` of the
+    response back as `start` until there is none.  An item is only
+    rewritten if its lists have not changed since it was scanned, and
+    keeps its etag, as the items the API returns are the same.  The
+    caller must be authorized as for `/load`.
+    '''
+    if not load_auth(request.headers):
+        return Response(
+            json.dumps({"http_status_code": 401,
+                        "reason": "Invalid authorization for /migrate"}),
+            status=401,
+            mimetype='application/json')
+    try:
+        content = request.get_json()
+        objtype = content['objtype']
+        encoding = content.get('encoding', idlists.ENCODING)
+        if encoding not in (idlists.LIST, idlists.PACKED):
+            raise ValueError(encoding)
+        kwargs = {'Limit': int(content.get('limit', MIGRATE_PAGE))}
+        if content.get('start'):
+            kwargs['ExclusiveStartKey'] = decode_cursor(content['start'])
+    except Exception:
+        return Response(json.dumps({"error": "error reading arguments"}),
+                        status=400,
+                        mimetype='application/json')
+    table_name = objtype.capitalize()+"-ZZ-REG-ID"
+    table_id = objtype + "_id"
+    table = dynamodb.Table(table_name)
+    with timing.phase('dynamodb'):
+        response = table.scan(**kwargs)
+    migrated = 0
+    conflicts = 0
+    for item in response['Items']:
+        if not idlists.needs_migration(item, encoding):
+            continue
+        new = idlists.encode_item(dict(item), encoding)
+        sets = []
+        conditions = []
+        names = {}
+        values = {}
+        for i, attr in enumerate(idlists.ATTRS):
+            if attr not in item or new[attr] == item[attr]:
+                continue
+            names['#a' + str(i)] = attr
+            values[':new' + str(i)] = new[attr]
+            values[':old' + str(i)] = item[attr]
+            sets.append('#a{0} = :new{0}'.format(i))
+            conditions.append('#a{0} = :old{0}'.format(i))
+        try:
+            with timing.phase('dynamodb'):
+                table.update_item(Key={table_id: item[table_id]},
+                                  UpdateExpression='SET ' + ', '.join(sets),
+                                  ConditionExpression=' AND '.join(
+                                      conditions),
+                                  ExpressionAttributeNames=names,
+                                  ExpressionAttributeValues=values)
+            migrated += 1
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != \
+                    'ConditionalCheckFailedException':
+                raise
+            # Written since the scan, in the encoding of that write
+            conflicts += 1
+    result = {"Scanned": response['Count'],
+              "Migrated": migrated,
+              "Conflicts": conflicts}
+    if 'LastEvaluatedKey' in response:
+        result['NextToken'] = encode_cursor(response['LastEvaluatedKey'])
+    return result
+
+
 @bp.route('/delete', methods=['DELETE'])
 def delete():
     headers = request.headers  # noqa: F841
@@ -197,10 +505,27 @@ def delete():
     table_name = objtype.capitalize()+"-ZZ-REG-ID"
     table_id = objtype + "_id"
     table = dynamodb.Table(table_name)
-    response = table.delete_item(Key={table_id: objkey})
+    with timing.phase('dynamodb'):
+        response = table.delete_item(Key={table_id: objkey})
+    changes.publish(objtype, objkey)
+    hotkeys.record(objtype, 'write', objkey)
     return response
 
 
+@bp.route('/debug/hotkeys', methods=['GET'])
+@metrics.do_not_track()
+def debug_hotkeys():
+    """
+    Return this process's hottest keys per object type, for reads and
+    for writes, over the last HOTKEYS_WINDOW seconds.
+
+    `n` (default 10) sets the keys per list; `objtype` limits the
+    report to one type.
+    """
+    n = request.args.get('n', 10, type=int)
+    return hotkeys.report(n, request.args.get('objtype'))
+
+
 @bp.route('/health')
 @metrics.do_not_track()
 def health():
@@ -210,7 +535,7 @@ def health():
 @bp.route('/readiness')
 @metrics.do_not_track()
 def readiness():
-    return Response("", status=200, mimetype="application/json")
+    return probes.readiness()
 
 
 # All database calls will have this prefix.  Prometheus metric
@@ -224,5 +549,6 @@ if __name__ == '__main__':
         sys.exit(-1)
 
     p = int(sys.argv[1])
+    # Development server only; images run `python -m common.serve`.
     # Do not set debug=True---that will disable the Prometheus metrics
     app.run(host='0.0.0.0', port=p, threaded=True)
@@ -0,0 +1,17 @@
+#!/usr/bin/env bash
+# Mixed read/write workload; override the ratios with
+#   READ_PCT=50 WRITE_PCT=30 UPDATE_PCT=15 DELETE_PCT=5 ./gatling-1000-mixed.sh
+docker container run --detach --rm \
+  -v ${PWD}/gatling/results:/opt/gatling/results \
+  -v ${PWD}/gatling:/opt/gatling/user-files \
+  -v ${PWD}/gatling/target:/opt/gatling/target \
+  -e CLUSTER_IP=`tools/getip.sh kubectl istio-system svc/istio-ingressgateway` \
+  -e USERS=1000 \
+  -e READ_PCT=${READ_PCT:-70} \
+  -e WRITE_PCT=${WRITE_PCT:-15} \
+  -e UPDATE_PCT=${UPDATE_PCT:-10} \
+  -e DELETE_PCT=${DELETE_PCT:-5} \
+  -e SIM_NAME=MixedWorkloadSim \
+  --label gatling \
+  ghcr.io/scp-2021-jan-cmpt-756/gatling:3.4.2 \
+  -s proj756.MixedWorkloadSim
@@ -0,0 +1,167 @@
+package proj756
+
+import scala.concurrent.duration._
+
+import io.gatling.core.Predef._
+import io.gatling.http.Predef._
+
+/*
+  Mixed read/write workload.
+
+  Each virtual user repeatedly picks one operation at random, in the
+  proportions set by these environment variables (percent, default
+  70/15/10/5; they should add up to 100):
+
+    READ_PCT    read a song, user or playlist
+    WRITE_PCT   create a song or user, or run a whole playlist flow:
+                create a playlist of two songs, add a third, read it,
+                then remove the added song
+    UPDATE_PCT  update a song or user, or add then remove a song on an
+                existing playlist (the read-modify-write paths)
+    DELETE_PCT  create then delete a song, user or playlist
+
+  Deletes only remove items this simulation created, so the data loaded
+  from the Gatling resource files survives the run.  PAUSE_MS sets the
+  pause between operations (default 1000).
+*/
+object Mixed {
+
+  val readPct = Utility.envVarToInt("READ_PCT", 70).toDouble
+  val writePct = Utility.envVarToInt("WRITE_PCT", 15).toDouble
+  val updatePct = Utility.envVarToInt("UPDATE_PCT", 10).toDouble
+  val deletePct = Utility.envVarToInt("DELETE_PCT", 5).toDouble
+  val pauseMs = Utility.envVarToInt("PAUSE_MS", 1000)
+
+  val m_feeder = csv("music.csv").eager.random
+  val u_feeder = csv("users.csv").eager.random
+  val p_feeder = csv("playlist.csv").eager.random
+
+  // Feed a random song and keep its id under `key`, so that
+  // several songs can be used in one flow
+  def song(key: String) =
+    feed(m_feeder)
+    .exec(session => session.set(key, session("UUID").as[String]))
+
+  val createSong =
+    feed(m_feeder)
+    .exec(http("CreateSong")
+      .post("/api/v1/music/")
+      .body(StringBody("""{"Artist": "${Artist}", "SongTitle": "${SongTitle}"}""")).asJson
+      .check(jsonPath("$.music_id").saveAs("newMusicId")))
+
+  // The user service replaces an existing user with the same names and
+  // email, so new users get a unique email to leave the seeded ones be
+  val createUser =
+    feed(u_feeder)
+    .exec(session => session.set("uniq", java.util.UUID.randomUUID.toString))
+    .exec(http("CreateUser")
+      .post("/api/v1/user/")
+      .body(StringBody("""{"fname": "${fname}", "lname": "${lname}", "email": "gatling-${uniq}@example.com"}""")).asJson
+      .check(jsonPath("$.user_id").saveAs("newUserId")))
+
+  val createPlaylist =
+    exec(song("songA"))
+    .exec(song("songB"))
+    .exec(http("CreatePlaylist")
+      .post("/api/v1/playlist/")
+      .body(StringBody("""{"music_list": "${songA},${songB}"}""")).asJson
+      .check(jsonPath("$.playlist_id").saveAs("newPlaylistId")))
+
+  val read = randomSwitch(
+    34.0 -> feed(m_feeder).exec(http("ReadMusic")
+      .get("/api/v1/music/${UUID}")),
+    33.0 -> feed(u_feeder).exec(http("ReadUser")
+      .get("/api/v1/user/${UUID}")),
+    33.0 -> feed(p_feeder).exec(http("ReadPlaylist")
+      .get("/api/v1/playlist/${UUID}"))
+  )
+
+  // Create a playlist, add songs, read, remove
+  val playlistFlow =
+    exec(createPlaylist)
+    .exec(song("songC"))
+    .doIf(session => session("songC").as[String] != session("songA").as[String] &&
+                     session("songC").as[String] != session("songB").as[String]) {
+      exec(http("AddMusic")
+        .put("/api/v1/playlist/${newPlaylistId}/add/${songC}"))
+      .exec(http("ReadNewPlaylist")
+        .get("/api/v1/playlist/${newPlaylistId}"))
+      .exec(http("RemoveMusic")
+        .put("/api/v1/playlist/${newPlaylistId}/remove/${songC}"))
+    }
+
+  val write = randomSwitch(
+    34.0 -> createSong,
+    33.0 -> createUser,
+    33.0 -> playlistFlow
+  )
+
+  // Add a song to an existing playlist then take it out again.
+  // Both are read-modify-write sequences on a shared item.
+  val addRemoveExisting =
+    feed(p_feeder)
+    .exec(song("songC"))
+    .doIf(session => !session("music_list").as[String].contains(session("songC").as[String])) {
+      exec(http("AddMusicExisting")
+        .put("/api/v1/playlist/${UUID}/add/${songC}"))
+      .exec(http("RemoveMusicExisting")
+        .put("/api/v1/playlist/${UUID}/remove/${songC}"))
+    }
+
+  // Updates rewrite the values loaded from the resource files
+  val update = randomSwitch(
+    34.0 -> feed(m_feeder).exec(http("UpdateMusic")
+      .put("/api/v1/music/${UUID}")
+      .body(StringBody("""{"Artist": "${Artist}", "SongTitle": "${SongTitle}"}""")).asJson),
+    33.0 -> feed(u_feeder).exec(http("UpdateUser")
+      .put("/api/v1/user/${UUID}")
+      .body(StringBody("""{"fname": "${fname}", "lname": "${lname}", "email": "${email}"}""")).asJson),
+    33.0 -> addRemoveExisting
+  )
+
+  val delete = randomSwitch(
+    34.0 -> exec(createSong).exec(http("DeleteMusic")
+      .delete("/api/v1/music/${newMusicId}")),
+    33.0 -> exec(createUser).exec(http("DeleteUser")
+      .delete("/api/v1/user/${newUserId}")),
+    33.0 -> exec(createPlaylist).exec(http("DeletePlaylist")
+      .delete("/api/v1/playlist/${newPlaylistId}"))
+  )
+
+  val mixed = forever("i") {
+    randomSwitch(
+      readPct -> read,
+      writePct -> write,
+      updatePct -> update,
+      deletePct -> delete
+    )
+    .pause(pauseMs.milliseconds)
+  }
+}
+
+/*
+  USERS virtual users run the mixed workload, all started at once.
+*/
+class MixedWorkloadSim extends ReadTablesSim {
+  val scnMixed = scenario("MixedWorkload")
+    .exec(Mixed.mixed)
+
+  setUp(
+    scnMixed.inject(atOnceUsers(Utility.envVarToInt("USERS", 1)))
+  ).protocols(httpProtocol)
+}
+
+/*
+  Mixed workload, adding one user per 10 s up to USERS,
+  to find where the write paths start to saturate.
+*/
+class MixedWorkloadRampSim extends ReadTablesSim {
+  val scnMixed = scenario("MixedWorkloadRamp")
+    .exec(Mixed.mixed)
+
+  val users = Utility.envVarToInt("USERS", 10)
+
+  setUp(
+    scnMixed.inject(rampConcurrentUsers(1).to(users).during(10*users))
+  ).protocols(httpProtocol)
+}
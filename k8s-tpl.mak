@@ -33,6 +33,10 @@ APP_VER_TAG=v1
 S2_VER=v1
 LOADER_VER=v1
 
+# Code shared by all the services; the service images are built from
+# the top of the repo so that each one can copy `common/`
+COMMON_SRC=$(wildcard common/*.py)
+
 # Kubernetes parameters that most of the time will be unchanged
 # but which you might override as projects become sophisticated
 APP_NS=project-services
@@ -319,27 +323,27 @@ db: db-docker cluster/awscred.yaml cluster/dynamodb-service-entry.yaml cluster/d
 cri: s1-docker s2-docker playlist-docker db-docker
 
 # Build the s1 service
-s1-docker: s1/Dockerfile s1/app.py s1/requirements.txt
+s1-docker: s1/Dockerfile s1/app.py s1/requirements.txt $(COMMON_SRC)
 	make -f k8s.mak --no-print-directory registry-login
-	$(DK) build $(ARCH) -t $(CREG)/$(REGID)/cmpt756s1:$(APP_VER_TAG) s1
+	$(DK) build $(ARCH) -f s1/Dockerfile -t $(CREG)/$(REGID)/cmpt756s1:$(APP_VER_TAG) .
 	$(DK) push $(CREG)/$(REGID)/cmpt756s1:$(APP_VER_TAG)
 
 # Build the s2 service
-s2-docker: s2/$(S2_VER)/Dockerfile s2/$(S2_VER)/app.py s2/$(S2_VER)/requirements.txt
+s2-docker: s2/$(S2_VER)/Dockerfile s2/$(S2_VER)/app.py s2/$(S2_VER)/requirements.txt $(COMMON_SRC)
 	make -f k8s.mak --no-print-directory registry-login
-	$(DK) build $(ARCH) -t $(CREG)/$(REGID)/cmpt756s2:$(S2_VER) s2/$(S2_VER)
+	$(DK) build $(ARCH) -f s2/$(S2_VER)/Dockerfile -t $(CREG)/$(REGID)/cmpt756s2:$(S2_VER) .
 	$(DK) push $(CREG)/$(REGID)/cmpt756s2:$(S2_VER)
 
 # Build the playlist service
-playlist-docker: playlist/Dockerfile playlist/app.py playlist/requirements.txt
+playlist-docker: playlist/Dockerfile playlist/app.py playlist/requirements.txt $(COMMON_SRC)
 	make -f k8s.mak --no-print-directory registry-login
-	$(DK) build $(ARCH) -t $(CREG)/$(REGID)/playlist:$(APP_VER_TAG) playlist
+	$(DK) build $(ARCH) -f playlist/Dockerfile -t $(CREG)/$(REGID)/playlist:$(APP_VER_TAG) .
 	$(DK) push $(CREG)/$(REGID)/playlist:$(APP_VER_TAG)
 
 # Build the db service
-db-docker: db/Dockerfile db/app.py db/requirements.txt
+db-docker: db/Dockerfile db/app.py db/requirements.txt $(COMMON_SRC)
 	make -f k8s.mak --no-print-directory registry-login
-	$(DK) build $(ARCH) -t $(CREG)/$(REGID)/cmpt756db:$(APP_VER_TAG) db
+	$(DK) build $(ARCH) -f db/Dockerfile -t $(CREG)/$(REGID)/cmpt756db:$(APP_VER_TAG) .
 	$(DK) push $(CREG)/$(REGID)/cmpt756db:$(APP_VER_TAG)
 
 # Build the loader
@@ -363,6 +367,12 @@ image: showcontext registry-login
 	cat __content
 	rm __content __header
 
+# Scale the services on saturation rather than CPU; needs prometheus-adapter
+# (make -f obs.mak install-adapter)
+hpa-saturation: cluster/saturation-hpa.yaml
+	$(KC) -n $(APP_NS) delete hpa cmpt756s1 cmpt756s2-$(S2_VER) playlist cmpt756db --ignore-not-found=true
+	$(KC) -n $(APP_NS) apply -f $<
+
 # Create a scalable target for DynamoDB tables
 ac-db: cluster/scaling-policy.json
 	$(AWS) application-autoscaling register-scalable-target \
@@ -423,14 +433,14 @@ provision-abort: cluster/db-vs-abort.yaml cluster/playlist-vs-abort.yaml
 provision-circuit: cluster/playlist-vs-circuit.yaml
 	$(KC) -n $(APP_NS) apply -f cluster/playlist-vs-circuit.yaml
 
-playlist-1: playlist/Dockerfile playlist/app.py playlist/requirements.txt
+playlist-1: playlist/Dockerfile playlist/app.py playlist/requirements.txt $(COMMON_SRC)
 	make -f k8s.mak --no-print-directory registry-login
-	$(DK) build $(ARCH) -t $(CREG)/$(REGID)/playlist:v1 playlist
+	$(DK) build $(ARCH) -f playlist/Dockerfile -t $(CREG)/$(REGID)/playlist:v1 .
 	$(DK) push $(CREG)/$(REGID)/playlist:v1
 
-playlist-2: playlist/v2/Dockerfile playlist/v2/app.py playlist/v2/requirements.txt
+playlist-2: playlist/v2/Dockerfile playlist/v2/app.py playlist/v2/requirements.txt $(COMMON_SRC)
 	make -f k8s.mak --no-print-directory registry-login
-	$(DK) build $(ARCH) -t $(CREG)/$(REGID)/playlist:v2 playlist/v2
+	$(DK) build $(ARCH) -f playlist/v2/Dockerfile -t $(CREG)/$(REGID)/playlist:v2 .
 	$(DK) push $(CREG)/$(REGID)/playlist:v2
 
 rollout-playlist-1: playlist-1 cluster/playlist1.yaml
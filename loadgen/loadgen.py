@@ -0,0 +1,400 @@
+"""
+SFU CMPT 756
+Open-loop load generator.
+
+The Gatling simulations in `gatling/simulations/proj756` are closed
+loops: each virtual user waits for its response before pausing and
+sending the next request.  When a service slows down, the offered load
+drops with it and the reported latencies hide the real tail
+("coordinated omission").
+
+This generator is open-loop.  Requests are scheduled at a fixed arrival
+rate that does not depend on response times, and every latency is
+measured from the *intended* send time of the request, not from the
+moment a worker thread got around to sending it.  Queueing inside the
+generator therefore shows up as latency, exactly as it would for real
+clients arriving at that rate.
+
+Load profiles:
+    --rate R --duration S      constant R requests/s for S seconds
+    --steps R1:S1,R2:S2,...    a sequence of constant-rate stages
+    --ramp START:END:INC       stages START, START+INC, ... END requests/s,
+                               each lasting --step-duration seconds
+
+Each stage is reported separately.  The first stage whose achieved
+throughput falls short of the offered rate, or whose p99 exceeds
+--slo-ms, is reported as the saturation point of the service.
+"""
+
+# Standard library modules
+import argparse
+import concurrent.futures
+import csv
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+# Installed packages
+import requests
+
+import simplejson as json
+
+# The services check only that we pass an authorization,
+# not whether it's valid
+DEFAULT_AUTH = 'Bearer A'
+
+# Time left before the caller gives up (see common/deadline.py)
+DEADLINE_HEADER = 'x-request-timeout-ms'
+
+# Default id files, relative to the top of the repo
+RESOURCE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'gatling', 'resources')
+ID_FILES = {
+    'music': 'music.csv',
+    'user': 'users.csv',
+    'playlist': 'playlist.csv',
+}
+
+# A stage is saturated if it completes fewer than this fraction
+# of the requests it offered per second
+THROUGHPUT_TOLERANCE = 0.95
+
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+def parse_args():
+    argp = argparse.ArgumentParser(
+        'loadgen',
+        description='Open-loop constant-arrival-rate load generator'
+        )
+    argp.add_argument(
+        'name',
+        help="DNS name or IP address of server"
+        )
+    argp.add_argument(
+        'port',
+        type=int,
+        help="Port number of server"
+        )
+    argp.add_argument(
+        'service',
+        choices=sorted(ID_FILES.keys()),
+        help="Microservice name"
+        )
+    argp.add_argument(
+        '--ids',
+        help="CSV file with a UUID column of ids to read "
+             "(default: the Gatling resource file for the service)"
+        )
+    argp.add_argument(
+        '--rate',
+        type=float,
+        default=10.0,
+        help="Constant arrival rate, requests/s (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--duration',
+        type=float,
+        default=30.0,
+        help="Duration of a constant-rate run, s (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--steps',
+        help="Comma-separated RATE:SECONDS stages, e.g. 50:30,100:30"
+        )
+    argp.add_argument(
+        '--ramp',
+        help="START:END:INCREMENT arrival rates for a stepped ramp"
+        )
+    argp.add_argument(
+        '--step-duration',
+        type=float,
+        default=30.0,
+        help="Duration of each --ramp stage, s (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--poisson',
+        action='store_true',
+        help="Use exponential (Poisson) rather than uniform interarrivals"
+        )
+    argp.add_argument(
+        '--max-workers',
+        type=int,
+        default=512,
+        help="Maximum concurrent requests in flight (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--timeout',
+        type=float,
+        default=10.0,
+        help="Per-request timeout, s (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--send-deadline',
+        action='store_true',
+        help="Tell the service how long is left of the timeout, so it "
+        "can stop work on requests the generator has given up on"
+        )
+    argp.add_argument(
+        '--slo-ms',
+        type=float,
+        default=None,
+        help="p99 latency objective; stages above it count as saturated"
+        )
+    argp.add_argument(
+        '--stop-on-saturation',
+        action='store_true',
+        help="Stop after the first saturated stage"
+        )
+    argp.add_argument(
+        '--output',
+        help="Write per-stage results to this JSON file"
+        )
+    args = argp.parse_args()
+    try:
+        args.stages = parse_stages(args)
+    except ValueError as e:
+        argp.error("invalid load profile: {}".format(e))
+    return args
+
+
+def get_url(name, port, service):
+    return "http://{}:{}/api/v1/{}/".format(name, port, service)
+
+
+def read_ids(path):
+    """Return the UUID column of a Gatling-style resource file."""
+    with open(path, 'r') as inp:
+        rdr = csv.DictReader(inp)
+        return [row['UUID'].strip() for row in rdr]
+
+
+def parse_stages(args):
+    """
+    Return the load profile as a list of (rate, duration) stages.
+
+    --steps takes precedence over --ramp, which takes precedence
+    over the constant --rate/--duration profile.  Raise ValueError
+    if the profile is malformed or has a rate that is not positive.
+    """
+    if args.steps:
+        stages = []
+        for step in args.steps.split(','):
+            rate, duration = step.split(':')
+            if float(rate) <= 0:
+                raise ValueError("step rates must be positive")
+            stages.append((float(rate), float(duration)))
+        return stages
+    if args.ramp:
+        start, end, inc = [float(v) for v in args.ramp.split(':')]
+        if inc <= 0:
+            raise ValueError("ramp increment must be positive")
+        if start <= 0:
+            raise ValueError("ramp start must be positive")
+        if end < start:
+            raise ValueError("ramp end must not be below its start")
+        stages = []
+        rate = start
+        while rate <= end + 1e-9:
+            stages.append((rate, args.step_duration))
+            rate += inc
+        return stages
+    if args.rate <= 0:
+        raise ValueError("rate must be positive")
+    return [(args.rate, args.duration)]
+
+
+def percentile(sorted_vals, pct):
+    """Nearest-rank percentile of an already-sorted list."""
+    if not sorted_vals:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(sorted_vals))) - 1
+    return sorted_vals[max(0, min(rank, len(sorted_vals) - 1))]
+
+
+class Stage:
+    """Results for one constant-rate stage of the profile."""
+
+    def __init__(self, rate, duration):
+        self.rate = rate
+        self.duration = duration
+        self.sent = 0
+        self.latencies = []
+        self.errors = 0
+        self.first_intended = None
+        self.last_done = None
+        self.lock = threading.Lock()
+
+    def record(self, intended, done, ok):
+        with self.lock:
+            self.latencies.append((done - intended) * 1000.0)
+            if not ok:
+                self.errors += 1
+            if self.last_done is None or done > self.last_done:
+                self.last_done = done
+
+    def summary(self, slo_ms):
+        lat = sorted(self.latencies)
+        completed = len(lat)
+        elapsed = 0.0
+        if self.first_intended is not None and self.last_done is not None:
+            elapsed = max(self.last_done - self.first_intended, self.duration)
+        ok = completed - self.errors
+        achieved = ok / elapsed if elapsed > 0 else 0.0
+        pcts = {str(p): percentile(lat, p) for p in PERCENTILES}
+        saturated = achieved < THROUGHPUT_TOLERANCE * self.rate
+        if slo_ms is not None and pcts['99'] is not None:
+            saturated = saturated or pcts['99'] > slo_ms
+        return {
+            'offered_rps': self.rate,
+            'duration_s': self.duration,
+            'sent': self.sent,
+            'completed': completed,
+            'errors': self.errors,
+            'achieved_rps': achieved,
+            'latency_ms': pcts,
+            'max_ms': lat[-1] if lat else None,
+            'saturated': saturated,
+        }
+
+
+class LoadGenerator:
+    """
+    Issue GETs for random ids at the arrival times of a load profile.
+
+    A single dispatcher thread computes the intended send time of every
+    request and hands it to a worker pool.  The worker measures latency
+    from the intended time, so any delay in the dispatcher or the pool
+    is charged to the request rather than silently dropped.
+    """
+
+    def __init__(self, url, ids, max_workers, timeout, poisson,
+                 send_deadline=False):
+        self.url = url
+        self.ids = ids
+        self.timeout = timeout
+        self.send_deadline = send_deadline
+        self.poisson = poisson
+        self.local = threading.local()
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers)
+
+    def session(self):
+        """Return a keep-alive session private to the calling thread."""
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+            self.local.session.headers['Authorization'] = DEFAULT_AUTH
+        return self.local.session
+
+    def issue(self, stage, intended, obj_id):
+        ok = False
+        headers = None
+        if self.send_deadline:
+            # The timeout runs from the intended send time
+            left = self.timeout - (time.perf_counter() - intended)
+            headers = {DEADLINE_HEADER: str(max(int(left * 1000), 0))}
+        try:
+            r = self.session().get(self.url + obj_id, headers=headers,
+                                   timeout=self.timeout)
+            ok = r.status_code == 200
+        except requests.exceptions.RequestException:
+            pass
+        stage.record(intended, time.perf_counter(), ok)
+
+    def run_stage(self, stage):
+        """Dispatch one stage; return once every request has been sent."""
+        start = time.perf_counter()
+        end = start + stage.duration
+        stage.first_intended = start
+        intended = start
+        futures = []
+        while intended < end:
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(self.pool.submit(
+                self.issue, stage, intended, random.choice(self.ids)))
+            stage.sent += 1
+            if self.poisson:
+                intended += random.expovariate(stage.rate)
+            else:
+                intended += 1.0 / stage.rate
+        return futures
+
+    def run(self, stages, slo_ms, stop_on_saturation):
+        results = []
+        for stage in stages:
+            futures = self.run_stage(stage)
+            concurrent.futures.wait(futures)
+            summary = stage.summary(slo_ms)
+            results.append(summary)
+            print_summary(summary)
+            if stop_on_saturation and summary['saturated']:
+                break
+        self.pool.shutdown()
+        return results
+
+
+def fmt_ms(val):
+    return '{:9.1f}'.format(val) if val is not None else '        -'
+
+
+def print_header():
+    print('{:>9} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}  {}'.format(
+        'offered', 'achieved', 'errors',
+        'p50 ms', 'p90 ms', 'p99 ms', 'p99.9 ms', 'max ms', ''))
+
+
+def print_summary(s):
+    lat = s['latency_ms']
+    print('{:9.1f} {:9.1f} {:7d} {} {} {} {} {}  {}'.format(
+        s['offered_rps'], s['achieved_rps'], s['errors'],
+        fmt_ms(lat['50']), fmt_ms(lat['90']), fmt_ms(lat['99']),
+        fmt_ms(lat['99.9']), fmt_ms(s['max_ms']),
+        'SATURATED' if s['saturated'] else ''))
+    sys.stdout.flush()
+
+
+def saturation_point(results):
+    """Return the offered rate of the first saturated stage, or None."""
+    for s in results:
+        if s['saturated']:
+            return s['offered_rps']
+    return None
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    ids_path = args.ids or os.path.join(RESOURCE_DIR, ID_FILES[args.service])
+    ids = read_ids(ids_path)
+    if len(ids) == 0:
+        print("No ids found in {}".format(ids_path))
+        sys.exit(1)
+    stages = [Stage(rate, duration) for rate, duration in args.stages]
+
+    gen = LoadGenerator(get_url(args.name, args.port, args.service),
+                        ids,
+                        args.max_workers,
+                        args.timeout,
+                        args.poisson,
+                        args.send_deadline)
+    print_header()
+    results = gen.run(stages, args.slo_ms, args.stop_on_saturation)
+
+    sat = saturation_point(results)
+    if sat is None:
+        print("No saturation observed up to {:.1f} requests/s".format(
+            results[-1]['offered_rps']))
+    else:
+        print("Saturation at {:.1f} requests/s offered".format(sat))
+
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({'service': args.service,
+                       'url': gen.url,
+                       'stages': results,
+                       'saturation_rps': sat},
+                      out, indent=2)
@@ -0,0 +1,248 @@
+"""
+SFU CMPT 756
+Replay recorded traffic.
+
+Re-issue the requests in one or more recordings made by the services
+(see `common/recorder.py`) against any environment, then compare the
+replayed latencies and status codes with the recorded ones, route by
+route.
+
+Speeds:
+    --speed 1      original timing
+    --speed N      original timing compressed N times
+    --speed max    as fast as possible
+
+At a finite speed each request is sent at its (scaled) recorded offset
+from the start of the recording, independently of earlier responses,
+so the overlap between requests---the recorded concurrency---is kept.
+At `max` speed the requests are sent in recorded order by as many
+workers as the recording's peak concurrency (or --concurrency).
+"""
+
+# Standard library modules
+import argparse
+import concurrent.futures
+import sys
+import threading
+import time
+
+# Installed packages
+import requests
+
+import simplejson as json
+
+# Local modules
+from loadgen import DEFAULT_AUTH
+from loadgen import fmt_ms
+from loadgen import percentile
+
+
+def parse_args():
+    argp = argparse.ArgumentParser(
+        'replay',
+        description='Replay recorded service traffic'
+        )
+    argp.add_argument(
+        'name',
+        help="DNS name or IP address of server"
+        )
+    argp.add_argument(
+        'port',
+        type=int,
+        help="Port number of server"
+        )
+    argp.add_argument(
+        'recordings',
+        nargs='+',
+        help="JSONL recordings written by the services"
+        )
+    argp.add_argument(
+        '--speed',
+        default='1',
+        help="Replay speed: a multiple of recorded time, or 'max' "
+             "(default: %(default)s)"
+        )
+    argp.add_argument(
+        '--concurrency',
+        type=int,
+        default=None,
+        help="Workers for --speed max (default: recorded peak concurrency)"
+        )
+    argp.add_argument(
+        '--max-workers',
+        type=int,
+        default=512,
+        help="Maximum concurrent requests in flight (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--timeout',
+        type=float,
+        default=10.0,
+        help="Per-request timeout, s (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--output',
+        help="Write per-route results to this JSON file"
+        )
+    return argp.parse_args()
+
+
+def read_recordings(paths):
+    """Return the records of all recordings, in order of start time."""
+    records = []
+    for path in paths:
+        with open(path, 'r') as inp:
+            for line in inp:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r['ts'])
+    return records
+
+
+def peak_concurrency(records):
+    """Largest number of recorded requests in progress at one time."""
+    events = []
+    for r in records:
+        events.append((r['ts'], 1))
+        events.append((r['ts'] + r['duration_ms'] / 1000.0, -1))
+    # At equal times, process ends before starts
+    events.sort()
+    peak = current = 0
+    for _, delta in events:
+        current += delta
+        peak = max(peak, current)
+    return max(peak, 1)
+
+
+def route_key(record):
+    return '{} {}'.format(record['method'],
+                          record.get('route') or record['path'])
+
+
+class Replayer:
+    """Send recorded requests and collect their latencies by route."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+            self.local.session.headers['Authorization'] = DEFAULT_AUTH
+        return self.local.session
+
+    def issue(self, record, intended=None):
+        url = self.base_url + record['path']
+        if record.get('query'):
+            url += '?' + record['query']
+        if intended is None:
+            intended = time.perf_counter()
+        try:
+            r = self.session().request(record['method'],
+                                       url,
+                                       json=record.get('body'),
+                                       timeout=self.timeout)
+            status = r.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        latency = (time.perf_counter() - intended) * 1000.0
+        with self.lock:
+            res = self.results.setdefault(route_key(record), {
+                'recorded': [], 'replayed': [], 'status_mismatches': 0})
+            res['recorded'].append(record['duration_ms'])
+            res['replayed'].append(latency)
+            if status != record['status']:
+                res['status_mismatches'] += 1
+
+    def replay_timed(self, records, speed, max_workers):
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        t0 = records[0]['ts']
+        start = time.perf_counter()
+        futures = []
+        for record in records:
+            intended = start + (record['ts'] - t0) / speed
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(self.issue, record, intended))
+        concurrent.futures.wait(futures)
+        pool.shutdown()
+
+    def replay_max(self, records, concurrency):
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=concurrency) as pool:
+            list(pool.map(self.issue, records))
+
+    def summary(self):
+        routes = {}
+        for key, res in sorted(self.results.items()):
+            rec = sorted(res['recorded'])
+            rep = sorted(res['replayed'])
+            routes[key] = {
+                'count': len(rec),
+                'status_mismatches': res['status_mismatches'],
+                'recorded_ms': {'50': percentile(rec, 50),
+                                '99': percentile(rec, 99)},
+                'replayed_ms': {'50': percentile(rep, 50),
+                                '99': percentile(rep, 99)},
+            }
+        return routes
+
+
+def fmt_diff(recorded, replayed):
+    if recorded is None or replayed is None:
+        return '        -'
+    return '{:+9.1f}'.format(replayed - recorded)
+
+
+def print_summary(routes):
+    print('{:>7} {:>7}  {:>9} {:>9} {:>9}  {:>9} {:>9} {:>9}  {}'.format(
+        'count', 'status', 'rec p50', 'rep p50', 'diff',
+        'rec p99', 'rep p99', 'diff', 'route'))
+    for key, s in routes.items():
+        rec = s['recorded_ms']
+        rep = s['replayed_ms']
+        print('{:7d} {:7d}  {} {} {}  {} {} {}  {}'.format(
+            s['count'], s['status_mismatches'],
+            fmt_ms(rec['50']), fmt_ms(rep['50']),
+            fmt_diff(rec['50'], rep['50']),
+            fmt_ms(rec['99']), fmt_ms(rep['99']),
+            fmt_diff(rec['99'], rep['99']),
+            key))
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    records = read_recordings(args.recordings)
+    if len(records) == 0:
+        print("No records to replay")
+        sys.exit(1)
+
+    replayer = Replayer("http://{}:{}".format(args.name, args.port),
+                        args.timeout)
+    if args.speed == 'max':
+        concurrency = args.concurrency or peak_concurrency(records)
+        print("Replaying {} requests as fast as possible, "
+              "{} concurrent".format(len(records), concurrency))
+        replayer.replay_max(records, concurrency)
+    else:
+        try:
+            speed = float(args.speed)
+        except ValueError:
+            speed = 0.0
+        if speed <= 0:
+            print("--speed must be a positive number or 'max'")
+            sys.exit(1)
+        print("Replaying {} requests at {}x".format(len(records), speed))
+        replayer.replay_timed(records, speed, args.max_workers)
+
+    routes = replayer.summary()
+    print_summary(routes)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump({'speed': args.speed, 'routes': routes}, out, indent=2)
@@ -68,6 +68,14 @@ uninstall-kiali:
 status-kiali:
 	$(KC) get -n $(ISTIO_NS) pod -l 'app=kiali'
 
+# prometheus-adapter serves the services' saturation metrics to the HPAs
+# in cluster/saturation-hpa.yaml (see `make -f k8s.mak hpa-saturation`)
+install-adapter:
+	$(HELM) install prometheus-adapter -f cluster/prometheus-adapter-values.yaml --namespace $(ISTIO_NS) prometheus-community/prometheus-adapter || true
+
+uninstall-adapter:
+	$(HELM) uninstall prometheus-adapter --namespace $(ISTIO_NS)
+
 promport:
 	$(KC) describe pods $(PROMETHEUSPOD) -n $(ISTIO_NS)
 
@@ -5,19 +5,42 @@ import sys
 # Installed packages
 from flask import Blueprint
 from flask import Flask
+from flask import g
 from flask import request
 from flask import Response
 
-from prometheus_flask_exporter import PrometheusMetrics
-
-import requests
-
 import simplejson as json
 
+# Local modules
+from common import auth
+from common import cache
+from common import changes
+from common import dbclient
+from common import deadline
+from common import limiter
+from common import probes
+from common import recorder
+from common import saturation
+from common import startup
+from common import timing
+from common import tracing
+from common import warmup
+from common.metrics import init_metrics
+
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+metrics = init_metrics(app)
 metrics.info('app_info', 'Playlist process')
+limiter.init_app(app)
+startup.init_app(app)
+saturation.init_app(app)
+recorder.init_app(app, 'playlist')
+timing.init_app(app)
+deadline.init_app(app)
+dbclient.init_app(app)
+changes.init_app(app)
+auth.init_app(app)
+tracing.init_app(app, 'playlist')
 
 db = {
     "name": "http://cmpt756db:30002/api/v1/datastore",
@@ -25,11 +48,31 @@ db = {
         "read",
         "write",
         "delete",
-        "update"
+        "update",
+        "batch_read"
     ]
 }
 bp = Blueprint('app', __name__)
 
+playlists = cache.TTLCache('playlist')
+changes.subscribe('playlist',
+                  lambda change: playlists.invalidate(change.objkey))
+
+
+def warm_playlists(ids):
+    """Cache the playlists with these ids, from one batched read."""
+    url = db['name'] + '/' + db['endpoint'][4]
+    response = dbclient.post(url,
+                             json={"objtype": "playlist", "objkeys": ids})
+    for item in response.json()['Items']:
+        if item is not None:
+            cache.prime(playlists, item['playlist_id'], item)
+
+
+warmup.init_app(app, 'playlist', warm_playlists,
+                'file:resources/playlist.csv')
+probes.init_app(lambda: dbclient.ping(db['name'] + '/health'))
+
 
 @bp.route('/hello', methods=['GET'])
 @metrics.do_not_track()
@@ -48,7 +91,7 @@ def health():
 @bp.route('/readiness')
 @metrics.do_not_track()
 def readiness():
-    return Response("", status=200, mimetype="application/json")
+    return probes.readiness()
 
 
 @bp.route('/', methods=['GET'])
@@ -82,7 +125,7 @@ def create_playlist():
         return json.dumps({"message": "error reading arguments"})
 
     for music_id in music_list:
-        music_get = requests.get(
+        music_get = dbclient.get(
             db['name'] + '/' + db['endpoint'][0],
             params={"objtype": "music", "objkey": music_id},
             headers={'Authorization': "test"}
@@ -94,8 +137,13 @@ def create_playlist():
         
 
     payload = {"objtype": "playlist", "music_list": music_list}
+    # Verified JWTs carry the caller's user id; opaque tokens do not, and
+    # their playlists are left out of the owner index
+    owner = g.get('user_id')
+    if owner is not None:
+        payload['owner'] = owner
     url = db['name'] + '/' + db['endpoint'][1]
-    response = requests.post(
+    response = dbclient.post(
         url,
         json=payload,
         headers={'Authorization': headers['Authorization']})
@@ -114,11 +162,11 @@ def get_playlist(playlist_id):
     
     payload = {"objtype": "playlist", "objkey": playlist_id}
     url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
+    body = cache.read(playlists, playlist_id, lambda: dbclient.get(
         url,
         params=payload,
-        headers={'Authorization': headers['Authorization']})
-    return (response.json())
+        headers={'Authorization': headers['Authorization']}))
+    return cache.respond(body)
 
 
 @bp.route('/<playlist_id>/add/<music_id>', methods=['PUT'])
@@ -132,7 +180,7 @@ def addmusic_playlist(playlist_id, music_id):
 
     payload = {"objtype": "playlist", "objkey": playlist_id}
     url = db['name'] + '/' + db['endpoint'][0]
-    playlist_res = requests.get(
+    playlist_res = dbclient.get(
         url,
         params=payload,
         headers={'Authorization': headers['Authorization']})
@@ -147,7 +195,7 @@ def addmusic_playlist(playlist_id, music_id):
     playlist = playlist_json["Items"][0]
     music_list = playlist["music_list"]
 
-    new_music_res = requests.get(
+    new_music_res = dbclient.get(
             db['name'] + '/' + db['endpoint'][0],
             params={"objtype": "music", "objkey": music_id},
             headers={'Authorization': headers['Authorization']}
@@ -170,11 +218,12 @@ def addmusic_playlist(playlist_id, music_id):
         "objkey": playlist_id
     }
     url = db['name'] + '/' + db['endpoint'][3]
-    response = requests.put(
+    response = dbclient.put(
         url,
         params=payload,
         json={"music_list": music_list})
 
+    playlists.invalidate(playlist_id)
     return (response.json())
 
 
@@ -189,7 +238,7 @@ def removemusic_playlist(playlist_id, music_id):
 
     payload = {"objtype": "playlist", "objkey": playlist_id}
     url = db['name'] + '/' + db['endpoint'][0]
-    playlist_res = requests.get(
+    playlist_res = dbclient.get(
         url,
         params=payload,
         headers={'Authorization': headers['Authorization']})
@@ -204,7 +253,7 @@ def removemusic_playlist(playlist_id, music_id):
     playlist = playlist_json["Items"][0]
     music_list = playlist["music_list"]
 
-    new_music_res = requests.get(
+    new_music_res = dbclient.get(
             db['name'] + '/' + db['endpoint'][0],
             params={"objtype": "music", "objkey": music_id},
             headers={'Authorization': headers['Authorization']}
@@ -228,11 +277,12 @@ def removemusic_playlist(playlist_id, music_id):
         "objkey": playlist_id
     }
     url = db['name'] + '/' + db['endpoint'][3]
-    response = requests.put(
+    response = dbclient.put(
         url,
         params=payload,
         json={"music_list": music_list})
 
+    playlists.invalidate(playlist_id)
     return (response.json())
 
 
@@ -247,10 +297,11 @@ def delete_playlist(playlist_id):
     
     payload = {"objtype": "playlist", "objkey": playlist_id}
     url = db['name'] + '/' + db['endpoint'][2]
-    response = requests.delete(
+    response = dbclient.delete(
         url,
         params=payload,
         headers={'Authorization': headers['Authorization']})
+    playlists.invalidate(playlist_id)
     return (response.json())
 
 
@@ -262,5 +313,6 @@ if __name__ == '__main__':
         sys.exit(-1)
 
     p = int(sys.argv[1])
+    # Development server only; images run `python -m common.serve`.
     # Do not set debug=True---that will disable the Prometheus metrics
     app.run(host='0.0.0.0', port=p, threaded=True)
@@ -11,37 +11,85 @@ import time
 # Installed packages
 from flask import Blueprint
 from flask import Flask
+from flask import g
 from flask import request
 from flask import Response
 
-import jwt
-
-from prometheus_flask_exporter import PrometheusMetrics
-
-import requests
-
 import simplejson as json
 
+# Local modules
+from common import auth
+from common import cache
+from common import changes
+from common import dbclient
+from common import deadline
+from common import limiter
+from common import probes
+from common import recorder
+from common import saturation
+from common import startup
+from common import timing
+from common import tracing
+from common import warmup
+from common.metrics import init_metrics
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+metrics = init_metrics(app)
 metrics.info('app_info', 'User process')
+limiter.init_app(app)
+startup.init_app(app)
+saturation.init_app(app)
+recorder.init_app(app, 'user')
+timing.init_app(app)
+deadline.init_app(app)
+dbclient.init_app(app)
+changes.init_app(app)
+auth.init_app(app)
+tracing.init_app(app, 'user')
 
 bp = Blueprint('app', __name__)
 
+# Most ids accepted by one multi-get
+MAX_IDS = 500
+
+# Playlists returned per page by `list_playlists`
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+users = cache.TTLCache('user')
+changes.subscribe('user',
+                  lambda change: users.invalidate(change.objkey))
+
 db = {
     "name": "http://cmpt756db:30002/api/v1/datastore",
     "endpoint": [
         "read",
         "write",
         "delete",
-        "update"
+        "update",
+        "query",
+        "batch_read"
     ]
 }
 
 
+def warm_users(ids):
+    """Cache the users with these ids, from one batched read."""
+    url = db['name'] + '/' + db['endpoint'][5]
+    response = dbclient.post(url,
+                             json={"objtype": "user", "objkeys": ids})
+    for item in response.json()['Items']:
+        if item is not None:
+            cache.prime(users, item['user_id'], item)
+
+
+warmup.init_app(app, 'user', warm_users, 'file:resources/users.csv')
+probes.init_app(lambda: dbclient.ping(db['name'] + '/health'))
+
+
 @bp.route('/hello', methods=['GET'])
 @metrics.do_not_track()
 def hello_world():
@@ -59,11 +107,10 @@ def health():
 @bp.route('/readiness')
 @metrics.do_not_track()
 def readiness():
-    return Response("", status=200, mimetype="application/json")
+    return probes.readiness()
 
 
 @bp.route('/', methods=['GET'])
-@metrics.do_not_track()
 def list_all():
     headers = request.headers
     # check header here
@@ -71,8 +118,66 @@ def list_all():
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
+    if 'ids' in request.args:
+        return get_many(request.args['ids'].split(','))
+    email = request.args.get('email')
+    if email is None:
+        return {}
+    response = find_by_email(email)
+    return Response(response.content,
+                    status=response.status_code,
+                    mimetype='application/json')
+
+
+def find_by_email(email):
+    """Query the db service's email index for users with `email`."""
+    url = db['name'] + '/' + db['endpoint'][4]
+    return dbclient.get(
+        url,
+        params={"objtype": "user", "attr": "email", "value": email})
 
-    return {}
+
+@bp.route('/batch', methods=['POST'])
+def batch_get():
+    """Like `GET /?ids=`, for lists too long for a URL: {"ids": [...]}."""
+    headers = request.headers
+    # check header here
+    if 'Authorization' not in headers:
+        return Response(json.dumps({"error": "missing auth"}),
+                        status=401,
+                        mimetype='application/json')
+    try:
+        ids = request.get_json()['ids']
+    except Exception:
+        return json.dumps({"message": "error reading arguments"})
+    return get_many(ids)
+
+
+def get_many(ids):
+    """
+    Return the users with these ids, from one datastore read.
+
+    The items are in the order of `ids`; an id with no user gets
+    {"user_id": id, "error": "not found"} in its place.
+    """
+    ids = [str(i).strip() for i in ids if str(i).strip()]
+    if not ids or len(ids) > MAX_IDS:
+        return Response(
+            json.dumps({"error": "need 1 to {} ids".format(MAX_IDS)}),
+            status=400,
+            mimetype='application/json')
+    url = db['name'] + '/' + db['endpoint'][5]
+    response = dbclient.post(url,
+                             json={"objtype": "user", "objkeys": ids})
+    if response.status_code != 200:
+        return Response(response.content,
+                        status=response.status_code,
+                        mimetype='application/json')
+    data = response.json()
+    items = [item if item is not None
+             else {"user_id": i, "error": "not found"}
+             for i, item in zip(ids, data['Items'])]
+    return {"Items": items, "Count": data['Count']}
 
 
 @bp.route('/<user_id>', methods=['PUT'])
@@ -90,10 +195,11 @@ def update_user(user_id):
     except Exception:
         return json.dumps({"message": "error reading arguments"})
     url = db['name'] + '/' + db['endpoint'][3]
-    response = requests.put(
+    response = dbclient.put(
         url,
         params={"objtype": "user", "objkey": user_id},
         json={"email": email, "fname": fname, "lname": lname})
+    users.invalidate(user_id)
     return (response.json())
 
 
@@ -112,13 +218,48 @@ def create_user():
     except Exception:
         return json.dumps({"message": "error reading arguments"})
     url = db['name'] + '/' + db['endpoint'][1]
-    response = requests.post(
+    created = time.time_ns()
+    response = dbclient.post(
         url,
         json={"objtype": "user",
               "lname": lname,
               "email": email,
-              "fname": fname})
-    return (response.json())
+              "fname": fname,
+              "created": created})
+    if response.status_code != 200:
+        return Response(response.content,
+                        status=response.status_code,
+                        mimetype='application/json')
+    body = response.json()
+    if body.get('user_id') is not None:
+        replace_older(body['user_id'], created, fname, lname, email)
+    return body
+
+
+def replace_older(user_id, created, fname, lname, email):
+    """
+    Delete the users with the same names and email that were created
+    before `user_id`, only once it has been written.  Of concurrent
+    creates, each deletes the older ones, so the newest survives.
+    """
+    response = find_by_email(email)
+    if response.status_code != 200:
+        # Tables created before the email index existed cannot be queried
+        logging.warning("email lookup failed ({}); not replacing "
+                        "duplicates".format(response.status_code))
+        return
+    url = db['name'] + '/' + db['endpoint'][2]
+    for item in response.json()['Items']:
+        if item['user_id'] == user_id or item.get('fname') != fname or \
+                item.get('lname') != lname:
+            continue
+        # Users created before this field existed count as oldest
+        if (int(item.get('created', 0)), item['user_id']) > \
+                (created, user_id):
+            continue
+        dbclient.delete(url,
+                        params={"objtype": "user", "objkey": item['user_id']})
+        users.invalidate(item['user_id'])
 
 
 @bp.route('/<user_id>', methods=['DELETE'])
@@ -130,9 +271,9 @@ def delete_user(user_id):
                         status=401,
                         mimetype='application/json')
     url = db['name'] + '/' + db['endpoint'][2]
-
-    response = requests.delete(url,
+    response = dbclient.delete(url,
                                params={"objtype": "user", "objkey": user_id})
+    users.invalidate(user_id)
     return (response.json())
 
 @bp.route('/<user_id>', methods=['GET'])
@@ -146,8 +287,51 @@ def get_user(user_id):
             mimetype='application/json')
     payload = {"objtype": "user", "objkey": user_id}
     url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(url, params=payload)
-    return (response.json())
+    body = cache.read(users, user_id,
+                      lambda: dbclient.get(url, params=payload))
+    return cache.respond(body)
+
+
+@bp.route('/<user_id>/playlists', methods=['GET'])
+def list_playlists(user_id):
+    """
+    List the playlists owned by a user, a page at a time.
+
+    `limit` sets the page size.  A response with a non-null `next`
+    may have more playlists; pass it back as `next` for the next page.
+    The caller must present a verified token (see `common/auth.py`),
+    and may only list their own playlists.
+    """
+    headers = request.headers
+    # check header here
+    if 'Authorization' not in headers:
+        return Response(json.dumps({"error": "missing auth"}),
+                        status=401,
+                        mimetype='application/json')
+    # An opaque token, accepted in permissive mode, names no user
+    if g.get('user_id') is None:
+        return Response(json.dumps({"error": "verified token required"}),
+                        status=401,
+                        mimetype='application/json')
+    if g.user_id != user_id:
+        return Response(json.dumps({"error": "not your playlists"}),
+                        status=403,
+                        mimetype='application/json')
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    params = {"objtype": "playlist", "attr": "owner", "value": user_id,
+              "limit": max(1, min(limit, MAX_PAGE_SIZE))}
+    if 'next' in request.args:
+        params['start'] = request.args['next']
+    url = db['name'] + '/' + db['endpoint'][4]
+    response = dbclient.get(url, params=params)
+    if response.status_code != 200:
+        return Response(response.content,
+                        status=response.status_code,
+                        mimetype='application/json')
+    data = response.json()
+    return {"Items": data['Items'],
+            "Count": data['Count'],
+            "next": data.get('NextToken')}
 
 
 @bp.route('/login', methods=['PUT'])
@@ -158,12 +342,10 @@ def login():
     except Exception:
         return json.dumps({"message": "error reading parameters"})
     url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(url, params={"objtype": "user", "objkey": uid})
+    response = dbclient.get(url, params={"objtype": "user", "objkey": uid})
     data = response.json()
     if len(data['Items']) > 0:
-        encoded = jwt.encode({'user_id': uid, 'time': time.time()},
-                             'secret',
-                             algorithm='HS256')
+        encoded = auth.encode(uid)
     return encoded
 
 
@@ -171,9 +353,10 @@ def login():
 def logoff():
     try:
         content = request.get_json()
-        _ = content['jwt']
+        token = content['jwt']
     except Exception:
         return json.dumps({"message": "error reading parameters"})
+    auth.revoke(token)
     return {}
 
 
@@ -188,5 +371,6 @@ if __name__ == '__main__':
         sys.exit(-1)
 
     p = int(sys.argv[1])
+    # Development server only; images run `python -m common.serve`.
     # Do not set debug=True---that will disable the Prometheus metrics
     app.run(host='0.0.0.0', port=p, threaded=True)
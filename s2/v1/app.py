@@ -14,18 +14,40 @@ from flask import Flask
 from flask import request
 from flask import Response
 
-from prometheus_flask_exporter import PrometheusMetrics
-
-import requests
-
 import simplejson as json
 
+# Local modules
+from common import auth
+from common import cache
+from common import changes
+from common import dbclient
+from common import deadline
+from common import limiter
+from common import probes
+from common import recorder
+from common import saturation
+from common import startup
+from common import timing
+from common import tracing
+from common import warmup
+from common.metrics import init_metrics
+
 # The application
 
 app = Flask(__name__)
 
-metrics = PrometheusMetrics(app)
+metrics = init_metrics(app)
 metrics.info('app_info', 'Music process')
+limiter.init_app(app)
+startup.init_app(app)
+saturation.init_app(app)
+recorder.init_app(app, 'music')
+timing.init_app(app)
+deadline.init_app(app)
+dbclient.init_app(app)
+changes.init_app(app)
+auth.init_app(app)
+tracing.init_app(app, 'music')
 
 db = {
     "name": "http://cmpt756db:30002/api/v1/datastore",
@@ -33,11 +55,33 @@ db = {
         "read",
         "write",
         "delete",
-        "update"
+        "update",
+        "batch_read"
     ]
 }
 bp = Blueprint('app', __name__)
 
+# Most ids accepted by one multi-get
+MAX_IDS = 500
+
+songs = cache.TTLCache('music')
+changes.subscribe('music',
+                  lambda change: songs.invalidate(change.objkey))
+
+
+def warm_songs(ids):
+    """Cache the songs with these ids, from one batched read."""
+    url = db['name'] + '/' + db['endpoint'][4]
+    response = dbclient.post(url,
+                             json={"objtype": "music", "objkeys": ids})
+    for item in response.json()['Items']:
+        if item is not None:
+            cache.prime(songs, item['music_id'], item)
+
+
+warmup.init_app(app, 'music', warm_songs, 'file:resources/music.csv')
+probes.init_app(lambda: dbclient.ping(db['name'] + '/health'))
+
 
 @bp.route('/health')
 @metrics.do_not_track()
@@ -48,11 +92,10 @@ def health():
 @bp.route('/readiness')
 @metrics.do_not_track()
 def readiness():
-    return Response("", status=200, mimetype="application/json")
+    return probes.readiness()
 
 
 @bp.route('/', methods=['GET'])
-@metrics.do_not_track()
 def list_all():
     headers = request.headers
     # check header here
@@ -60,10 +103,12 @@ def list_all():
         return Response(json.dumps({"error": "missing auth"}),
                         status=401,
                         mimetype='application/json')
+    if 'ids' in request.args:
+        return get_many(request.args['ids'].split(','))
     # list all songs here
     # payload = {"objtype": "music"}
     # url = db['name'] + '/' + db['endpoint'][0]
-    # response = requests.get(
+    # response = dbclient.get(
     #     url,
     #     params=payload,
     #     headers={'Authorization': headers['Authorization']})
@@ -71,6 +116,49 @@ def list_all():
     return {}
 
 
+@bp.route('/batch', methods=['POST'])
+def batch_get():
+    """Like `GET /?ids=`, for lists too long for a URL: {"ids": [...]}."""
+    headers = request.headers
+    # check header here
+    if 'Authorization' not in headers:
+        return Response(json.dumps({"error": "missing auth"}),
+                        status=401,
+                        mimetype='application/json')
+    try:
+        ids = request.get_json()['ids']
+    except Exception:
+        return json.dumps({"message": "error reading arguments"})
+    return get_many(ids)
+
+
+def get_many(ids):
+    """
+    Return the songs with these ids, from one datastore read.
+
+    The items are in the order of `ids`; an id with no song gets
+    {"music_id": id, "error": "not found"} in its place.
+    """
+    ids = [str(i).strip() for i in ids if str(i).strip()]
+    if not ids or len(ids) > MAX_IDS:
+        return Response(
+            json.dumps({"error": "need 1 to {} ids".format(MAX_IDS)}),
+            status=400,
+            mimetype='application/json')
+    url = db['name'] + '/' + db['endpoint'][4]
+    response = dbclient.post(url,
+                             json={"objtype": "music", "objkeys": ids})
+    if response.status_code != 200:
+        return Response(response.content,
+                        status=response.status_code,
+                        mimetype='application/json')
+    data = response.json()
+    items = [item if item is not None
+             else {"music_id": i, "error": "not found"}
+             for i, item in zip(ids, data['Items'])]
+    return {"Items": items, "Count": data['Count']}
+
+
 @bp.route('/<music_id>', methods=['GET'])
 def get_song(music_id):
     headers = request.headers
@@ -81,11 +169,11 @@ def get_song(music_id):
                         mimetype='application/json')
     payload = {"objtype": "music", "objkey": music_id}
     url = db['name'] + '/' + db['endpoint'][0]
-    response = requests.get(
+    body = cache.read(songs, music_id, lambda: dbclient.get(
         url,
         params=payload,
-        headers={'Authorization': headers['Authorization']})
-    return (response.json())
+        headers={'Authorization': headers['Authorization']}))
+    return cache.respond(body)
 
 
 @bp.route('/', methods=['POST'])
@@ -103,7 +191,7 @@ def create_song():
     except Exception:
         return json.dumps({"message": "error reading arguments"})
     url = db['name'] + '/' + db['endpoint'][1]
-    response = requests.post(
+    response = dbclient.post(
         url,
         json={"objtype": "music", "Artist": Artist, "SongTitle": SongTitle},
         headers={'Authorization': headers['Authorization']})
@@ -119,10 +207,11 @@ def delete_song(music_id):
                         status=401,
                         mimetype='application/json')
     url = db['name'] + '/' + db['endpoint'][2]
-    response = requests.delete(
+    response = dbclient.delete(
         url,
         params={"objtype": "music", "objkey": music_id},
         headers={'Authorization': headers['Authorization']})
+    songs.invalidate(music_id)
     return (response.json())
 
 @bp.route('/<music_id>', methods=['PUT'])
@@ -140,10 +229,11 @@ def update_song(music_id):
     except Exception:
         return json.dumps({"message": "error reading arguments"})
     url = db['name'] + '/' + db['endpoint'][3]
-    response = requests.put(
+    response = dbclient.put(
         url,
         params={"objtype": "music", "objkey": music_id},
         json={"Artist": artist, "SongTitle": song})
+    songs.invalidate(music_id)
     return (response.json())
 
 
@@ -159,5 +249,6 @@ if __name__ == '__main__':
         sys.exit(-1)
 
     p = int(sys.argv[1])
+    # Development server only; images run `python -m common.serve`.
     # Do not set debug=True---that will disable the Prometheus metrics
     app.run(host='0.0.0.0', port=p, threaded=True)
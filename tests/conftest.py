@@ -0,0 +1,38 @@
+"""
+SFU CMPT 756
+Shared setup for the unit tests.
+
+    python -m pytest tests
+"""
+
+# Standard library modules
+import os
+import sys
+
+# Installed packages
+import pytest
+
+# The tests import `common` from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+
+class Clock:
+    """A stand-in for time.monotonic that only moves when told to."""
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replace time.monotonic with a Clock for the test."""
+    fake = Clock()
+    monkeypatch.setattr('time.monotonic', fake)
+    return fake
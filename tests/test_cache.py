@@ -0,0 +1,63 @@
+"""
+SFU CMPT 756
+Tests for the read-through cache's invalidation.
+"""
+
+# Local modules
+from common import cache
+
+
+class Response:
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def json(self):
+        return self.body
+
+
+def found(name):
+    return {'Count': 1, 'Items': [{'name': name}]}
+
+
+def test_fetch_caches_result(clock):
+    items = cache.TTLCache('test', 10, 5.0)
+    cache.fetch_into(items, 'k', lambda: Response(found('old')))
+    assert items.get('k') == found('old')
+
+
+def test_fetch_invalidated_in_flight_is_dropped(clock):
+    items = cache.TTLCache('test', 10, 5.0)
+
+    def fetch():
+        # A write lands while the fetch is under way
+        items.invalidate('k')
+        return Response(found('old'))
+    status, body = cache.fetch_into(items, 'k', fetch)
+    assert (status, body) == (200, found('old'))
+    assert items.get('k') is None
+    # A fetch started after the write is cached
+    cache.fetch_into(items, 'k', lambda: Response(found('new')))
+    assert items.get('k') == found('new')
+
+
+def test_missing_invalidated_in_flight_is_dropped(clock):
+    items = cache.TTLCache('test', 10, 5.0)
+
+    def fetch():
+        items.invalidate('k')
+        return Response({'Count': 0, 'Items': []})
+    cache.fetch_into(items, 'k', fetch)
+    assert items.missing.get('k') is None
+
+
+def test_forgotten_invalidations_drop_older_fetches(clock):
+    items = cache.TTLCache('test', 2, 5.0)
+    token = items.token()
+    for key in 'abc':
+        items.invalidate(key)
+    # 'a' is no longer remembered, so a fetch from before is not trusted
+    items.put('a', found('old'), token)
+    assert items.get('a') is None
+    items.put('a', found('new'), items.token())
+    assert items.get('a') == found('new')
@@ -0,0 +1,222 @@
+"""
+SFU CMPT 756
+Tests for the db client's retry budget, circuit breaker and hedging.
+"""
+
+# Standard library modules
+import time
+
+# Installed packages
+import pytest
+
+# Local modules
+from common import dbclient
+
+
+def test_budget_starts_full_and_runs_out():
+    budget = dbclient.RetryBudget(0.2, cap=3.0)
+    assert [budget.withdraw() for _ in range(4)] == [True, True, True, False]
+
+
+def test_budget_refills_by_ratio_per_call():
+    budget = dbclient.RetryBudget(0.25, cap=3.0)
+    while budget.withdraw():
+        pass
+    for _ in range(3):
+        budget.deposit()
+    assert not budget.withdraw()
+    budget.deposit()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+def test_budget_is_capped():
+    budget = dbclient.RetryBudget(0.5, cap=2.0)
+    for _ in range(100):
+        budget.deposit()
+    assert budget.tokens == 2.0
+
+
+def make_breaker():
+    return dbclient.CircuitBreaker(threshold=0.5, min_calls=4, window=10,
+                                   cooldown=5.0)
+
+
+def test_breaker_needs_min_calls(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == dbclient.CLOSED
+    breaker.record(False)
+    assert breaker.state == dbclient.OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_stays_closed_below_threshold(clock):
+    breaker = make_breaker()
+    for ok in [True, True, False] * 10:
+        breaker.record(ok)
+        clock.advance(0.1)
+    assert breaker.state == dbclient.CLOSED
+    assert breaker.allow()
+
+
+def test_breaker_forgets_failures_outside_window(clock):
+    breaker = make_breaker()
+    for _ in range(3):
+        breaker.record(False)
+    clock.advance(11)
+    breaker.record(False)
+    assert breaker.state == dbclient.CLOSED
+
+
+def test_breaker_half_open_trial_closes(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record(False)
+    clock.advance(4.9)
+    assert not breaker.allow()
+    clock.advance(0.1)
+    # One trial call only
+    assert breaker.allow()
+    assert breaker.state == dbclient.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == dbclient.CLOSED
+    assert breaker.allow()
+    # The failures before the trip no longer count
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == dbclient.CLOSED
+
+
+def test_breaker_half_open_trial_reopens(clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record(False)
+    clock.advance(5)
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.state == dbclient.OPEN
+    assert not breaker.allow()
+    # The cooldown starts again from the failed trial
+    clock.advance(4.9)
+    assert not breaker.allow()
+    clock.advance(0.1)
+    assert breaker.allow()
+
+
+def test_tracker_waits_for_samples():
+    tracker = dbclient.LatencyTracker('read')
+    for _ in range(dbclient.HEDGE_MIN_SAMPLES - 1):
+        tracker.observe(0.01)
+    assert tracker.delay() is None
+
+
+def test_tracker_delay_is_percentile():
+    tracker = dbclient.LatencyTracker('read')
+    for i in range(100):
+        tracker.observe((i + 1) / 1000.0)
+    index = int(100 * dbclient.HEDGE_PERCENTILE / 100.0)
+    assert tracker.delay() == (index + 1) / 1000.0
+
+
+def test_tracker_delay_has_floor():
+    tracker = dbclient.LatencyTracker('read')
+    for _ in range(100):
+        tracker.observe(0.0)
+    assert tracker.delay() == dbclient.HEDGE_MIN_DELAY
+
+
+class Response:
+    def __init__(self, name):
+        self.name = name
+
+
+def slow_then_fast(delays):
+    """A session.request whose calls take the given times in turn."""
+    calls = []
+
+    def request(method, url, **kwargs):
+        n = len(calls)
+        calls.append(n)
+        time.sleep(delays[n])
+        return Response(n)
+    return request, calls
+
+
+def tracker_with_delay(monkeypatch, delay):
+    tracker = dbclient.LatencyTracker('read')
+    tracker.current = delay
+    monkeypatch.setattr(dbclient, 'trackers', {'read': tracker})
+    return tracker
+
+
+def test_hedge_sent_when_first_is_slow(monkeypatch):
+    tracker_with_delay(monkeypatch, 0.01)
+    monkeypatch.setattr(dbclient, 'hedge_budget',
+                        dbclient.RetryBudget(0.05))
+    request, calls = slow_then_fast([0.5, 0.0])
+    monkeypatch.setattr(dbclient.session, 'request', request)
+    response = dbclient.hedged_request('read', 'GET', 'http://db/read')
+    assert response.name == 1
+    assert len(calls) == 2
+
+
+def test_no_hedge_when_first_is_fast(monkeypatch):
+    tracker_with_delay(monkeypatch, 0.5)
+    monkeypatch.setattr(dbclient, 'hedge_budget',
+                        dbclient.RetryBudget(0.05))
+    request, calls = slow_then_fast([0.0, 0.0])
+    monkeypatch.setattr(dbclient.session, 'request', request)
+    response = dbclient.hedged_request('read', 'GET', 'http://db/read')
+    assert response.name == 0
+    assert len(calls) == 1
+
+
+def test_no_hedge_without_budget(monkeypatch):
+    tracker_with_delay(monkeypatch, 0.01)
+    monkeypatch.setattr(dbclient, 'hedge_budget',
+                        dbclient.RetryBudget(0.05, cap=0.0))
+    request, calls = slow_then_fast([0.1, 0.0])
+    monkeypatch.setattr(dbclient.session, 'request', request)
+    response = dbclient.hedged_request('read', 'GET', 'http://db/read')
+    assert response.name == 0
+    assert len(calls) == 1
+
+
+def half_open(monkeypatch, clock):
+    breaker = make_breaker()
+    for _ in range(4):
+        breaker.record(False)
+    clock.advance(5)
+    monkeypatch.setattr(dbclient, 'breaker', breaker)
+    return breaker
+
+
+def test_trial_released_when_deadline_runs_out(monkeypatch, clock):
+    breaker = half_open(monkeypatch, clock)
+
+    def timeout(*args, **kwargs):
+        # The caller's deadline passes while the call is in flight
+        monkeypatch.setattr(dbclient.deadline, 'remaining', lambda: -1.0)
+        raise dbclient.requests.Timeout()
+    monkeypatch.setattr(dbclient, 'send', timeout)
+    with pytest.raises(dbclient.deadline.DeadlineExceeded):
+        dbclient.request('GET', 'http://db/read')
+    assert breaker.state == dbclient.HALF_OPEN
+    # The next call is the trial, and closes the breaker
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == dbclient.CLOSED
+
+
+def test_trial_released_on_unexpected_error(monkeypatch, clock):
+    breaker = half_open(monkeypatch, clock)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("bug")
+    monkeypatch.setattr(dbclient, 'send', fail)
+    with pytest.raises(RuntimeError):
+        dbclient.request('GET', 'http://db/read')
+    assert breaker.allow()
@@ -0,0 +1,89 @@
+"""
+SFU CMPT 756
+Tests for the Space-Saving sketch and its sliding window.
+"""
+
+# Standard library modules
+import collections
+import random
+
+# Local modules
+from common import hotkeys
+
+
+def test_sketch_counts_exactly_below_k():
+    sketch = hotkeys.SpaceSaving(4)
+    for key in 'aabbbc':
+        sketch.offer(key)
+    assert sketch.counts == {'a': 2, 'b': 3, 'c': 1}
+    assert set(sketch.errors.values()) == {0}
+    assert sketch.total == 6
+
+
+def test_sketch_bounds_hold_on_any_stream():
+    rng = random.Random(756)
+    stream = ([rng.randrange(1000) for _ in range(5000)] +
+              [1, 2, 3] * 1000)
+    rng.shuffle(stream)
+    truth = collections.Counter(stream)
+    sketch = hotkeys.SpaceSaving(16)
+    for key in stream:
+        sketch.offer(key)
+    assert len(sketch.counts) == 16
+    assert sketch.total == len(stream)
+    assert sum(sketch.counts.values()) == len(stream)
+    for key, count in sketch.counts.items():
+        assert count - sketch.errors[key] <= truth[key] <= count
+
+
+def test_sketch_finds_heavy_hitters():
+    # Every key with more than total / k occurrences is kept
+    rng = random.Random(756)
+    stream = [rng.randrange(10000) for _ in range(2000)] + ['hot'] * 300
+    rng.shuffle(stream)
+    sketch = hotkeys.SpaceSaving(10)
+    for key in stream:
+        sketch.offer(key)
+    assert 'hot' in sketch.counts
+    assert max(sketch.counts, key=sketch.counts.get) == 'hot'
+
+
+def test_tracker_merges_buckets(clock):
+    tracker = hotkeys.Tracker('music', 'read', k=8, window=6.0)
+    for _ in range(3):
+        tracker.offer('a')
+        clock.advance(1.0)
+    tracker.offer('b')
+    hottest, total = tracker.top(2)
+    assert hottest == [('a', 3, 0), ('b', 1, 0)]
+    assert total == 4
+    assert len(tracker.ring) == 4
+
+
+def test_tracker_forgets_old_traffic(clock):
+    tracker = hotkeys.Tracker('music', 'read', k=8, window=6.0)
+    for _ in range(100):
+        tracker.offer('old')
+    clock.advance(3.0)
+    tracker.offer('new')
+    assert tracker.top(1) == ([('old', 100, 0)], 101)
+    clock.advance(3.0)
+    assert tracker.top(2) == ([('new', 1, 0)], 1)
+
+
+def test_tracker_empties_after_idle(clock):
+    tracker = hotkeys.Tracker('music', 'read', k=8, window=0.6)
+    for _ in range(100):
+        tracker.offer('hot')
+    clock.advance(2.0)
+    assert tracker.top(1) == ([], 0)
+    tracker.offer('hot')
+    assert tracker.top(1) == ([('hot', 1, 0)], 1)
+    assert len(tracker.ring) == hotkeys.BUCKETS
+
+
+def test_record_ignores_unknown_objtypes(monkeypatch):
+    monkeypatch.setattr(hotkeys, 'trackers', {})
+    hotkeys.record('music', 'read', 'a')
+    hotkeys.record('no-such-table', 'read', 'a')
+    assert list(hotkeys.trackers) == [('music', 'read')]
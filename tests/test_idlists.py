@@ -0,0 +1,82 @@
+"""
+SFU CMPT 756
+Tests for the packed encoding of id lists.
+"""
+
+# Standard library modules
+import uuid
+
+# Local modules
+from common import idlists
+
+
+def ids(n):
+    return [str(uuid.UUID(int=i * 0x1234567890abcdef + 1, version=4))
+            for i in range(n)]
+
+
+def test_pack_round_trip():
+    music = ids(50)
+    packed = idlists.pack(music)
+    assert len(packed) == 50 * idlists.UUID_BYTES
+    assert idlists.unpack(packed) == music
+
+
+def test_pack_refuses_other_lists():
+    assert idlists.pack([]) is None
+    assert idlists.pack(ids(2) + ['not-a-uuid']) is None
+    assert idlists.pack(['6ECFAFD0-8A35-4F51-8F3C-0D1D2F3A4B5C']) is None
+    assert idlists.pack([1, 2]) is None
+
+
+def test_item_round_trip():
+    music = ids(3)
+    item = {'playlist_id': 'p1', 'name': 'mix', 'music_list': list(music)}
+    stored = idlists.encode_item(dict(item), idlists.PACKED)
+    assert isinstance(stored['music_list'], bytes)
+    assert stored['name'] == 'mix'
+    assert idlists.decode_item(stored) == item
+
+
+def test_item_kept_as_list_when_not_packable():
+    item = {'playlist_id': 'p1', 'music_list': ['a', 'b']}
+    assert idlists.encode_item(dict(item), idlists.PACKED) == item
+    item = {'playlist_id': 'p1', 'music_list': []}
+    assert idlists.encode_item(dict(item), idlists.PACKED) == item
+
+
+def test_list_encoding_unpacks():
+    music = ids(2)
+    stored = {'music_list': idlists.pack(music)}
+    assert idlists.encode_item(stored, idlists.LIST) == {'music_list': music}
+
+
+def test_decode_accepts_both_forms():
+    music = ids(2)
+
+    class Binary:
+        # boto3's wrapper of Binary attributes
+        def __init__(self, value):
+            self.value = value
+    assert idlists.decode_item({'music_list': list(music)}) == \
+        {'music_list': music}
+    assert idlists.decode_item({'music_list': Binary(
+        idlists.pack(music))}) == {'music_list': music}
+    assert idlists.decode_item(None) is None
+
+
+def test_needs_migration():
+    item = {'music_list': ids(2)}
+    assert idlists.needs_migration(item, idlists.PACKED)
+    assert not idlists.needs_migration(item, idlists.LIST)
+    packed = idlists.encode_item(dict(item), idlists.PACKED)
+    assert not idlists.needs_migration(packed, idlists.PACKED)
+    assert idlists.needs_migration(packed, idlists.LIST)
+
+
+def test_packed_item_is_smaller():
+    item = {'playlist_id': ids(1)[0], 'music_list': ids(20)}
+    packed = idlists.encode_item(dict(item), idlists.PACKED)
+    assert idlists.value_size(packed['music_list']) == 20 * 16
+    assert idlists.value_size(item['music_list']) == 3 + 20 * 37
+    assert idlists.item_size(packed) < idlists.item_size(item) / 2
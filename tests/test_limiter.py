@@ -0,0 +1,127 @@
+"""
+SFU CMPT 756
+Tests for the concurrency limiter's algorithms and counting.
+"""
+
+# Local modules
+from common import limiter
+
+
+def run_window(limit, clock, rtt, inflight, overloaded=False):
+    """Feed `limit` one full gradient window of identical samples."""
+    for _ in range(limiter.WINDOW_MIN_SAMPLES - 1):
+        limit.sample(rtt, inflight, overloaded)
+    clock.advance(limiter.WINDOW_SECONDS)
+    limit.sample(rtt, inflight, overloaded)
+
+
+def make_gradient():
+    return limiter.GradientLimit(20, 4, 200, 1.5)
+
+
+def test_gradient_waits_for_full_window(clock):
+    limit = make_gradient()
+    for _ in range(limiter.WINDOW_MIN_SAMPLES * 10):
+        limit.sample(0.01, 20, False)
+    assert limit.long_rtt is None
+    assert limit.limit == 20
+
+
+def test_gradient_grows_at_steady_latency(clock):
+    limit = make_gradient()
+    for _ in range(10):
+        before = limit.limit
+        run_window(limit, clock, 0.01, int(limit.limit))
+        assert limit.limit > before
+    assert limit.limit <= 200
+
+
+def test_gradient_ignores_idle_windows(clock):
+    limit = make_gradient()
+    for _ in range(10):
+        run_window(limit, clock, 0.01, 5)
+    assert limit.limit == 20
+
+
+def test_gradient_shrinks_as_latency_rises(clock):
+    limit = make_gradient()
+    run_window(limit, clock, 0.01, 20)
+    grown = limit.limit
+    for _ in range(5):
+        before = limit.limit
+        run_window(limit, clock, 0.1, int(limit.limit))
+        assert limit.limit < before
+    assert limit.limit < grown
+
+
+def test_gradient_tolerates_some_latency_growth(clock):
+    limit = make_gradient()
+    run_window(limit, clock, 0.01, 20)
+    before = limit.limit
+    run_window(limit, clock, 0.014, 20)
+    assert limit.limit > before
+
+
+def test_gradient_stays_within_bounds(clock):
+    limit = limiter.GradientLimit(20, 10, 200, 1.5)
+    run_window(limit, clock, 0.01, 20)
+    for _ in range(20):
+        run_window(limit, clock, 10.0, 200)
+    assert limit.limit == 10
+    limit = make_gradient()
+    for _ in range(1000):
+        run_window(limit, clock, 0.01, 200)
+    assert limit.limit == 200
+
+
+def make_aimd():
+    return limiter.AimdLimit(10, 4, 12, 0.5)
+
+
+def test_aimd_adds_one_per_fast_busy_request():
+    limit = make_aimd()
+    limit.sample(0.1, 5, False)
+    assert limit.limit == 11
+    limit.sample(0.1, 5, False)
+    limit.sample(0.1, 12, False)
+    assert limit.limit == 12
+
+
+def test_aimd_ignores_idle_requests():
+    limit = make_aimd()
+    limit.sample(0.1, 4, False)
+    assert limit.limit == 10
+
+
+def test_aimd_backs_off_on_slow_or_overloaded():
+    limit = make_aimd()
+    limit.sample(0.6, 10, False)
+    assert limit.limit == 9
+    limit.sample(0.1, 10, True)
+    assert abs(limit.limit - 8.1) < 1e-9
+    for _ in range(100):
+        limit.sample(1.0, 10, False)
+    assert limit.limit == 4
+
+
+def test_limiter_rejects_at_limit():
+    concurrency = limiter.Limiter(limiter.AimdLimit(2, 1, 10, 0.5))
+    assert concurrency.acquire() == 1
+    assert concurrency.acquire() == 2
+    assert concurrency.acquire() == 0
+    assert (concurrency.admitted, concurrency.rejected) == (2, 1)
+    concurrency.release(0.1, 2, False)
+    assert concurrency.inflight == 1
+    assert concurrency.acquire() > 0
+
+
+def test_limiter_counts_queued_requests():
+    concurrency = limiter.Limiter(limiter.AimdLimit(3, 1, 10, 0.5))
+    for _ in range(4):
+        concurrency.enqueue()
+    # Taken off the queue with three still waiting behind it
+    concurrency.dequeue()
+    assert concurrency.acquire() == 0
+    concurrency.dequeue()
+    assert concurrency.acquire() == 3
+    assert (concurrency.inflight, concurrency.waiting) == (1, 2)
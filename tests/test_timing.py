@@ -0,0 +1,78 @@
+"""
+SFU CMPT 756
+Tests for the per-request timing breakdown.
+"""
+
+# Installed packages
+import flask
+import prometheus_client
+import pytest
+
+# Local modules
+from common import timing
+
+
+@pytest.fixture
+def ticks(clock, monkeypatch):
+    """Replace time.perf_counter with the test's Clock."""
+    monkeypatch.setattr('time.perf_counter', clock)
+    return clock
+
+
+def observed(phase):
+    count = prometheus_client.REGISTRY.get_sample_value(
+        'request_phase_seconds_count', {'phase': phase})
+    return count or 0.0
+
+
+def make_app(ticks, monkeypatch, send_header='1'):
+    monkeypatch.setenv('SERVER_TIMING', send_header)
+    app = flask.Flask(__name__)
+    timing.init_app(app)
+
+    @app.route('/')
+    def index():
+        for ms in (3, 2):
+            with timing.phase('db'):
+                ticks.advance(ms / 1000.0)
+        with timing.phase('auth'):
+            ticks.advance(0.0005)
+        timing.add_downstream(
+            'db', 'dynamodb;dur=4.00, total;dur=6.00')
+        ticks.advance(0.001)
+        return 'ok'
+    return app.test_client()
+
+
+def test_header_lists_phases(ticks, monkeypatch):
+    response = make_app(ticks, monkeypatch).get('/')
+    assert response.headers['Server-Timing'] == (
+        'db;dur=5.00;desc="2 calls", auth;dur=0.50, '
+        'serialize;dur=0.00, db-dynamodb;dur=4.00, total;dur=6.50')
+
+
+def test_phases_observed_once_per_request(ticks, monkeypatch):
+    before = {p: observed(p) for p in ('db', 'auth', 'serialize')}
+    sums = prometheus_client.REGISTRY.get_sample_value(
+        'request_phase_seconds_sum', {'phase': 'db'}) or 0.0
+    make_app(ticks, monkeypatch).get('/')
+    for phase, count in before.items():
+        assert observed(phase) == count + 1
+    assert observed('db-dynamodb') == 0.0
+    assert prometheus_client.REGISTRY.get_sample_value(
+        'request_phase_seconds_sum', {'phase': 'db'}) == \
+        pytest.approx(sums + 0.005)
+
+
+def test_header_can_be_turned_off(ticks, monkeypatch):
+    before = observed('db')
+    response = make_app(ticks, monkeypatch, send_header='0').get('/')
+    assert 'Server-Timing' not in response.headers
+    assert observed('db') == before + 1
+
+
+def test_phase_outside_request_is_observed_directly(ticks):
+    before = observed('warmup')
+    with timing.phase('warmup'):
+        ticks.advance(0.01)
+    assert observed('warmup') == before + 1
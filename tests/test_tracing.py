@@ -0,0 +1,42 @@
+"""
+SFU CMPT 756
+Tests for trace context propagation.
+"""
+
+# Installed packages
+import flask
+
+# Local modules
+from common import tracing
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+SPAN_ID = '00f067aa0ba902b7'
+
+
+def forwarded(headers):
+    """Return the headers a service would pass on for a request."""
+    app = flask.Flask(__name__)
+    tracing.init_app(app, 'test')
+
+    @app.route('/')
+    def index():
+        return flask.jsonify(tracing.outbound_headers())
+    return app.test_client().get('/', headers=headers).get_json()
+
+
+def test_traceparent_continues_trace():
+    out = forwarded({'traceparent': '00-{}-{}-01'.format(TRACE_ID, SPAN_ID),
+                     'tracestate': 'vendor=1'})
+    assert out['traceparent'] == '00-{}-{}-01'.format(TRACE_ID, SPAN_ID)
+    assert out['tracestate'] == 'vendor=1'
+    assert 'x-b3-traceid' not in out
+
+
+def test_malformed_traceparent_is_replaced():
+    out = forwarded({'traceparent': '00-{}-{}-01'.format('0' * 32, SPAN_ID),
+                     'tracestate': 'vendor=1', 'x-request-id': 'r1'})
+    assert 'traceparent' not in out
+    assert 'tracestate' not in out
+    assert len(out['x-b3-traceid']) == 32
+    assert out['x-b3-traceid'] != '0' * 32
+    assert out['x-request-id'] == 'r1'
@@ -0,0 +1,130 @@
+"""
+SFU CMPT 756
+Critical-path report for the spans written by the services.
+
+    python tools/critical-path.py [--top N] [--show N] SPANS.jsonl ...
+
+Joins the span files of any number of services (see
+`common/tracing.py`) by trace id and works out each trace's critical
+path: the chain of spans that the request actually waited on.  Where a
+span fans out, only the child that finished last before the parent
+could finish is on the path; children that overlapped it are not.
+
+The report charges the time on each trace's critical path to the span
+that was doing the work (its self time) and totals it by span over all
+traces, so the spans that dominate fan-out latency come first.
+--show prints the critical paths of the slowest traces.
+"""
+
+# Standard library modules
+import argparse
+import collections
+import json
+import sys
+
+
+def load(paths):
+    traces = collections.defaultdict(dict)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    span = json.loads(line)
+                    span['end'] = span['start'] + span['duration_ms'] / 1000.0
+                    traces[span['trace_id']][span['span_id']] = span
+    return traces
+
+
+def label(span):
+    return '{} {}'.format(span['service'], span['name'])
+
+
+def critical_path(span, children, lo=None, hi=None):
+    """
+    Return the critical path below `span` as [(span, self_ms), ...].
+
+    Spans are clipped to their parent's interval, because the clocks
+    of different pods need not agree.
+    """
+    lo = span['start'] if lo is None else max(lo, span['start'])
+    hi = span['end'] if hi is None else min(hi, span['end'])
+    path = []
+    self_s = 0.0
+    t = hi
+    for child in sorted(children.get(span['span_id'], []),
+                        key=lambda c: c['end'], reverse=True):
+        if child['end'] > t or child['end'] <= lo:
+            continue
+        start = max(child['start'], lo)
+        self_s += t - min(child['end'], t)
+        path.extend(critical_path(child, children, start, t))
+        t = start
+    self_s += max(t - lo, 0.0)
+    return [(span, self_s * 1000.0)] + path
+
+
+def analyse(spans):
+    """Return (root, path) for one trace's spans."""
+    children = collections.defaultdict(list)
+    roots = []
+    for span in spans.values():
+        if span.get('parent_id') in spans:
+            children[span['parent_id']].append(span)
+        else:
+            roots.append(span)
+    root = max(roots, key=lambda s: s['duration_ms'])
+    return root, critical_path(root, children)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Critical-path report for service span files")
+    parser.add_argument('files', nargs='+', help="span files (TRACE_FILE)")
+    parser.add_argument('--top', type=int, default=20,
+                        help="spans to list (default 20)")
+    parser.add_argument('--show', type=int, default=0,
+                        help="print the critical paths of the N slowest "
+                        "traces")
+    args = parser.parse_args(argv[1:])
+
+    traces = load(args.files)
+    if not traces:
+        sys.stderr.write("no spans found\n")
+        return 1
+
+    totals = collections.defaultdict(lambda: [0.0, 0])
+    results = []
+    total_ms = 0.0
+    for spans in traces.values():
+        root, path = analyse(spans)
+        results.append((root, path))
+        total_ms += root['duration_ms']
+        for span, self_ms in path:
+            entry = totals[label(span)]
+            entry[0] += self_ms
+            entry[1] += 1
+
+    print("{} traces, mean {:.2f} ms".format(len(traces),
+                                             total_ms / len(traces)))
+    print()
+    print("{:>7} {:>10} {:>8}  {}".format('share', 'total ms', 'count',
+                                          'span'))
+    ranked = sorted(totals.items(), key=lambda kv: kv[1][0], reverse=True)
+    for name, (ms, count) in ranked[:args.top]:
+        print("{:>6.1f}% {:>10.1f} {:>8}  {}".format(
+            100.0 * ms / total_ms if total_ms else 0.0, ms, count, name))
+
+    results.sort(key=lambda r: r[0]['duration_ms'], reverse=True)
+    for root, path in results[:args.show]:
+        print()
+        print("trace {} {:.2f} ms".format(root['trace_id'],
+                                          root['duration_ms']))
+        for span, self_ms in path:
+            print("  {:>8.2f} ms self  {:>8.2f} ms  {}".format(
+                self_ms, span['duration_ms'], label(span)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -10,6 +10,7 @@ then
   echo "   ReadUserSim"
   echo "   ReadMusicSim"
   echo "   ReadPlaylistSim"
+  echo "   MixedWorkloadSim (READ_PCT/WRITE_PCT/UPDATE_PCT/DELETE_PCT)"
   exit 1
 fi
 
@@ -0,0 +1,82 @@
+"""
+SFU CMPT 756
+Convert the stored id lists of a table to another encoding.
+
+    SVC_LOADER_TOKEN=... python tools/migrate-id-lists.py \
+        [--db URL] [--objtype playlist] [--page N] {packed,list}
+
+Calls the db service's `/migrate` endpoint a page at a time until the
+whole table has been scanned (see `common/idlists.py`).  Run it with
+`packed` after setting ID_LIST_ENCODING=packed on the db service, so
+that items written meanwhile are packed too; run it with `list` after
+setting ID_LIST_ENCODING=list to undo that.  It is safe to rerun or to
+interrupt: items already in the encoding are left alone, and an item
+written during the scan keeps what its writer stored.
+"""
+
+# Standard library modules
+import argparse
+import os
+import sys
+
+# Installed packages
+import requests
+
+
+def parse_args():
+    argp = argparse.ArgumentParser(
+        'migrate-id-lists',
+        description='Convert stored id lists to another encoding'
+        )
+    argp.add_argument(
+        'encoding',
+        choices=['packed', 'list'],
+        help="Encoding to convert to"
+        )
+    argp.add_argument(
+        '--db',
+        default='http://cmpt756db:30002/api/v1/datastore',
+        help="db service URL (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--objtype',
+        default='playlist',
+        help="Object type whose table is converted (default: %(default)s)"
+        )
+    argp.add_argument(
+        '--page',
+        type=int,
+        default=100,
+        help="Items scanned per call (default: %(default)s)"
+        )
+    return argp.parse_args()
+
+
+def main(args):
+    token = os.getenv('SVC_LOADER_TOKEN')
+    if not token:
+        print("SVC_LOADER_TOKEN is not set")
+        return 2
+    auth = requests.auth.HTTPBasicAuth('svc-loader', token)
+    totals = {"Scanned": 0, "Migrated": 0, "Conflicts": 0}
+    body = {"objtype": args.objtype, "encoding": args.encoding,
+            "limit": args.page}
+    while True:
+        response = requests.post(args.db + '/migrate', json=body, auth=auth,
+                                 timeout=30)
+        if response.status_code != 200:
+            print("migrate failed: {} {}".format(response.status_code,
+                                                 response.text))
+            return 1
+        page = response.json()
+        for key in totals:
+            totals[key] += page[key]
+        print("scanned {Scanned}, converted {Migrated}, "
+              "changed meanwhile {Conflicts}".format(**totals))
+        if 'NextToken' not in page:
+            return 0
+        body['start'] = page['NextToken']
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))